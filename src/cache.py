@@ -0,0 +1,174 @@
+"""Caches for results of processing documents."""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Mapping, Optional
+
+import lambdalogging
+from config import RESULT_CACHE_MAX_SIZE, RESULT_CACHE_DIRECTORY
+from constants import ETAG, VERSION_ID, CONTENT_RANGE, CONTENT_LENGTH
+
+LOG = lambdalogging.getLogger(__name__)
+
+
+class LruCache:
+    """Thread safe in-memory cache which evicts the least recently used entries once their total size exceeds max_size."""
+
+    def __init__(self, max_size: int, size_of: Callable[[Any], int] = lambda value: 1):
+        self.max_size = max_size
+        self.size_of = size_of
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value cached for given key, or default if there is none."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        """Cache given value, evicting the least recently used entries if needed. Values larger than max_size are not cached."""
+        value_size = self.size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if value_size > self.max_size:
+                return
+            self._entries[key] = (value, value_size)
+            self.size += value_size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        """Remove all the entries."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        """Check if given key is cached without marking it as recently used."""
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        """Return the number of cached entries."""
+        with self._lock:
+            return len(self._entries)
+
+
+class ResultCacheStore(ABC):
+    """Shared tier of the result cache, which can outlive a single Lambda execution environment."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Mapping]:
+        """Return the result stored for given key, or None if there is none."""
+
+    @abstractmethod
+    def put(self, key: str, value: Mapping):
+        """Store the result for given key."""
+
+
+class FileResultCacheStore(ResultCacheStore):
+    """Store keeping each result as a json file in a local directory, such as a mounted EFS file system."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Mapping]:
+        """Return the result stored for given key, or None if there is none."""
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as file_pointer:
+                return json.load(file_pointer)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, value: Mapping):
+        """Store the result for given key."""
+        # write to a temporary file first so that concurrent readers never see a partially written result
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w', encoding='utf-8') as file_pointer:
+                json.dump(value, file_pointer)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+class ResultCache:
+    """
+    Cache of document processing results keyed by the version of the S3 object and the configuration used to process it.
+
+    Results are looked up in an in-process LRU tier, which serves the warm invocations of the same execution environment, and
+    then in an optional shared tier. Failures of the shared tier are logged and treated as cache misses, so that they never fail
+    the request.
+    """
+
+    def __init__(self, local_tier: LruCache, shared_tier: ResultCacheStore = None):
+        self.local_tier = local_tier
+        self.shared_tier = shared_tier
+
+    @staticmethod
+    def key(http_headers: Mapping, *config) -> Optional[str]:
+        """
+        Build a cache key from the response headers of the downloaded object and given configuration.
+
+        Return None when the headers don't identify the version of the object, in which case the result can't be cached.
+        """
+        etag = http_headers.get(ETAG)
+        if not etag:
+            return None
+        object_version = [etag, http_headers.get(VERSION_ID), http_headers.get(CONTENT_RANGE), str(http_headers.get(CONTENT_LENGTH))]
+        serialized_key = json.dumps([object_version, config], sort_keys=True, default=str)
+        return hashlib.sha256(serialized_key.encode('utf-8')).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[Mapping]:
+        """Return the result cached for given key, or None if there is none."""
+        if key is None:
+            return None
+        value = self.local_tier.get(key)
+        if value is None and self.shared_tier is not None:
+            try:
+                value = self.shared_tier.get(key)
+            except Exception:
+                LOG.warning("Error reading from the shared result cache", exc_info=True)
+            if value is not None:
+                self.local_tier.put(key, value)
+        LOG.debug(f"Result cache {'hit' if value is not None else 'miss'} for key {key}")
+        return value
+
+    def put(self, key: Optional[str], value: Mapping):
+        """Cache the result for given key."""
+        if key is None:
+            return
+        self.local_tier.put(key, value)
+        if self.shared_tier is not None:
+            try:
+                self.shared_tier.put(key, value)
+            except Exception:
+                LOG.warning("Error writing to the shared result cache", exc_info=True)
+
+    def clear(self):
+        """Remove all the results cached in the in-process tier."""
+        self.local_tier.clear()
+
+
+def _result_size(result: Mapping) -> int:
+    """Approximate the memory held by a cached result by the length of the text it contains."""
+    return sum(len(value) if isinstance(value, str) else 1 for value in result.values())
+
+
+RESULT_CACHE = ResultCache(LruCache(RESULT_CACHE_MAX_SIZE, size_of=_result_size),
+                           FileResultCacheStore(RESULT_CACHE_DIRECTORY) if RESULT_CACHE_DIRECTORY else None)
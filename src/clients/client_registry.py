@@ -0,0 +1,76 @@
+"""Process-lifetime registry of the service clients used by the lambda function handlers."""
+import threading
+from typing import Dict, Optional, Tuple
+
+import lambdalogging
+from clients.cloudwatch_client import BackgroundMetricsPublisher, CloudWatchClient, EmbeddedMetricFormatClient, MetricsPublisher
+from clients.comprehend_client import ComprehendClient
+from clients.s3_client import S3Client
+from config import METRICS_MAX_LAG, METRICS_PUBLISHER
+from constants import DEFAULT_USER_AGENT, METRICS_PUBLISHER_VALID_VALUES
+
+LOG = lambdalogging.getLogger(__name__)
+
+
+class ClientRegistry:
+    """
+    Cache of service clients which lives as long as the Lambda execution environment.
+
+    Creating a client builds boto3 clients, http connection pools and thread pools. A warm container can skip all of that work
+    (including the TLS handshakes) by reusing the clients built by a previous invocation. Clients are keyed by the S3 object lambda
+    access point they serve and the endpoint they talk to, since both are baked into the client at construction time.
+    Per-request state such as the session id and the metrics buffers is reset through the client's `begin_request` method.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._s3_clients: Dict[Tuple[str, Optional[str]], S3Client] = {}
+        self._comprehend_clients: Dict[Tuple[str, Optional[str]], ComprehendClient] = {}
+        self._cloudwatch_client: Optional[MetricsPublisher] = None
+
+    def s3_client(self, s3ol_access_point: str, endpoint_url: str = None) -> S3Client:
+        """Return the s3 client for given access point and endpoint, creating it on first use."""
+        key = (s3ol_access_point, endpoint_url)
+        with self._lock:
+            if key not in self._s3_clients:
+                LOG.debug(f"Creating s3 client for access point {s3ol_access_point} and endpoint {endpoint_url}")
+                self._s3_clients[key] = S3Client(s3ol_access_point, endpoint_url=endpoint_url)
+            return self._s3_clients[key]
+
+    def comprehend_client(self, s3ol_access_point: str, endpoint_url: str = None,
+                          user_agent: str = DEFAULT_USER_AGENT) -> ComprehendClient:
+        """Return the comprehend client for given access point and endpoint, creating it on first use."""
+        key = (s3ol_access_point, endpoint_url)
+        with self._lock:
+            if key not in self._comprehend_clients:
+                LOG.debug(f"Creating comprehend client for access point {s3ol_access_point} and endpoint {endpoint_url}")
+                self._comprehend_clients[key] = ComprehendClient(s3ol_access_point=s3ol_access_point, user_agent=user_agent,
+                                                                 endpoint_url=endpoint_url)
+            return self._comprehend_clients[key]
+
+    def cloudwatch_client(self, metrics_publisher: METRICS_PUBLISHER_VALID_VALUES = METRICS_PUBLISHER,
+                          max_lag_in_millis: int = METRICS_MAX_LAG) -> MetricsPublisher:
+        """
+        Return the publisher of the cloudwatch metrics, creating it on first use.
+
+        Metrics published with PutMetricData are published in the background when a maximum lag is given.
+        """
+        with self._lock:
+            if self._cloudwatch_client is None:
+                if metrics_publisher == METRICS_PUBLISHER_VALID_VALUES.EMBEDDED_METRIC_FORMAT:
+                    self._cloudwatch_client = EmbeddedMetricFormatClient()
+                elif max_lag_in_millis > 0:
+                    self._cloudwatch_client = BackgroundMetricsPublisher(CloudWatchClient(), max_lag_in_millis)
+                else:
+                    self._cloudwatch_client = CloudWatchClient()
+            return self._cloudwatch_client
+
+    def clear(self):
+        """Forget all the cached clients."""
+        with self._lock:
+            self._s3_clients.clear()
+            self._comprehend_clients.clear()
+            self._cloudwatch_client = None
+
+
+CLIENT_REGISTRY = ClientRegistry()
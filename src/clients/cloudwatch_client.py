@@ -1,66 +1,150 @@
 """Client wrapper over aws services."""
-
-from typing import List
+import atexit
+import json
+import queue
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple, Type, Union
 
 import boto3
 
 import lambdalogging
 from constants import CLOUD_WATCH_NAMESPACE, LANGUAGE, COUNT, PII_DOCUMENTS_PROCESSED, DOCUMENTS_PROCESSED, NAME, \
     VALUE, S3OL_ACCESS_POINT, METRIC_NAME, UNIT, DIMENSIONS, PII_DOCUMENT_TYPES_PROCESSED, PII_ENTITY_TYPE, \
-    LATENCY, API, SERVICE, ERROR_COUNT, MILLISECONDS
+    LATENCY, API, SERVICE, ERROR_COUNT, MILLISECONDS, SEGMENT_CACHE_HIT_COUNT, SEGMENT_CACHE_MISS_COUNT, \
+    CONCURRENCY_LIMIT, VALUES, COUNTS, STATISTIC_VALUES, SAMPLE_COUNT, SUM, MINIMUM, MAXIMUM, PRE_SCREEN_CANDIDATE_COUNT, \
+    PRE_SCREEN_CLEAN_COUNT, PRE_SCREEN_MISS_COUNT
 
 LOG = lambdalogging.getLogger(__name__)
 
 
+class StatisticSet:
+    """Aggregate of the samples of a metric whose values only matter summed up, such as counts of events."""
+
+    def __init__(self):
+        self.sample_count = 0
+        self.sum = 0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value: float):
+        """Add a sample."""
+        self.sample_count += 1
+        self.sum += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def metric_data(self) -> List[Dict]:
+        """Return the values of the metric data, a single sample being kept as a plain value."""
+        if self.sample_count == 1:
+            return [{VALUE: self.sum}]
+        return [{STATISTIC_VALUES: {SAMPLE_COUNT: self.sample_count, SUM: self.sum, MINIMUM: self.minimum, MAXIMUM: self.maximum}}]
+
+
+class Histogram:
+    """
+    Aggregate of the samples of a metric whose distribution matters, such as latencies.
+
+    Samples are counted per distinct value, so that CloudWatch can still compute percentiles. A datum holds at most MAX_VALUES
+    distinct values, more distinct values are split across datums.
+    """
+
+    MAX_VALUES = 150
+
+    def __init__(self):
+        self.counts: Dict[float, int] = {}
+
+    def add(self, value: float):
+        """Add a sample."""
+        self.counts[value] = self.counts.get(value, 0) + 1
+
+    def metric_data(self) -> List[Dict]:
+        """Return the values of the metric data, a single sample being kept as a plain value."""
+        if len(self.counts) == 1 and sum(self.counts.values()) == 1:
+            return [{VALUE: next(iter(self.counts))}]
+        values = list(self.counts)
+        return [{VALUES: values[i:i + self.MAX_VALUES], COUNTS: [self.counts[value] for value in values[i:i + self.MAX_VALUES]]}
+                for i in range(0, len(values), self.MAX_VALUES)]
+
+
 class Metrics:
-    """Metrics class for latency and fault counts."""
+    """
+    Metrics class for latency and fault counts.
+
+    All the metrics share the same dimensions, so the samples are aggregated per metric as they are added, and a request making
+    hundreds of calls publishes a handful of datums. Latencies are rounded to whole milliseconds so that they aggregate densely.
+    """
 
     def __init__(self, service_name, api, s3ol_access_point, cloudwatch_namespace=CLOUD_WATCH_NAMESPACE):
         self.cloudwatch_namespace = cloudwatch_namespace
         self.service_name = service_name
         self.s3ol_access_point_arn = s3ol_access_point
         self.api = api
-        self.metrics = []
+        self._lock = threading.Lock()
+        self._aggregates: Dict[Tuple[str, str], Union[StatisticSet, Histogram]] = {}
 
-    def add_latency(self, start_time: float, end_time: float):
-        """Add a latency metric."""
-        self.metrics.append({METRIC_NAME: LATENCY, DIMENSIONS: [
+    @property
+    def metrics(self) -> List[Dict]:
+        """Return the metric data of the samples added so far, one or more datums per metric."""
+        dimensions = [
             {NAME: API, VALUE: self.api},
             {NAME: S3OL_ACCESS_POINT, VALUE: self.s3ol_access_point_arn},
             {NAME: SERVICE, VALUE: self.service_name}
-        ], UNIT: MILLISECONDS, VALUE: (end_time - start_time) * 1000})
+        ]
+        with self._lock:
+            return [dict({METRIC_NAME: metric_name, DIMENSIONS: dimensions, UNIT: unit}, **values)
+                    for (metric_name, unit), aggregate in self._aggregates.items() for values in aggregate.metric_data()]
+
+    def add_latency(self, start_time: float, end_time: float):
+        """Add a latency metric."""
+        self._add_sample(LATENCY, MILLISECONDS, round((end_time - start_time) * 1000), Histogram)
 
     def add_fault_count(self, count: int = 1):
         """Add a fault count metric."""
-        self.metrics.append({METRIC_NAME: ERROR_COUNT, DIMENSIONS: [
-            {NAME: API, VALUE: self.api},
-            {NAME: S3OL_ACCESS_POINT, VALUE: self.s3ol_access_point_arn},
-            {NAME: SERVICE, VALUE: self.service_name}
-        ], UNIT: COUNT, VALUE: count})
+        self._add_sample(ERROR_COUNT, COUNT, count, StatisticSet)
 
+    def add_cache_hit_count(self, count: int = 1):
+        """Add a segment cache hit count metric."""
+        self._add_sample(SEGMENT_CACHE_HIT_COUNT, COUNT, count, StatisticSet)
 
-class CloudWatchClient:
-    """Wrapper over cloudwatch client."""
+    def add_cache_miss_count(self, count: int = 1):
+        """Add a segment cache miss count metric."""
+        self._add_sample(SEGMENT_CACHE_MISS_COUNT, COUNT, count, StatisticSet)
 
-    MAX_METRIC_DATA = 15
+    def add_concurrency_limit(self, limit: int):
+        """Add a metric of the number of calls allowed in flight."""
+        self._add_sample(CONCURRENCY_LIMIT, COUNT, limit, Histogram)
 
-    def __init__(self):
-        self.cloudwatch = boto3.client('cloudwatch')
+    def add_pre_screen_candidate_count(self, count: int = 1):
+        """Add a metric of the segments in which the local pre-screen found candidate pii."""
+        self._add_sample(PRE_SCREEN_CANDIDATE_COUNT, COUNT, count, StatisticSet)
 
-    def segment_metric_data(self, metric_list: List):
-        """Segments a list of arbitrary length into a list of lists each of size MAX_METRIC_DATA."""
-        list_len = len(metric_list)
-        if list_len <= self.MAX_METRIC_DATA:
-            return [metric_list]
-        remaining_list_len = list_len % self.MAX_METRIC_DATA
-        chunks = [metric_list[x:x + self.MAX_METRIC_DATA] for x in range(0, list_len - remaining_list_len, self.MAX_METRIC_DATA)]
-        chunks.append(metric_list[-remaining_list_len:])
-        return chunks
+    def add_pre_screen_clean_count(self, count: int = 1):
+        """Add a metric of the segments in which the local pre-screen found no candidate pii."""
+        self._add_sample(PRE_SCREEN_CLEAN_COUNT, COUNT, count, StatisticSet)
+
+    def add_pre_screen_miss_count(self, count: int = 1):
+        """Add a metric of the segments found clean by the local pre-screen in which comprehend found pii of interest."""
+        self._add_sample(PRE_SCREEN_MISS_COUNT, COUNT, count, StatisticSet)
+
+    def _add_sample(self, metric_name: str, unit: str, value: float, aggregate_type: Type[Union[StatisticSet, Histogram]]):
+        with self._lock:
+            key = (metric_name, unit)
+            if key not in self._aggregates:
+                self._aggregates[key] = aggregate_type()
+            self._aggregates[key].add(value)
+
+
+class MetricsPublisher:
+    """Base of the publishers of the metrics of the function, taking metric data in the shape PutMetricData accepts."""
 
     def publish_metrics(self, metric_list: List):
         """Publish the metrics to CloudWatch."""
-        for metrics in self.segment_metric_data(metric_list):
-            self.cloudwatch.put_metric_data(MetricData=metrics, Namespace=CLOUD_WATCH_NAMESPACE)
+        raise NotImplementedError()
+
+    def flush(self):
+        """Publish the metrics held back by the publisher, called at the end of every invocation."""
 
     def put_pii_document_processed_metric(self, language: str, s3ol_access_point: str):
         """Put PiiDocumentsProcessed metric."""
@@ -83,3 +167,176 @@ class CloudWatchClient:
             {NAME: S3OL_ACCESS_POINT, VALUE: s3ol_access_point},
             {NAME: LANGUAGE, VALUE: language}
         ], UNIT: COUNT, VALUE: 1.0} for pii_entity_type in pii_entity_types])
+
+
+class CloudWatchClient(MetricsPublisher):
+    """Wrapper over cloudwatch client."""
+
+    MAX_METRIC_DATA = 15
+
+    def __init__(self):
+        self.cloudwatch = boto3.client('cloudwatch')
+
+    def segment_metric_data(self, metric_list: List):
+        """Segments a list of arbitrary length into a list of lists each of size MAX_METRIC_DATA."""
+        list_len = len(metric_list)
+        if list_len <= self.MAX_METRIC_DATA:
+            return [metric_list]
+        remaining_list_len = list_len % self.MAX_METRIC_DATA
+        chunks = [metric_list[x:x + self.MAX_METRIC_DATA] for x in range(0, list_len - remaining_list_len, self.MAX_METRIC_DATA)]
+        chunks.append(metric_list[-remaining_list_len:])
+        return chunks
+
+    def publish_metrics(self, metric_list: List):
+        """Publish the metrics to CloudWatch."""
+        for metrics in self.segment_metric_data(metric_list):
+            self.cloudwatch.put_metric_data(MetricData=metrics, Namespace=CLOUD_WATCH_NAMESPACE)
+
+
+class BackgroundMetricsPublisher(MetricsPublisher):
+    """
+    Publisher handing the metrics off to a background thread, which publishes them through another publisher.
+
+    The handler then returns without waiting for CloudWatch. The thread batches the metrics it receives, and publishes a batch
+    when it reaches MAX_BATCH_SIZE metrics, when its oldest metric has waited for max_lag_in_millis, or when the handler flushes
+    at the end of an invocation. Lambda freezes the execution environment between invocations, so metrics which were not
+    published by then are published when the next invocation thaws it. The queue is bounded: metrics which don't fit in it are
+    dropped, metric publishing being a best effort. `shutdown` publishes the metrics still queued, and is registered to run at
+    exit.
+    """
+
+    MAX_BATCH_SIZE = 1000
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, publisher: MetricsPublisher, max_lag_in_millis: int, max_queue_size: int = 10000):
+        self.publisher = publisher
+        self.max_lag = max_lag_in_millis / 1000
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="MetricsPublisher", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def publish_metrics(self, metric_list: List):
+        """Queue the metrics for the background thread to publish."""
+        for i, metric in enumerate(metric_list):
+            try:
+                self._queue.put_nowait(metric)
+            except queue.Full:
+                LOG.warning(f"Metrics queue is full, dropping {len(metric_list) - i} metrics")
+                return
+
+    def flush(self):
+        """Ask the background thread to publish the metrics it holds without waiting for them to be published."""
+        try:
+            self._queue.put_nowait(self._FLUSH)
+        except queue.Full:
+            # the thread has plenty to publish already
+            pass
+
+    def shutdown(self, timeout: float = 1.0):
+        """Publish the metrics still queued and stop the background thread, waiting for it for at most given seconds."""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            LOG.warning("Metrics queue is full, couldn't stop the metrics publisher")
+            return
+        self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        oldest = 0
+        while True:
+            try:
+                item = self._queue.get(timeout=max(oldest + self.max_lag - time.monotonic(), 0) if batch else None)
+            except queue.Empty:
+                item = self._FLUSH
+            if item is not self._FLUSH and item is not self._STOP:
+                if not batch:
+                    oldest = time.monotonic()
+                batch.append(item)
+                if len(batch) < self.MAX_BATCH_SIZE:
+                    continue
+            if batch:
+                self._publish(batch)
+                batch = []
+            if item is self._STOP:
+                return
+
+    def _publish(self, batch: List):
+        try:
+            self.publisher.publish_metrics(batch)
+            self.publisher.flush()
+        except Exception as e:
+            LOG.warning(f"Error publishing {len(batch)} metrics to cloudwatch: {e}")
+
+
+class EmbeddedMetricFormatClient(MetricsPublisher):
+    """
+    Publisher writing the metrics to the log in the CloudWatch embedded metric format, from which CloudWatch extracts them.
+
+    Publishing then costs the invocation no call to CloudWatch. The metrics of an invocation are held back until flush and are
+    written out aggregated by their dimensions: the values of a metric sharing the same dimensions go in one array, and one log
+    line holds all the metrics sharing the same dimensions. A line can only hold MAX_VALUES_PER_METRIC values of a metric, so
+    metrics with more values are split across lines. Histograms are expanded back into their samples, while statistic sets,
+    which the format has no equivalent of, are written as their sum.
+    Refer https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+
+    MAX_VALUES_PER_METRIC = 100
+
+    def __init__(self, namespace: str = CLOUD_WATCH_NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._metrics: List = []
+
+    def publish_metrics(self, metric_list: List):
+        """Hold the metrics back until the end of the invocation."""
+        with self._lock:
+            self._metrics.extend(metric_list)
+
+    def flush(self):
+        """Write the metrics held back to the log."""
+        with self._lock:
+            metrics, self._metrics = self._metrics, []
+        if not metrics:
+            return
+        stream = self.stream or sys.stdout
+        stream.write(''.join(json.dumps(document, separators=(',', ':')) + '\n'
+                             for document in self.emf_documents(metrics, int(time.time() * 1000))))
+        stream.flush()
+
+    def emf_documents(self, metric_list: List, timestamp: int) -> List[Dict]:
+        """Aggregate the metrics into embedded metric format documents, one per set of dimensions."""
+        values_by_dimensions: Dict[Tuple, Dict[Tuple[str, str], List]] = {}
+        for metric in metric_list:
+            dimensions = tuple((dimension[NAME], dimension[VALUE]) for dimension in metric[DIMENSIONS])
+            values_by_dimensions.setdefault(dimensions, {}).setdefault((metric[METRIC_NAME], metric[UNIT]), []).extend(
+                self._sample_values(metric))
+        documents = []
+        for dimensions, values_by_metric in values_by_dimensions.items():
+            most_values = max(len(values) for values in values_by_metric.values())
+            for start in range(0, most_values, self.MAX_VALUES_PER_METRIC):
+                chunk = {metric: values[start:start + self.MAX_VALUES_PER_METRIC]
+                         for metric, values in values_by_metric.items() if len(values) > start}
+                document = {'_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [[name for name, _ in dimensions]],
+                    'Metrics': [{NAME: name, UNIT: unit} for name, unit in chunk]
+                }]}}
+                document.update(dimensions)
+                document.update((name, values[0] if len(values) == 1 else values) for (name, _), values in chunk.items())
+                documents.append(document)
+        return documents
+
+    @staticmethod
+    def _sample_values(metric: Dict) -> List[float]:
+        if VALUES in metric:
+            return [value for value, count in zip(metric[VALUES], metric[COUNTS]) for _ in range(count)]
+        if STATISTIC_VALUES in metric:
+            # the format has no statistic sets, the sum is what matters for the metrics aggregated as one
+            return [metric[STATISTIC_VALUES][SUM]]
+        return [metric[VALUE]]
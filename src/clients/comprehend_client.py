@@ -1,21 +1,32 @@
 """Client wrapper over aws services."""
 
+import hashlib
 import string
-from concurrent.futures._base import as_completed
+import threading
+from concurrent.futures._base import Future, TimeoutError, as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
-from copy import deepcopy
 from random import choices
-from typing import List
+from types import MappingProxyType
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
 import boto3
 import botocore
 import time
+from botocore.exceptions import ClientError
 
 import lambdalogging
+from cache import LruCache
 from clients.cloudwatch_client import Metrics
-from config import CONTAINS_PII_ENTITIES_THREAD_COUNT, DETECT_PII_ENTITIES_THREAD_COUNT, DEFAULT_LANGUAGE_CODE
-from constants import DEFAULT_USER_AGENT, CONTAINS_PII_ENTITIES, DETECT_PII_ENTITIES, COMPREHEND, COMPREHEND_MAX_RETRIES
-from data_object import Document
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from config import CONTAINS_PII_ENTITIES_THREAD_COUNT, DETECT_PII_ENTITIES_THREAD_COUNT, DEFAULT_LANGUAGE_CODE, SEGMENT_CACHE_MAX_SIZE, \
+    ADAPTIVE_CONCURRENCY
+from constants import DEFAULT_USER_AGENT, CONTAINS_PII_ENTITIES, DETECT_PII_ENTITIES, COMPREHEND, COMPREHEND_MAX_RETRIES, \
+    COMPREHEND_THROTTLING_ERROR_CODES, MIN_TIME_FOR_API_CALL
+from data_object import Document, EntityStore, SegmentResult
+from exceptions import DeadlineExceededException, TaskCancelledException
+from scheduler import SCHEDULER, CancellationToken, TaskGroup
+from segment_planner import LatencyModel
+from util import Deadline
 
 LOG = lambdalogging.getLogger(__name__)
 
@@ -26,8 +37,8 @@ class ComprehendClient:
     def __init__(self, s3ol_access_point: str, pii_classification_thread_count: int = CONTAINS_PII_ENTITIES_THREAD_COUNT,
                  pii_redaction_thread_count: int = DETECT_PII_ENTITIES_THREAD_COUNT,
                  session_id: str = ''.join(choices(string.ascii_uppercase + string.digits, k=10)),
-                 user_agent=DEFAULT_USER_AGENT, endpoint_url=None):
-        self.session_id = session_id
+                 user_agent=DEFAULT_USER_AGENT, endpoint_url=None, segment_cache_max_size: int = SEGMENT_CACHE_MAX_SIZE,
+                 adaptive_concurrency: bool = ADAPTIVE_CONCURRENCY):
         session_config = botocore.config.Config(
             user_agent_extra=user_agent,
             retries={
@@ -39,75 +50,294 @@ class ComprehendClient:
         else:
             self.comprehend = boto3.client('comprehend', config=session_config, endpoint_url=endpoint_url, verify=False)
         self.comprehend.meta.events.register('before-sign.comprehend.*', self._add_session_header)
-        self.classification_executor_service = ThreadPoolExecutor(max_workers=pii_classification_thread_count)
-        self.redaction_executor_service = ThreadPoolExecutor(max_workers=pii_redaction_thread_count)
-        self.classify_metrics = Metrics(service_name=COMPREHEND, api=CONTAINS_PII_ENTITIES, s3ol_access_point=s3ol_access_point)
-        self.detection_metrics = Metrics(service_name=COMPREHEND, api=DETECT_PII_ENTITIES, s3ol_access_point=s3ol_access_point)
+        # botocore sends the first attempt of a call and every retry through before-send, on the thread making the call
+        self.comprehend.meta.events.register('before-send.comprehend.*', self._check_deadline)
+        self._call_context = threading.local()
+        # the pools are shared process wide and outlive the client, every batch of calls submits its work as a task group
+        self.classification_executor_service = SCHEDULER.pool(CONTAINS_PII_ENTITIES, pii_classification_thread_count)
+        self.redaction_executor_service = SCHEDULER.pool(DETECT_PII_ENTITIES, pii_redaction_thread_count)
+        # the thread counts are the upper bounds of the calls in flight, the limiters back off from them when comprehend throttles.
+        # They live as long as the client, so a warm container starts off with the limits learnt by the previous invocations
+        self.classification_limiter = AdaptiveConcurrencyLimiter(pii_classification_thread_count) if adaptive_concurrency else None
+        self.redaction_limiter = AdaptiveConcurrencyLimiter(pii_redaction_thread_count) if adaptive_concurrency else None
+        self.pii_classification_thread_count = pii_classification_thread_count
+        self.pii_redaction_thread_count = pii_redaction_thread_count
+        # latencies of the calls by size of their text, learnt across invocations like the concurrency limits, to plan segment sizes
+        self.classification_latency = LatencyModel()
+        self.detection_latency = LatencyModel()
+        # responses of recent calls keyed by (api, language, hash of the text), sized by their number of labels and entities.
+        # Logs and templated documents repeat the same segments within an object as well as across objects
+        self.segment_cache = LruCache(segment_cache_max_size, size_of=lambda response: len(response) + 1)
+        self.s3ol_access_point = s3ol_access_point
+        self.begin_request(session_id)
+
+    def begin_request(self, session_id: str):
+        """
+        Reset the per-request state so that the client can be reused across invocations.
+
+        Every batch of calls takes the session id and metrics of the request it was made for, so that the calls a timed out
+        request leaves running on the shared pools neither record into the metrics of the next request nor send its session id.
+        """
+        self.session_id = session_id
+        self.classify_metrics = Metrics(service_name=COMPREHEND, api=CONTAINS_PII_ENTITIES, s3ol_access_point=self.s3ol_access_point)
+        self.detection_metrics = Metrics(service_name=COMPREHEND, api=DETECT_PII_ENTITIES, s3ol_access_point=self.s3ol_access_point)
+
+    @property
+    def classification_concurrency(self) -> int:
+        """Return the number of classification calls currently allowed in flight."""
+        return self.pii_classification_thread_count if self.classification_limiter is None else self.classification_limiter.limit
+
+    @property
+    def detection_concurrency(self) -> int:
+        """Return the number of entity detection calls currently allowed in flight."""
+        return self.pii_redaction_thread_count if self.redaction_limiter is None else self.redaction_limiter.limit
 
     def _add_session_header(self, request, **kwargs):
-        request.headers.add_header('x-amzn-session-id', self.session_id)
+        # the session of the request the call was made for, which might not be the one the client is serving any more
+        request.headers.add_header('x-amzn-session-id', getattr(self._call_context, 'session_id', None) or self.session_id)
+
+    def _check_deadline(self, request, **kwargs):
+        # attempts, retries included, which can't complete before the deadline of the call's request aren't sent
+        deadline = getattr(self._call_context, 'deadline', None)
+        if deadline is not None:
+            deadline.check(COMPREHEND, MIN_TIME_FOR_API_CALL)
 
-    def contains_pii_entities(self, documents: List[Document], language=DEFAULT_LANGUAGE_CODE) -> List[Document]:
+    def contains_pii_entities(self, documents: List[Document], language=DEFAULT_LANGUAGE_CODE,
+                              cancellation_token: CancellationToken = None, deadline: Deadline = None) -> List[SegmentResult]:
         """Call comprehend to get pii classification of given documents."""
-        documents_copy = deepcopy(documents)
-        result = []
-        with self.classification_executor_service:
-            futures = []
-            for doc in documents_copy:
-                futures.append(self.classification_executor_service.submit(self._update_doc_with_pii_classification, doc, language))
-
-            for future_result in as_completed(futures):
+        return list(self.contains_pii_entities_as_completed(documents, language, cancellation_token=cancellation_token,
+                                                            deadline=deadline))
+
+    def contains_pii_entities_as_completed(self, documents: Iterable[Document], language=DEFAULT_LANGUAGE_CODE,
+                                           stop_when: Callable[[SegmentResult], bool] = None,
+                                           cancellation_token: CancellationToken = None,
+                                           deadline: Deadline = None) -> Iterator[SegmentResult]:
+        """
+        Call comprehend to get pii classification of given documents.
+
+        The classification of every document is yielded as soon as its call completes, in no particular order, as a result which
+        refers to the document without copying or modifying it. Iteration stops right after a result for which `stop_when`
+        returns True. Calls which haven't started yet are cancelled when the iteration stops early, and the ones already in flight
+        are abandoned. Cancelling the token cancels the calls which haven't started and raises TaskCancelledException. Calls
+        which can't complete before the deadline aren't started, and waiting for the results past it raises
+        DeadlineExceededException.
+        """
+        pending_calls = _PendingCalls(self.classification_executor_service, self.session_id, self.classify_metrics, cancellation_token,
+                                      deadline)
+        try:
+            for doc in documents:
+                pending_calls.add(doc, self._submit_memoized(self._contains_pii_entities, CONTAINS_PII_ENTITIES, doc.text, language,
+                                                             pending_calls))
+            for future_result in pending_calls.as_completed():
+                pending_calls.raise_if_cancelled()
                 try:
-                    result.append(future_result.result())
+                    labels = future_result.result()
                 except Exception as error:
                     LOG.error("Error occurred while calling comprehend for classifying text as pii", exc_info=True)
-                    self.classify_metrics.add_fault_count()
+                    pending_calls.abandon()
+                    pending_calls.metrics.add_fault_count()
                     raise error
-        return result
+                pii_classification = MappingProxyType({label['Name']: label['Score'] for label in labels})
+                for doc in pending_calls.documents[future_result]:
+                    classification_result = SegmentResult(doc, pii_classification)
+                    yield classification_result
+                    if stop_when is not None and stop_when(classification_result):
+                        LOG.debug("Stopping pii classification early, skipping the remaining documents")
+                        return
+        finally:
+            pending_calls.tasks.cancel()
+            pending_calls.publish_cache_metrics()
+            if self.classification_limiter is not None:
+                pending_calls.metrics.add_concurrency_limit(self.classification_limiter.limit)
 
-    def _update_doc_with_pii_classification(self, document: Document, language) -> Document:
+    def _contains_pii_entities(self, text: str, language) -> List[dict]:
+        metrics = self._call_context.metrics
         start_time = time.time()
         response = None
         try:
-            response = self.comprehend.contains_pii_entities(Text=document.text, LanguageCode=language)
+            response = self._call_api(self.classification_limiter, self.comprehend.contains_pii_entities, text, language)
         finally:
+            end_time = time.time()
             if response is not None:
-                self.classify_metrics.add_fault_count(response['ResponseMetadata']['RetryAttempts'])
-            self.classify_metrics.add_latency(start_time, time.time())
-        # updating the document itself instead of creating a new copy to save space
-        document.pii_classification = {label['Name']: label['Score'] for label in response['Labels']}
-        return document
-
-    def detect_pii_documents(self, documents: List[Document], language=DEFAULT_LANGUAGE_CODE) -> List[Document]:
-        """Call comprehend to get pii entities present in given documents."""
-        documents_copy = deepcopy(documents)
-        result = []
-        with self.redaction_executor_service:
-            futures = []
-            for doc in documents_copy:
-                futures.append(self.redaction_executor_service.submit(self._update_doc_with_pii_entities, doc, language))
-
-            for future_result in as_completed(futures):
+                metrics.add_fault_count(response['ResponseMetadata']['RetryAttempts'])
+                self._observe_latency(self.classification_latency, text, response, start_time, end_time)
+            metrics.add_latency(start_time, end_time)
+        return response['Labels']
+
+    def detect_pii_documents(self, documents: Iterable[Document], language=DEFAULT_LANGUAGE_CODE,
+                             cancellation_token: CancellationToken = None, deadline: Deadline = None) -> List[SegmentResult]:
+        """Call comprehend to get pii entities present in given documents, as results which refer to the documents."""
+        return list(self.detect_pii_documents_as_completed(documents, language, cancellation_token=cancellation_token,
+                                                           deadline=deadline))
+
+    def detect_pii_documents_as_completed(self, documents: Iterable[Document], language=DEFAULT_LANGUAGE_CODE,
+                                          cancellation_token: CancellationToken = None,
+                                          deadline: Deadline = None) -> Iterator[SegmentResult]:
+        """
+        Call comprehend to get pii entities present in given documents, yielding the results as soon as their calls complete.
+
+        A call is submitted as soon as its document is produced by the iterable, so a generator of documents lets the detection calls
+        overlap with whatever work produces them. Every document is submitted before the first result is yielded. Cancelling the
+        token cancels the calls which haven't started and raises TaskCancelledException. Calls which can't complete before the
+        deadline aren't started, and waiting for the results past it raises DeadlineExceededException.
+        """
+        pending_calls = _PendingCalls(self.redaction_executor_service, self.session_id, self.detection_metrics, cancellation_token,
+                                      deadline)
+        try:
+            try:
+                for doc in documents:
+                    pending_calls.add(doc, self._submit_memoized(self._detect_pii_entities, DETECT_PII_ENTITIES, doc.text, language,
+                                                                 pending_calls))
+            except Exception:
+                # the remaining documents can't be produced, so the calls already submitted are of no use either
+                pending_calls.abandon()
+                raise
+
+            for future_result in pending_calls.as_completed():
+                pending_calls.raise_if_cancelled()
                 try:
-                    result.append(future_result.result())
+                    entities = future_result.result()
                 except Exception as error:
                     LOG.error("Error occurred while calling comprehend for detecting pii entities", exc_info=True)
-                    self.detection_metrics.add_fault_count()
+                    pending_calls.abandon()
+                    pending_calls.metrics.add_fault_count()
                     raise error
-            return result
+                for doc in pending_calls.documents[future_result]:
+                    yield self._detection_result(doc, entities)
+        finally:
+            pending_calls.tasks.cancel()
+            pending_calls.publish_cache_metrics()
+            if self.redaction_limiter is not None:
+                pending_calls.metrics.add_concurrency_limit(self.redaction_limiter.limit)
 
-    def _update_doc_with_pii_entities(self, document: Document, language) -> Document:
+    def _detect_pii_entities(self, text: str, language) -> EntityStore:
+        metrics = self._call_context.metrics
         start_time = time.time()
         response = None
         try:
-            response = self.comprehend.detect_pii_entities(Text=document.text, LanguageCode=language)
+            response = self._call_api(self.redaction_limiter, self.comprehend.detect_pii_entities, text, language)
         finally:
+            end_time = time.time()
             if response is not None:
-                self.detection_metrics.add_fault_count(response['ResponseMetadata']['RetryAttempts'])
-            self.detection_metrics.add_latency(start_time, time.time())
-        # updating the document itself instead of creating a new copy to save space
-        document.pii_entities = response['Entities']
-        document.pii_classification = {entity['Type']: max(entity['Score'], document.pii_classification[entity['Type']])
-                                       if entity['Type'] in document.pii_classification else entity['Score']
-                                       for entity in response['Entities']}
-        return document
+                metrics.add_fault_count(response['ResponseMetadata']['RetryAttempts'])
+                self._observe_latency(self.detection_latency, text, response, start_time, end_time)
+            metrics.add_latency(start_time, end_time)
+        return EntityStore.from_entities(response['Entities'])
+
+    @staticmethod
+    def _observe_latency(latency: LatencyModel, text: str, response: dict, start_time: float, end_time: float):
+        # the latency of a retried call is mostly backoff, which doesn't depend on the size of its text
+        if response['ResponseMetadata']['RetryAttempts'] == 0:
+            latency.observe(len(text), (end_time - start_time) * 1000)
+
+    def _detection_result(self, document: Document, entities: EntityStore) -> SegmentResult:
+        # entity stores are never modified, so the cached one is shared by every segment with the same text
+        pii_classification = {}
+        for i, score in enumerate(entities.scores):
+            entity_type = entities.entity_type(i)
+            previous_score = pii_classification.get(entity_type, document.pii_classification.get(entity_type, score))
+            pii_classification[entity_type] = max(score, previous_score)
+        return SegmentResult(document, MappingProxyType(pii_classification), entities)
+
+    def _call_api(self, limiter: AdaptiveConcurrencyLimiter, api: Callable[..., dict], text: str, language) -> dict:
+        if limiter is None:
+            return api(Text=text, LanguageCode=language)
+        return limiter.run(lambda: api(Text=text, LanguageCode=language), _is_throttled, getattr(self._call_context, 'deadline', None),
+                           getattr(self._call_context, 'is_cancelled', None))
+
+    def _submit_memoized(self, api_call: Callable[[str, str], List[dict]], api: str, text: str, language,
+                         pending_calls: '_PendingCalls') -> Future:
+        """
+        Return a future holding the response of given comprehend api for given text.
+
+        The api is only called if its response for the same text is neither in the segment cache nor already requested by another
+        document of the same batch.
+        """
+        key = (api, language, hashlib.sha256(text.encode('utf-8')).hexdigest())
+        if key in pending_calls.futures:
+            pending_calls.cache_hits += 1
+            return pending_calls.futures[key]
+        cached_response = self.segment_cache.get(key)
+        if cached_response is not None:
+            pending_calls.cache_hits += 1
+            future = Future()
+            future.set_result(cached_response)
+        else:
+            pending_calls.cache_misses += 1
+            if pending_calls.deadline is not None:
+                pending_calls.deadline.check(api, MIN_TIME_FOR_API_CALL)
+            future = pending_calls.tasks.submit(self._call_and_cache, api_call, key, text, language, pending_calls)
+        pending_calls.futures[key] = future
+        return future
+
+    def _call_and_cache(self, api_call: Callable[[str, str], List[dict]], key: Tuple, text: str, language,
+                        pending_calls: '_PendingCalls') -> List[dict]:
+        if pending_calls.tasks.cancelled:
+            # the call was picked up by a worker just as its batch got cancelled
+            raise TaskCancelledException()
+        self._call_context.deadline = pending_calls.deadline
+        # a call waiting for the concurrency limit is dropped if its batch gets cancelled meanwhile
+        self._call_context.is_cancelled = lambda: pending_calls.tasks.cancelled
+        # the call reports to its own request even if it outlives it on the shared pool
+        self._call_context.session_id = pending_calls.session_id
+        self._call_context.metrics = pending_calls.metrics
+        try:
+            response = api_call(text, language)
+        finally:
+            self._call_context.deadline = None
+            self._call_context.is_cancelled = None
+            self._call_context.session_id = None
+            self._call_context.metrics = None
+        self.segment_cache.put(key, response)
+        return response
+
+
+def _is_throttled(response_or_error) -> bool:
+    """Check whether a comprehend call was throttled, either in the end or on one of the attempts that botocore retried."""
+    if isinstance(response_or_error, ClientError):
+        return response_or_error.response.get('Error', {}).get('Code') in COMPREHEND_THROTTLING_ERROR_CODES
+    if isinstance(response_or_error, Exception):
+        return False
+    return response_or_error['ResponseMetadata']['RetryAttempts'] > 0
+
+
+class _PendingCalls:
+    """Calls submitted for one batch of documents, with the documents waiting for each of them and the request they were made for."""
+
+    def __init__(self, executor: ThreadPoolExecutor, session_id: str, metrics: Metrics, cancellation_token: CancellationToken = None,
+                 deadline: Deadline = None):
+        self.tasks = TaskGroup(executor, cancellation_token)
+        self.session_id = session_id
+        self.metrics = metrics
+        self.cancellation_token = cancellation_token
+        self.deadline = deadline
+        self.futures: Dict[Tuple, Future] = {}
+        self.documents: Dict[Future, List[Document]] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def add(self, document: Document, future: Future):
+        self.documents.setdefault(future, []).append(document)
+
+    def as_completed(self) -> Iterator[Future]:
+        timeout = self.deadline.remaining_time_in_millis() / 1000 if self.deadline is not None else None
+        try:
+            yield from as_completed(self.documents, timeout=timeout)
+        except TimeoutError:
+            raise DeadlineExceededException("waiting for comprehend", self.deadline.remaining_time_in_millis())
+
+    def raise_if_cancelled(self):
+        if self.cancellation_token is not None:
+            self.cancellation_token.raise_if_cancelled()
+
+    def abandon(self):
+        # the calls which haven't started are of no use any more. Unless the whole request is being cancelled, the calls in flight
+        # are waited for so that none of them outlives this request on the shared pool
+        self.tasks.cancel()
+        if self.cancellation_token is None or not self.cancellation_token.cancelled:
+            self.tasks.wait()
+
+    def publish_cache_metrics(self):
+        if self.cache_hits or self.cache_misses:
+            self.metrics.add_cache_hit_count(self.cache_hits)
+            self.metrics.add_cache_miss_count(self.cache_misses)
@@ -1,8 +1,9 @@
 """Client wrapper over aws services."""
+import codecs
 import re
 import time
 import urllib
-from typing import Tuple
+from typing import BinaryIO, Iterable, Iterator, Tuple, Union
 
 import boto3
 import botocore
@@ -12,14 +13,74 @@ from urllib3.util.retry import Retry
 
 import lambdalogging
 from clients.cloudwatch_client import Metrics
-from config import DOCUMENT_MAX_SIZE
-from constants import CONTENT_LENGTH, S3_STATUS_CODES, S3_ERROR_CODES, error_code_to_enums, WRITE_GET_OBJECT_RESPONSE, \
-    DOWNLOAD_PRESIGNED_URL, S3_MAX_RETRIES, S3, http_status_code_to_s3_status_code
-from exceptions import UnsupportedFileException, FileSizeLimitExceededException, S3DownloadException
+from config import DOCUMENT_MAX_SIZE, UNSUPPORTED_FILE_HANDLING
+from constants import CONTENT_LENGTH, CONTENT_RANGE, S3_STATUS_CODES, S3_ERROR_CODES, error_code_to_enums, WRITE_GET_OBJECT_RESPONSE, \
+    DOWNLOAD_PRESIGNED_URL, S3_MAX_RETRIES, S3, http_status_code_to_s3_status_code, UNSUPPORTED_FILE_HANDLING_VALID_VALUES, \
+    MIN_TIME_FOR_API_CALL
+from exceptions import UnsupportedFileException, FileSizeLimitExceededException, S3DownloadException, TaskCancelledException
+from partial_object import MAX_UTF8_CONTINUATION_BYTES, ByteRange, content_range, parse_content_range
+from scheduler import CancellationToken
+from spill import MappedText, spill_file
+from util import Deadline
 
 LOG = lambdalogging.getLogger(__name__)
 
 
+class TextStream:
+    """
+    Read-once body of a request, encoding chunks of text to utf-8 as they are read.
+
+    A body of unknown length is sent with chunked transfer encoding by iterating over it, and a body of known length is read in
+    blocks, so both go through the chunks of text without the encoded text ever being held as a whole. Long chunks are encoded a
+    slice at a time. The first error raised by the chunks is kept, since the http client reports it as a failure to send.
+    """
+
+    ENCODING_SIZE = 64 * 1024
+
+    def __init__(self, chunks: Iterable[str]):
+        self.error = None
+        self._encoded = self._encode(chunks)
+        self._buffer = b''
+        self._offset = 0
+
+    def _encode(self, chunks: Iterable[str]) -> Iterator[bytes]:
+        try:
+            for chunk in chunks:
+                for start in range(0, len(chunk), self.ENCODING_SIZE):
+                    yield chunk[start:start + self.ENCODING_SIZE].encode('utf-8')
+        except Exception as error:
+            self.error = error
+            raise
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Yield the encoded text chunk by chunk."""
+        if self._offset < len(self._buffer):
+            buffer, self._buffer, self._offset = self._buffer[self._offset:], b'', 0
+            yield buffer
+        yield from self._encoded
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes of the encoded text, or all of the rest of it if size is negative."""
+        parts = []
+        while size != 0:
+            if self._offset == len(self._buffer):
+                self._buffer, self._offset = next(self._encoded, b''), 0
+                if not self._buffer:
+                    break
+            end = len(self._buffer) if size < 0 else min(self._offset + size, len(self._buffer))
+            parts.append(self._buffer[self._offset:end])
+            size -= 0 if size < 0 else end - self._offset
+            self._offset = end
+        return b''.join(parts)
+
+    def close(self):
+        """Stop producing the text, e.g. when the request failed before all of it was sent."""
+        self._encoded.close()
+
+
 class S3Client:
     """Wrapper over s3 client."""
 
@@ -31,6 +92,7 @@ class S3Client:
     S3_RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
     BACKOFF_FACTOR = 1.5
     MAX_GET_TIMEOUT = 10
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
     # Translation map from response headers of s3's getObject response to S3OL's WriteGetObjectResponse's request headers
     S3GET_TO_WGOR_HEADER_TRANSLATION_MAP = {
         "accept-ranges": ("AcceptRanges", str),
@@ -67,14 +129,21 @@ class S3Client:
     # Adding these headers can causes a mismatch with Sigv4 signature
     BLOCKED_REQUEST_HEADERS = ("Host")
 
-    def __init__(self, s3ol_access_point: str, max_file_supported=DOCUMENT_MAX_SIZE):
+    def __init__(self, s3ol_access_point: str, max_file_supported=DOCUMENT_MAX_SIZE, endpoint_url=None):
         self.max_file_supported = max_file_supported
-        session_config = botocore.config.Config(
+        self.endpoint_url = endpoint_url
+        self.session_config = session_config = botocore.config.Config(
             retries={
                 'max_attempts': S3_MAX_RETRIES,
                 'mode': 'standard'
-            })
-        self.s3 = boto3.client('s3', config=session_config)
+            },
+            # WriteGetObjectResponse prefixes the host with the request route, which a custom endpoint can't resolve
+            inject_host_prefix=endpoint_url is None)
+        if endpoint_url is None:
+            self.s3 = boto3.client('s3', config=session_config)
+        else:
+            self.s3 = boto3.client('s3', config=session_config, endpoint_url=endpoint_url)
+        self._single_attempt_s3 = None
 
         self.session = requests.Session()
         self.session.mount("https://", adapter=HTTPAdapter(max_retries=Retry(
@@ -84,11 +153,20 @@ class S3Client:
             backoff_factor=self.BACKOFF_FACTOR
         )))
 
-        self.download_metrics = Metrics(service_name=S3, api=DOWNLOAD_PRESIGNED_URL, s3ol_access_point=s3ol_access_point)
-        self.write_get_object_metrics = Metrics(service_name=S3, api=WRITE_GET_OBJECT_RESPONSE, s3ol_access_point=s3ol_access_point)
+        self.s3ol_access_point = s3ol_access_point
+        self.begin_request()
+
+    def begin_request(self):
+        """
+        Reset the per-request state so that the client can be reused across invocations.
+
+        Every call records into the metrics of the request it was made for, even if it outlives that request.
+        """
+        self.download_metrics = Metrics(service_name=S3, api=DOWNLOAD_PRESIGNED_URL, s3ol_access_point=self.s3ol_access_point)
+        self.write_get_object_metrics = Metrics(service_name=S3, api=WRITE_GET_OBJECT_RESPONSE,
+                                                s3ol_access_point=self.s3ol_access_point)
 
-    def _contains_error(self, response) -> Tuple[bool, Tuple[str, str, S3_STATUS_CODES]]:
-        text = response.content.decode('utf-8')
+    def _contains_error(self, response, text: str) -> Tuple[bool, Tuple[str, str, S3_STATUS_CODES]]:
         lines = text.split('\n')
         # All 200-299 status codes are succesfull responses . 206 is for partial code .
         if response.status_code >= 300 or (len(lines) > 0 and lines[0] == self.XML_HEADER):
@@ -106,6 +184,94 @@ class S3Client:
                     S3_ERROR_CODES.InternalError.name, "Internal Server Error", http_status_code_to_s3_status_code(response.status_code))
         return False, ('', '', http_status_code_to_s3_status_code(response.status_code))
 
+    def _read_body(self, response, cancellation_token: CancellationToken = None, spill_to: BinaryIO = None,
+                   trim_partial_characters: bool = False) -> Union[str, MappedText]:
+        """
+        Read the body of a streamed response and decode it as utf-8, without reading more than max_file_supported bytes.
+
+        The body is read in chunks into a buffer preallocated from the Content-Length header, and decoded as the chunks arrive.
+        Invalid utf-8 is therefore detected as soon as it is received. Unless the content of unsupported files needs to be passed
+        back to the caller, the rest of the body isn't even downloaded then. The cancellation token is checked between chunks.
+
+        Given a file to spill to, the chunks are written to it instead, only decoded to be validated, and the text is returned as
+        the mapped text of the file.
+
+        With trim_partial_characters, the multibyte characters cut at the edges of a partial response are left out of the text,
+        and its Content-Range and Content-Length headers are rewritten to match. Other partial responses, such as object parts,
+        are decoded as they are, and rejected if they cut a character.
+        """
+        content_length = response.headers.get(CONTENT_LENGTH)
+        if spill_to is not None:
+            buffer = None
+        else:
+            buffer = bytearray(int(content_length)) if content_length is not None else bytearray()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        text_parts = []
+        size = 0
+        decode_error = None
+        # a range of the object can start and end in the middle of multibyte characters, which are left out of the text
+        partial_content = trim_partial_characters and response.status_code == S3_STATUS_CODES.PARTIAL_CONTENT_206.get_http_status_code()
+        leading_bytes = 0
+        for chunk in response.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled()
+            if size + len(chunk) > self.max_file_supported:
+                raise FileSizeLimitExceededException("File too large to process")
+            if spill_to is not None:
+                spill_to.write(chunk)
+            else:
+                # slice assignment writes into the preallocated space, and grows the buffer if the body turns out to be longer
+                buffer[size:size + len(chunk)] = chunk
+            if partial_content and size == leading_bytes:
+                while leading_bytes - size < len(chunk) and leading_bytes < MAX_UTF8_CONTINUATION_BYTES and \
+                        chunk[leading_bytes - size] & 0xC0 == 0x80:
+                    leading_bytes += 1
+                chunk = chunk[leading_bytes - size:]
+                size += leading_bytes - size
+            size += len(chunk)
+            if decode_error is None:
+                try:
+                    text_part = decoder.decode(chunk)
+                    if spill_to is None:
+                        text_parts.append(text_part)
+                except UnicodeDecodeError as error:
+                    if UNSUPPORTED_FILE_HANDLING != UNSUPPORTED_FILE_HANDLING_VALID_VALUES.PASS:
+                        raise UnsupportedFileException(None, response.headers, "Not a valid utf-8 file")
+                    decode_error = error
+                    text_parts = []
+        if spill_to is None:
+            del buffer[size:]
+        trailing_bytes = 0
+        if decode_error is None:
+            if partial_content:
+                trailing_bytes = len(decoder.getstate()[0])
+                decoder.reset()
+            try:
+                text_parts.append(decoder.decode(b'', final=True))
+            except UnicodeDecodeError as error:
+                decode_error = error
+        if decode_error is not None:
+            if spill_to is not None:
+                # passed back as it is, without reading the whole file in memory
+                spill_to.seek(0)
+                raise UnsupportedFileException(spill_to, response.headers, "Not a valid utf-8 file")
+            raise UnsupportedFileException(bytes(buffer), response.headers, "Not a valid utf-8 file")
+        if (leading_bytes or trailing_bytes) and response.headers.get(CONTENT_RANGE):
+            # the headers describe the text returned
+            byte_range, object_size = parse_content_range(response.headers[CONTENT_RANGE])
+            response.headers[CONTENT_RANGE] = content_range(
+                ByteRange(byte_range.first + leading_bytes, byte_range.last - trailing_bytes), object_size)
+            response.headers[CONTENT_LENGTH] = str(size - leading_bytes - trailing_bytes)
+        if spill_to is not None:
+            return MappedText(spill_to)
+        return ''.join(text_parts)
+
+    @staticmethod
+    def _should_spill(response, spill_threshold: int) -> bool:
+        """Return whether the body of the response is a whole object larger than spill_threshold, which is then greater than 0."""
+        return spill_threshold > 0 and response.status_code == S3_STATUS_CODES.OK_200.get_http_status_code() and \
+            int(response.headers.get(CONTENT_LENGTH, 0)) > spill_threshold
+
     def _parse_response_headers(self, headers):
         """
         Convert response headers received from s3 presigned download call to the format similar to arguments of WriteGetObjectResponse API.
@@ -138,59 +304,131 @@ class S3Client:
             filtered_headers[header] = headers[header]
         return filtered_headers
 
-    def download_file_from_presigned_url(self, presigned_url, headers=None) -> Tuple[str, map, S3_STATUS_CODES]:
+    def download_file_from_presigned_url(self, presigned_url, headers=None, cancellation_token: CancellationToken = None,
+                                         deadline: Deadline = None,
+                                         spill_threshold: int = 0,
+                                         trim_partial_characters: bool = False) -> Tuple[Union[str, MappedText], map, S3_STATUS_CODES]:
         """
         Download the file from a s3's presigned url.
         Python AWS-SDK doesn't provide any method to download from a presigned url directly so we'd have to make a simple GET httpcall.
+        Cancelling the token aborts the download, closing the connection, and raises TaskCancelledException. The timeout of the
+        GET is capped by the deadline, and attempts which can't complete before it aren't started.
+        A whole object of more than spill_threshold bytes, when it is greater than 0, is spilled to a temporary file instead of
+        being held in memory, and returned as a MappedText which the caller closes. With trim_partial_characters, the multibyte
+        characters cut at the edges of a partial response are left out, which only the ranges widened for context can afford.
         """
+        download_metrics = self.download_metrics
         parsed_headers = self._filter_request_headers(presigned_url, headers)
         for i in range(self.S3_DOWNLOAD_MAX_RETRIES):
             start_time = time.time()
             LOG.debug(f"Downloading object with presigned url {presigned_url} and headers: {parsed_headers}")
-            response = self.session.get(presigned_url, timeout=self.MAX_GET_TIMEOUT, headers=parsed_headers)
-            end_time = time.time()
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled()
+            timeout = self.MAX_GET_TIMEOUT
+            if deadline is not None:
+                deadline.check(DOWNLOAD_PRESIGNED_URL, MIN_TIME_FOR_API_CALL)
+                timeout = deadline.timeout(self.MAX_GET_TIMEOUT)
+            response = self.session.get(presigned_url, timeout=timeout, headers=parsed_headers, stream=True)
+            if cancellation_token is not None:
+                # closing the response from the cancelling thread interrupts a read blocked on the connection
+                cancellation_token.add_callback(response.close)
             try:
-                # Since presigned urls do not return correct status codes when there is an error,
-                # the xml must be parsed to find the error code and status
-                error_detected, (error_code, error_message, response_status_code) = self._contains_error(response)
-                if error_detected:
-                    status_code_enum, error_code_enum = error_code_to_enums(error_code)
-                    LOG.error(f"Error downloading file from presigned url. ({error_code}: {error_message})")
-                    status_code = int(status_code_enum.name[-3:])
-                    if status_code not in self.S3_RETRY_STATUS_CODES or i == self.S3_DOWNLOAD_MAX_RETRIES - 1:
-                        LOG.error("Client error or max retries reached for downloading file from presigned url.")
-                        self.download_metrics.add_fault_count()
-                        raise S3DownloadException(error_code, error_message)
+                if response.status_code < 300 and CONTENT_LENGTH in response.headers and \
+                        int(response.headers.get(CONTENT_LENGTH)) > self.max_file_supported:
+                    # rejected before downloading the body
+                    raise FileSizeLimitExceededException("File too large to process")
+                if response.status_code >= 300:
+                    # error responses carry a short xml document, which might not even be valid utf-8
+                    text_content = response.content.decode('utf-8', errors='replace')
                 else:
-                    text_content = response.content.decode('utf-8')
-                    if CONTENT_LENGTH in response.headers and int(response.headers.get(CONTENT_LENGTH)) > self.max_file_supported:
-                        raise FileSizeLimitExceededException("File too large to process")
-                    self.download_metrics.add_latency(start_time, end_time)
-                    return text_content, response.headers, response_status_code,
-                time.sleep(max(1.0, i ** self.BACKOFF_FACTOR))
-            except UnicodeDecodeError:
-                raise UnsupportedFileException(response.content, response.headers, "Not a valid utf-8 file")
-
-    def respond_back_with_data(self, data, headers: map, request_route: str, request_token: str,
-                               status_code: S3_STATUS_CODES = S3_STATUS_CODES.OK_200):
-        """Call S3's WriteGetObjectResponse API to return the processed object back to the original caller of get_object API."""
+                    spill_to = spill_file() if self._should_spill(response, spill_threshold) else None
+                    try:
+                        text_content = self._read_body(response, cancellation_token, spill_to, trim_partial_characters)
+                    except Exception as error:
+                        if spill_to is not None and not (isinstance(error, UnsupportedFileException) and error.file_content is spill_to):
+                            spill_to.close()
+                        raise
+            except Exception:
+                if cancellation_token is not None:
+                    # reading from a connection closed by the cancellation fails in all sorts of ways
+                    cancellation_token.raise_if_cancelled()
+                raise
+            finally:
+                if cancellation_token is not None:
+                    cancellation_token.remove_callback(response.close)
+                response.close()
+            end_time = time.time()
+            # Since presigned urls do not return correct status codes when there is an error,
+            # the xml must be parsed to find the error code and status
+            # an error document is never large enough to be spilled
+            error_detected, (error_code, error_message, response_status_code) = self._contains_error(
+                response, text_content if isinstance(text_content, str) else '')
+            if error_detected:
+                status_code_enum, error_code_enum = error_code_to_enums(error_code)
+                LOG.error(f"Error downloading file from presigned url. ({error_code}: {error_message})")
+                status_code = int(status_code_enum.name[-3:])
+                if status_code not in self.S3_RETRY_STATUS_CODES or i == self.S3_DOWNLOAD_MAX_RETRIES - 1:
+                    LOG.error("Client error or max retries reached for downloading file from presigned url.")
+                    download_metrics.add_fault_count()
+                    raise S3DownloadException(error_code, error_message)
+            else:
+                download_metrics.add_latency(start_time, end_time)
+                return text_content, response.headers, response_status_code,
+            backoff_time = max(1.0, i ** self.BACKOFF_FACTOR)
+            if deadline is not None:
+                # no point in waiting for an attempt which won't have time to complete
+                deadline.check(DOWNLOAD_PRESIGNED_URL, int(backoff_time * 1000) + MIN_TIME_FOR_API_CALL)
+            if cancellation_token is None:
+                time.sleep(backoff_time)
+            elif cancellation_token.wait(backoff_time):
+                raise TaskCancelledException()
+
+    def _streaming_client(self):
+        """Return a client which doesn't retry requests, since the body of a streamed response can't be sent again."""
+        if self._single_attempt_s3 is None:
+            config = self.session_config.merge(botocore.config.Config(retries={'total_max_attempts': 1, 'mode': 'standard'}))
+            if self.endpoint_url is None:
+                self._single_attempt_s3 = boto3.client('s3', config=config)
+            else:
+                self._single_attempt_s3 = boto3.client('s3', config=config, endpoint_url=self.endpoint_url)
+        return self._single_attempt_s3
+
+    def respond_back_with_data(self, data: Union[bytes, str, BinaryIO, Iterable[str]], headers: map, request_route: str,
+                               request_token: str, status_code: S3_STATUS_CODES = S3_STATUS_CODES.OK_200):
+        """
+        Call S3's WriteGetObjectResponse API to return the processed object back to the original caller of get_object API.
+
+        The data is either the whole body, a file holding it, or an iterable of chunks of text which are encoded and streamed to
+        S3 as they are produced. A streamed body is sent with chunked transfer encoding unless the headers give its length, and
+        isn't retried. An error raised while producing the chunks is raised as it is, after the request has failed.
+        """
+        write_get_object_metrics = self.write_get_object_metrics
         start_time = time.time()
+        streamed = not isinstance(data, (bytes, bytearray, str)) and not hasattr(data, 'read')
+        body = TextStream(data) if streamed else data
         try:
             parsed_headers = self._parse_response_headers(headers)
             LOG.debug(f"Calling s3 WriteGetObjectResponse with RequestRoute:{request_route} , headers: {parsed_headers},"
-                      f" RequestToken: {request_token}")
-            self.s3.write_get_object_response(StatusCode=status_code.get_http_status_code(), Body=data, RequestRoute=request_route,
-                                              RequestToken=request_token, **parsed_headers)
+                      f" RequestToken: {request_token}, streamed: {streamed}")
+            s3 = self._streaming_client() if streamed else self.s3
+            s3.write_get_object_response(StatusCode=status_code.get_http_status_code(), Body=body, RequestRoute=request_route,
+                                         RequestToken=request_token, **parsed_headers)
         except Exception as error:
+            if streamed and body.error is not None:
+                LOG.error("Error occurred while producing the data streamed to s3 write get object response.")
+                raise body.error
             LOG.error("Error occurred while calling s3 write get object response with data.", exc_info=True)
-            self.write_get_object_metrics.add_fault_count()
+            write_get_object_metrics.add_fault_count()
             raise error
         finally:
-            self.write_get_object_metrics.add_latency(start_time, time.time())
+            if streamed:
+                body.close()
+            write_get_object_metrics.add_latency(start_time, time.time())
 
     def respond_back_with_error(self, status_code: S3_STATUS_CODES, error_code: S3_ERROR_CODES, error_message: str,
                                 request_route: str, request_token: str):
         """Call S3's WriteGetObjectResponse API to return an error to the original caller of get_object API."""
+        write_get_object_metrics = self.write_get_object_metrics
         start_time = time.time()
         try:
             self.s3.write_get_object_response(StatusCode=status_code.get_http_status_code(), ErrorCode=error_code.name,
@@ -198,7 +436,7 @@ class S3Client:
                                               RequestRoute=request_route, RequestToken=request_token)
         except Exception as error:
             LOG.error("Error occurred while calling s3 write get object response with error.", exc_info=True)
-            self.write_get_object_metrics.add_fault_count()
+            write_get_object_metrics.add_fault_count()
             raise error
         finally:
-            self.write_get_object_metrics.add_latency(start_time, time.time())
+            write_get_object_metrics.add_latency(start_time, time.time())
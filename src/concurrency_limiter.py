@@ -0,0 +1,103 @@
+"""Adaptive limit on the number of concurrent calls to a rate limited service."""
+import threading
+import time
+from typing import Callable, TypeVar, Union
+
+import lambdalogging
+from exceptions import DeadlineExceededException, TaskCancelledException
+from util import Deadline
+
+LOG = lambdalogging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Additive increase / multiplicative decrease (AIMD) limit on the number of calls in flight.
+
+    Every successful call which wasn't retried raises the limit by 1/limit, i.e. by about one call per round of calls, up to
+    max_limit. A throttled call cuts the limit by decrease_factor, down to min_limit. Calls that were already in flight when the
+    limit was cut can't have been affected by the cut, so their throttling doesn't cut it again. This makes the number of calls in
+    flight converge towards what the service quota sustains instead of a fixed guess.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, initial_limit: int = None, decrease_factor: float = 0.5):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.decrease_factor = decrease_factor
+        self._limit = float(max_limit if initial_limit is None else max(self.min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._last_decrease_time = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        """Return the number of calls currently allowed in flight."""
+        return max(self.min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        """Return the number of calls currently in flight."""
+        return self._in_flight
+
+    # how often a call waiting for a slot checks whether it has been cancelled, which nothing notifies the limiter of
+    CANCELLATION_CHECK_INTERVAL = 0.05
+
+    def acquire(self, deadline: Deadline = None, is_cancelled: Callable[[], bool] = None) -> float:
+        """
+        Wait until a call is allowed to start and return its start time.
+
+        Waiting past the deadline raises DeadlineExceededException. A call found cancelled while it waits, or once it is allowed
+        to start, gives its slot back and raises TaskCancelledException, so that it isn't made just because a slot came free.
+        """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                if is_cancelled is not None and is_cancelled():
+                    raise TaskCancelledException()
+                timeout = None if is_cancelled is None else self.CANCELLATION_CHECK_INTERVAL
+                if deadline is not None:
+                    remaining_time = deadline.remaining_time_in_millis()
+                    if remaining_time <= 0:
+                        raise DeadlineExceededException("waiting for a call to be allowed", remaining_time)
+                    timeout = remaining_time / 1000 if timeout is None else min(timeout, remaining_time / 1000)
+                self._condition.wait(timeout)
+            if is_cancelled is not None and is_cancelled():
+                # the slot was never taken, the other calls may use it
+                self._condition.notify()
+                raise TaskCancelledException()
+            self._in_flight += 1
+            return time.monotonic()
+
+    def release(self, start_time: float, throttled: bool):
+        """Account for the outcome of a call started at given time."""
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                if start_time > self._last_decrease_time:
+                    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                    self._last_decrease_time = time.monotonic()
+                    LOG.debug(f"Call throttled, decreasing the concurrency limit to {self.limit}")
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def run(self, call: Callable[[], T], is_throttled: Callable[[Union[T, Exception]], bool], deadline: Deadline = None,
+            is_cancelled: Callable[[], bool] = None) -> T:
+        """
+        Make the call once the limit allows it to start and return its result.
+
+        `is_throttled` is given the result of the call, or the exception it raised, to find out whether the call was throttled.
+        The call isn't made if it is cancelled, or the deadline passes, before the limit allows it to start, see acquire.
+        """
+        start_time = self.acquire(deadline, is_cancelled)
+        throttled = False
+        try:
+            result = call()
+            throttled = is_throttled(result)
+            return result
+        except Exception as error:
+            throttled = is_throttled(error)
+            raise
+        finally:
+            self.release(start_time, throttled)
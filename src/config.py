@@ -1,12 +1,14 @@
 """Contain the configurations used in the package."""
 import os
 
-from constants import UNSUPPORTED_FILE_HANDLING_VALID_VALUES, MASK_MODE_VALID_VALUES
+from constants import UNSUPPORTED_FILE_HANDLING_VALID_VALUES, MASK_MODE_VALID_VALUES, METRICS_PUBLISHER_VALID_VALUES, \
+    PII_PRE_SCREEN_POLICY_VALID_VALUES
 
 DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES = int(os.getenv('DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES', 50 * 1000))  # 50 KB
 DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES = int(os.getenv('DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES', 5 * 1000))  # 5KB
 PII_ENTITY_TYPES = str(os.getenv('PII_ENTITY_TYPES', 'ALL'))
 IS_PARTIAL_OBJECT_SUPPORTED = str(os.getenv('IS_PARTIAL_OBJECT_SUPPORTED', 'false')).lower() == 'true'
+PARTIAL_OBJECT_CONTEXT_SIZE = int(os.getenv('PARTIAL_OBJECT_CONTEXT_SIZE', 1024))  # bytes
 MASK_CHARACTER = str(os.getenv('MASK_CHARACTER', '*'))
 MASK_MODE = MASK_MODE_VALID_VALUES[os.getenv('MASK_MODE', MASK_MODE_VALID_VALUES.MASK.name)]
 SUBSEGMENT_OVERLAPPING_TOKENS = int(os.getenv('SUBSEGMENT_OVERLAPPING_TOKENS', 20))
@@ -16,6 +18,14 @@ assert 0.5 <= CONFIDENCE_THRESHOLD <= 1.0, "CONFIDENCE_THRESHOLD is not within a
 MAX_CHARS_OVERLAP = int(os.getenv('MAX_CHARS_OVERLAP', 200))
 DEFAULT_LANGUAGE_CODE = str(os.getenv('DEFAULT_LANGUAGE_CODE', 'en'))
 REDACTION_API_ONLY = os.getenv('REDACTION_API_ONLY', 'false').lower() == 'true'
+STREAMING_RESPONSE_THRESHOLD = int(os.getenv('STREAMING_RESPONSE_THRESHOLD', 0))  # characters, 0 never streams
+SPILL_THRESHOLD = int(os.getenv('SPILL_THRESHOLD', 0))  # bytes, 0 never spills
+SPILL_DIRECTORY = os.getenv('SPILL_DIRECTORY', '/tmp')
+SPILL_WINDOW_SIZE = int(os.getenv('SPILL_WINDOW_SIZE', 1024 * 1024))  # characters
+PII_PRE_SCREEN_POLICY = PII_PRE_SCREEN_POLICY_VALID_VALUES[
+    os.getenv('PII_PRE_SCREEN_POLICY', PII_PRE_SCREEN_POLICY_VALID_VALUES.OFF.name)]
+SEGMENT_SIZE_PLANNING = os.getenv('SEGMENT_SIZE_PLANNING', 'false').lower() == 'true'
+SEGMENT_PLAN_MAX_EXTRA_UNITS = float(os.getenv('SEGMENT_PLAN_MAX_EXTRA_UNITS', 0.1))  # fraction of the fewest units billable
 
 UNSUPPORTED_FILE_HANDLING = UNSUPPORTED_FILE_HANDLING_VALID_VALUES[
     os.getenv('UNSUPPORTED_FILE_HANDLING', UNSUPPORTED_FILE_HANDLING_VALID_VALUES.FAIL.name)]
@@ -23,6 +33,15 @@ UNSUPPORTED_FILE_HANDLING = UNSUPPORTED_FILE_HANDLING_VALID_VALUES[
 DETECT_PII_ENTITIES_THREAD_COUNT = int(os.getenv('DETECT_PII_ENTITIES_THREAD_COUNT', 8))
 CONTAINS_PII_ENTITIES_THREAD_COUNT = int(os.getenv('CONTAINS_PII_ENTITIES_THREAD_COUNT', 20))
 PUBLISH_CLOUD_WATCH_METRICS = os.getenv('PUBLISH_CLOUD_WATCH_METRICS', 'true').lower() == 'true'
+METRICS_PUBLISHER = METRICS_PUBLISHER_VALID_VALUES[
+    os.getenv('METRICS_PUBLISHER', METRICS_PUBLISHER_VALID_VALUES.PUT_METRIC_DATA.name)]
+METRICS_MAX_LAG = int(os.getenv('METRICS_MAX_LAG', 0))  # milliseconds, 0 publishes synchronously
+ADAPTIVE_CONCURRENCY = os.getenv('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+ACCESS_CONTROL_SHORT_CIRCUIT = os.getenv('ACCESS_CONTROL_SHORT_CIRCUIT', 'true').lower() == 'true'
+RESULT_CACHE_MAX_SIZE = int(os.getenv('RESULT_CACHE_MAX_SIZE', 16 * 1024 * 1024))  # 16M characters
+RESULT_CACHE_DIRECTORY = os.getenv('RESULT_CACHE_DIRECTORY', '')
+SEGMENT_CACHE_MAX_SIZE = int(os.getenv('SEGMENT_CACHE_MAX_SIZE', 50000))  # labels and entities
 COMPREHEND_ENDPOINT_URL = None if os.getenv('COMPREHEND_ENDPOINT_URL', '') == '' else os.getenv('COMPREHEND_ENDPOINT_URL')
+S3_ENDPOINT_URL = None if os.getenv('S3_ENDPOINT_URL', '') == '' else os.getenv('S3_ENDPOINT_URL')
 
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
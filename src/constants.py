@@ -23,20 +23,42 @@ INPUT_S3_URL = "inputS3Url"
 S3OL_CONFIGURATION = "configuration"
 S3OL_ACCESS_POINT_ARN = "accessPointArn"
 CONTENT_LENGTH = "Content-Length"
+CONTENT_RANGE = "Content-Range"
+ETAG = "ETag"
+VERSION_ID = "x-amz-version-id"
 OVERLAP_TOKENS = "overlap_tokens"
 PAYLOAD = "payload"
 ONE_DOC_PER_LINE = "ONE_DOC_PER_LINE"
 ONE_DOC_PER_FILE = "ONE_DOC_PER_FILE"
 LANGUAGE_CODE = "language_code"
+REDACTED_TEXT = "redacted_text"
+PII_CLASSIFICATION = "pii_classification"
+INTERESTED_PII_ENTITY_TYPES = "interested_pii_entity_types"
 
 DEFAULT_USER_AGENT = "S3ObjectLambda/1.0"
 
 RESERVED_TIME_FOR_CLEANUP = 2000   # We need at least this much time (in millis) to perform cleanup tasks like flushing the metrics
 COMPREHEND_MAX_RETRIES = 7
+MIN_TIME_FOR_API_CALL = 200  # Calls to other services aren't started with less time (in millis) than this left before the deadline
+SPILL_WINDOW_CONTEXT_SIZE = 1000  # characters of context read on each side of a window of an object spilled to disk
+COMPREHEND_BILLING_UNIT_SIZE = 100  # characters, comprehend bills every call by units of that many characters
+COMPREHEND_MIN_BILLED_UNITS = 3  # units billed for a call however short its text
+COMPREHEND_BASE_LATENCY_PRIOR = 150  # millis, expected fixed cost of a comprehend call until calls have been observed
+COMPREHEND_LATENCY_PER_CHAR_PRIOR = 0.005  # millis, expected cost per character of a comprehend call
+MIN_PLANNED_SEGMENT_SIZE = 1000  # characters, segments smaller than that are mostly overlap and billing minimums
+REQUEST_POOL = "Request"
+REQUEST_POOL_THREAD_COUNT = 4  # a request which timed out may still hold a thread, the next ones mustn't queue behind it
+COMPREHEND_THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException')
 S3_MAX_RETRIES = 10
 CLOUD_WATCH_NAMESPACE = "ComprehendS3ObjectLambda"
 LATENCY = "Latency"
 ERROR_COUNT = "ErrorCount"
+SEGMENT_CACHE_HIT_COUNT = "SegmentCacheHitCount"
+SEGMENT_CACHE_MISS_COUNT = "SegmentCacheMissCount"
+CONCURRENCY_LIMIT = "ConcurrencyLimit"
+PRE_SCREEN_CANDIDATE_COUNT = "PreScreenCandidateCount"
+PRE_SCREEN_CLEAN_COUNT = "PreScreenCleanCount"
+PRE_SCREEN_MISS_COUNT = "PreScreenMissCount"
 API = "API"
 CONTAINS_PII_ENTITIES = "ContainsPiiEntities"
 DETECT_PII_ENTITIES = "DetectPiiEntities"
@@ -53,6 +75,13 @@ LANGUAGE = "Language"
 MILLISECONDS = "Milliseconds"
 COUNT = "Count"
 VALUE = "Value"
+VALUES = "Values"
+COUNTS = "Counts"
+STATISTIC_VALUES = "StatisticValues"
+SAMPLE_COUNT = "SampleCount"
+SUM = "Sum"
+MINIMUM = "Minimum"
+MAXIMUM = "Maximum"
 S3OL_ACCESS_POINT = "S3ObjectLambdaAccessPoint"
 METRIC_NAME = "MetricName"
 UNIT = "Unit"
@@ -73,6 +102,21 @@ class MASK_MODE_VALID_VALUES(Enum):
     REPLACE_WITH_PII_ENTITY_TYPE = auto()
 
 
+class PII_PRE_SCREEN_POLICY_VALID_VALUES(Enum):
+    """Valid values for PII_PRE_SCREEN_POLICY variable."""
+
+    OFF = auto()
+    SKIP = auto()
+    DEPRIORITIZE = auto()
+
+
+class METRICS_PUBLISHER_VALID_VALUES(Enum):
+    """Valid values for METRICS_PUBLISHER variable."""
+
+    PUT_METRIC_DATA = auto()
+    EMBEDDED_METRIC_FORMAT = auto()
+
+
 class S3_STATUS_CODES(Enum):
     """
     Valid http status codes for S3.
@@ -1,10 +1,20 @@
 """Module containing some custom data structures ."""
 
 import os
-from typing import List
+import threading
+from array import array
+from itertools import chain, compress, islice, repeat
+from operator import add, itemgetter, ne, sub
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Union
 
+from constants import BEGIN_OFFSET, END_OFFSET, ENTITY_TYPE, SCORE
 from exceptions import InvalidConfigurationException
 
+# pii entity types are interned, so that entities only hold a small id for their type
+_ENTITY_TYPE_NAMES: List[str] = []
+_ENTITY_TYPE_IDS: Dict[str, int] = {}
+_ENTITY_TYPES_LOCK = threading.Lock()
+
 
 class PiiConfig:
     """PiiConfig class represents the base config for classification and redaction."""
@@ -41,13 +51,169 @@ class RedactionConfig(ClassificationConfig):
         self.mask_mode = mask_mode
 
 
+def entity_type_id(entity_type: str) -> int:
+    """Return the id of given pii entity type, assigning it one the first time it is seen."""
+    type_id = _ENTITY_TYPE_IDS.get(entity_type)
+    if type_id is None:
+        with _ENTITY_TYPES_LOCK:
+            type_id = _ENTITY_TYPE_IDS.get(entity_type)
+            if type_id is None:
+                type_id = len(_ENTITY_TYPE_NAMES)
+                _ENTITY_TYPE_NAMES.append(entity_type)
+                _ENTITY_TYPE_IDS[entity_type] = type_id
+    return type_id
+
+
+class EntityStore:
+    """
+    Compact sequence of pii entities, held in parallel arrays of their type ids, scores and begin and end offsets.
+
+    An entity takes 18 bytes instead of a dict per entity, which matters for documents with tens of thousands of entities.
+    Indexing the store returns the entity as a dict in the shape comprehend returns it, and the store compares equal to a list
+    of such dicts. Stores are never modified once built, so they can be shared between documents without copying.
+    """
+
+    __slots__ = ('type_ids', 'scores', 'begin_offsets', 'end_offsets')
+
+    def __init__(self, type_ids: array = None, scores: array = None, begin_offsets: array = None, end_offsets: array = None):
+        self.type_ids = array('H') if type_ids is None else type_ids
+        self.scores = array('d') if scores is None else scores
+        self.begin_offsets = array('i') if begin_offsets is None else begin_offsets
+        self.end_offsets = array('i') if end_offsets is None else end_offsets
+
+    @classmethod
+    def from_entities(cls, entities: Iterable[dict]) -> 'EntityStore':
+        """Build a store from entities in the shape comprehend returns them."""
+        entities = list(entities)
+        entity_types = list(map(itemgetter(ENTITY_TYPE), entities))
+        for entity_type in set(entity_types):
+            entity_type_id(entity_type)
+        return cls(array('H', map(_ENTITY_TYPE_IDS.__getitem__, entity_types)), array('d', map(itemgetter(SCORE), entities)),
+                   array('i', map(itemgetter(BEGIN_OFFSET), entities)), array('i', map(itemgetter(END_OFFSET), entities)))
+
+    @classmethod
+    def concatenate(cls, stores: Iterable['EntityStore']) -> 'EntityStore':
+        """Build a store holding the entities of given stores one after the other."""
+        concatenated = cls()
+        for store in stores:
+            concatenated.type_ids.extend(store.type_ids)
+            concatenated.scores.extend(store.scores)
+            concatenated.begin_offsets.extend(store.begin_offsets)
+            concatenated.end_offsets.extend(store.end_offsets)
+        return concatenated
+
+    def entity_type(self, index: int) -> str:
+        """Return the type of the entity at given index."""
+        return _ENTITY_TYPE_NAMES[self.type_ids[index]]
+
+    def shifted(self, offset: int) -> 'EntityStore':
+        """Return the entities with their offsets shifted by given offset, sharing the type ids and scores."""
+        if offset == 0:
+            return self
+        return EntityStore(self.type_ids, self.scores, array('i', map(add, self.begin_offsets, repeat(offset))),
+                           array('i', map(add, self.end_offsets, repeat(offset))))
+
+    def clipped(self, begin: int, end: int) -> 'EntityStore':
+        """Return the entities overlapping the span [begin, end) of the text, cut to the span and relative to its beginning."""
+        overlapping = self.take(i for i in range(len(self)) if self.begin_offsets[i] < end and self.end_offsets[i] > begin)
+        return EntityStore(overlapping.type_ids, overlapping.scores,
+                           array('i', (max(offset, begin) - begin for offset in overlapping.begin_offsets)),
+                           array('i', (min(offset, end) - begin for offset in overlapping.end_offsets)))
+
+    def take(self, indexes: Iterable[int]) -> 'EntityStore':
+        """Return the entities at given indexes, in that order."""
+        indexes = indexes if isinstance(indexes, list) else list(indexes)
+        taken = EntityStore()
+        # indexes mostly come in runs of consecutive indexes, which are copied as slices of the arrays
+        run_starts = compress(range(1, len(indexes)), map(ne, map(sub, islice(indexes, 1, None), indexes), repeat(1)))
+        run_start = 0
+        for run_end in chain(run_starts, [len(indexes)]):
+            if run_end == run_start:
+                break
+            first, last = indexes[run_start], indexes[run_end - 1] + 1
+            taken.type_ids.extend(self.type_ids[first:last])
+            taken.scores.extend(self.scores[first:last])
+            taken.begin_offsets.extend(self.begin_offsets[first:last])
+            taken.end_offsets.extend(self.end_offsets[first:last])
+            run_start = run_end
+        return taken
+
+    def __len__(self) -> int:
+        """Return the number of entities."""
+        return len(self.type_ids)
+
+    def __getitem__(self, index: int) -> dict:
+        """Return the entity at given index as a dict in the shape comprehend returns it."""
+        return {ENTITY_TYPE: _ENTITY_TYPE_NAMES[self.type_ids[index]], SCORE: self.scores[index],
+                BEGIN_OFFSET: self.begin_offsets[index], END_OFFSET: self.end_offsets[index]}
+
+    def __iter__(self):
+        """Iterate over the entities as dicts in the shape comprehend returns them."""
+        return map(self.__getitem__, range(len(self)))
+
+    def __eq__(self, other) -> bool:
+        """Compare with another store, or with a list of entities in the shape comprehend returns them."""
+        if isinstance(other, EntityStore):
+            return (self.type_ids == other.type_ids and self.scores == other.scores and
+                    self.begin_offsets == other.begin_offsets and self.end_offsets == other.end_offsets)
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        """Represent the store as the list of its entities."""
+        return f"EntityStore({list(self)})"
+
+
 class Document:
     """A chunk of text."""
 
-    def __init__(self, text: str, char_offset: int = 0, pii_classification: map = {},
-                 pii_entities: List = [], redacted_text: str = ''):
+    __slots__ = ('text', 'char_offset', 'pii_classification', '_pii_entities', 'redacted_text')
+
+    def __init__(self, text: str, char_offset: int = 0, pii_classification: map = None,
+                 pii_entities: Union[EntityStore, List] = None, redacted_text: str = ''):
         self.text = text
         self.char_offset = char_offset
-        self.pii_classification = pii_classification
+        self.pii_classification = {} if pii_classification is None else pii_classification
         self.pii_entities = pii_entities
         self.redacted_text = redacted_text
+
+    @property
+    def pii_entities(self) -> EntityStore:
+        """Return the pii entities found in the text, with offsets relative to the text."""
+        return self._pii_entities
+
+    @pii_entities.setter
+    def pii_entities(self, pii_entities: Union[EntityStore, Iterable[dict], None]):
+        if isinstance(pii_entities, EntityStore):
+            self._pii_entities = pii_entities
+        else:
+            self._pii_entities = EntityStore.from_entities(pii_entities or [])
+
+
+_NO_ENTITIES = EntityStore()
+
+
+class SegmentResult(NamedTuple):
+    """
+    Immutable result of calling comprehend for one segment of a document.
+
+    The result refers to its segment instead of copying it, and reads like a document with the segment's text and char offset,
+    so results can be desegmented like documents.
+    """
+
+    segment: Document
+    pii_classification: Mapping[str, float]
+    pii_entities: EntityStore = _NO_ENTITIES
+
+    @property
+    def text(self) -> str:
+        """Return the text of the segment."""
+        return self.segment.text
+
+    @property
+    def char_offset(self) -> int:
+        """Return the char offset of the segment in its document."""
+        return self.segment.char_offset
@@ -4,7 +4,7 @@ from clients.s3_client import S3Client
 from config import UNSUPPORTED_FILE_HANDLING
 from constants import UNSUPPORTED_FILE_HANDLING_VALID_VALUES, S3_STATUS_CODES, S3_ERROR_CODES, error_code_to_enums
 from exceptions import UnsupportedFileException, FileSizeLimitExceededException, S3DownloadException, InvalidConfigurationException, \
-    InvalidRequestException, RestrictedDocumentException, TimeoutException
+    InvalidRequestException, InvalidRangeException, RestrictedDocumentException, TimeoutException
 
 LOG = lambdalogging.getLogger(__name__)
 
@@ -38,6 +38,10 @@ class ExceptionHandler:
             LOG.info(f"Encountered an invalid request {e}", exc_info=True)
             self.s3_client.respond_back_with_error(S3_STATUS_CODES.BAD_REQUEST_400, S3_ERROR_CODES.InvalidRequest,
                                                    e.message, request_route, request_token)
+        except InvalidRangeException as e:
+            LOG.info(f"Encountered a range not satisfiable {e}", exc_info=True)
+            self.s3_client.respond_back_with_error(S3_STATUS_CODES.RANGE_NOT_SATISFIABLE_416, S3_ERROR_CODES.InvalidRange,
+                                                   e.message, request_route, request_token)
         except S3DownloadException as e:
             LOG.error(f"Error downloading from presigned url. {e}", exc_info=True)
             status_code, error_code = error_code_to_enums(e.s3_error_code)
@@ -29,6 +29,22 @@ class TimeoutException(CustomException):
     pass
 
 
+class DeadlineExceededException(TimeoutException):
+    """Exception raised when some work can't be completed before the deadline of the request, so it isn't even started."""
+
+    def __init__(self, operation: str, remaining_time_in_millis: int, *args):
+        super().__init__(f"Not enough time left for {operation}, {remaining_time_in_millis} ms remaining before the deadline",
+                         *args)
+        self.operation = operation
+        self.remaining_time_in_millis = remaining_time_in_millis
+
+
+class TaskCancelledException(CustomException):
+    """Exception raised by a task whose request has been cancelled, e.g. because it ran out of time."""
+
+    pass
+
+
 class InvalidConfigurationException(CustomException):
     """Exception representing an incorrect configuration of the access point such as incorrect function payload structure."""
 
@@ -45,6 +61,14 @@ class InvalidRequestException(CustomException):
         self.message = message
 
 
+class InvalidRangeException(CustomException):
+    """Exception representing a requested range of bytes which doesn't overlap the requested object."""
+
+    def __init__(self, message, *args, **kwargs):
+        super().__init__(*args)
+        self.message = message
+
+
 class S3DownloadException(CustomException):
     """Exception representing an error occurring during downloading from the presigned url."""
 
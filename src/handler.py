@@ -6,21 +6,32 @@ import traceback
 
 import lambdainit  # noqa: F401
 import json
-from typing import List
+from types import MappingProxyType
+from typing import BinaryIO, Callable, Dict, Iterator, List, Mapping, Optional, Tuple, Union
 import lambdalogging
+from cache import RESULT_CACHE
+from clients.client_registry import CLIENT_REGISTRY
 from clients.comprehend_client import ComprehendClient
 from clients.s3_client import S3Client
-from clients.cloudwatch_client import CloudWatchClient
+from clients.cloudwatch_client import MetricsPublisher
 from config import DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES, DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES, DEFAULT_LANGUAGE_CODE, \
-    PUBLISH_CLOUD_WATCH_METRICS, REDACTION_API_ONLY, COMPREHEND_ENDPOINT_URL
+    PUBLISH_CLOUD_WATCH_METRICS, REDACTION_API_ONLY, COMPREHEND_ENDPOINT_URL, ACCESS_CONTROL_SHORT_CIRCUIT, S3_ENDPOINT_URL, \
+    IS_PARTIAL_OBJECT_SUPPORTED, PARTIAL_OBJECT_CONTEXT_SIZE, STREAMING_RESPONSE_THRESHOLD, SPILL_THRESHOLD, SPILL_WINDOW_SIZE, \
+    PII_PRE_SCREEN_POLICY, SEGMENT_SIZE_PLANNING
 from constants import ALL, REQUEST_ID, GET_OBJECT_CONTEXT, S3OL_ACCESS_POINT_ARN, \
-    INPUT_S3_URL, S3OL_CONFIGURATION, REQUEST_ROUTE, REQUEST_TOKEN, PAYLOAD, DEFAULT_USER_AGENT, LANGUAGE_CODE, USER_REQUEST, \
-    HEADERS, CONTENT_LENGTH, RESERVED_TIME_FOR_CLEANUP
-from data_object import Document, PiiConfig, RedactionConfig, ClassificationConfig
+    INPUT_S3_URL, S3OL_CONFIGURATION, REQUEST_ROUTE, REQUEST_TOKEN, PAYLOAD, LANGUAGE_CODE, USER_REQUEST, \
+    HEADERS, CONTENT_LENGTH, RESERVED_TIME_FOR_CLEANUP, REDACTED_TEXT, PII_CLASSIFICATION, INTERESTED_PII_ENTITY_TYPES, RANGE, \
+    CONTENT_RANGE, S3_STATUS_CODES, SPILL_WINDOW_CONTEXT_SIZE, PII_PRE_SCREEN_POLICY_VALID_VALUES
+from data_object import Document, PiiConfig, RedactionConfig, ClassificationConfig, SegmentResult
 from exception_handlers import ExceptionHandler
 from exceptions import RestrictedDocumentException
-from processors import Segmenter, Redactor
-from util import execute_task_with_timeout
+from interval_index import IntervalIndex
+from partial_object import PartialObject, RangeRequest, content_range
+from processors import IncrementalRedactor, PiiPreScreen, Segmenter, Redactor
+from scheduler import CancellationToken
+from segment_planner import plan_segment_sizes
+from spill import MappedText, spill_file
+from util import Deadline, execute_task_with_timeout
 from validators import InputEventValidator, PartialObjectRequestValidator
 
 LOG = lambdalogging.getLogger(__name__)
@@ -41,23 +52,120 @@ def get_interested_pii(document: Document, classification_config: PiiConfig):
     return pii_entities
 
 
-def publish_metrics(cloud_watch: CloudWatchClient, s3: S3Client, comprehend: ComprehendClient, processed_document: bool,
+def classify_segments(segments: List[Document], comprehend: ComprehendClient, classification_config: PiiConfig, language_code,
+                      stop_when: Callable[[SegmentResult], bool] = None, cancellation_token: CancellationToken = None,
+                      deadline: Deadline = None) -> Iterator[SegmentResult]:
+    """
+    Get the pii classification of given segments like ComprehendClient.contains_pii_entities_as_completed, screening them first.
+
+    Unless PII_PRE_SCREEN_POLICY is OFF, the segments are screened locally for candidate pii of interest. The segments with
+    candidates are sent to comprehend first, and the clean ones are either sent after them or skipped, in which case they are
+    yielded right away with an empty classification. The numbers of segments with and without candidates, and of clean segments
+    comprehend found pii of interest in, are added to the classification metrics so that the recall of the screen can be tuned.
+    """
+    if PII_PRE_SCREEN_POLICY is PII_PRE_SCREEN_POLICY_VALID_VALUES.OFF:
+        yield from comprehend.contains_pii_entities_as_completed(segments, language_code, stop_when=stop_when,
+                                                                 cancellation_token=cancellation_token, deadline=deadline)
+        return
+    pre_screen = PiiPreScreen(classification_config.pii_entity_types, PII_PRE_SCREEN_POLICY)
+    candidates, clean = pre_screen.partition(segments)
+    LOG.debug(f"Pre-screen found candidate pii in {len(candidates)} of {len(segments)} segments")
+    comprehend.classify_metrics.add_pre_screen_candidate_count(len(candidates))
+    comprehend.classify_metrics.add_pre_screen_clean_count(len(clean))
+    if pre_screen.skips_clean_segments:
+        for segment in clean:
+            yield SegmentResult(segment, MappingProxyType({}))
+        clean = []
+    clean_offsets = {segment.char_offset for segment in clean}
+    misses = 0
+    try:
+        for result in comprehend.contains_pii_entities_as_completed(candidates + clean, language_code, stop_when=stop_when,
+                                                                    cancellation_token=cancellation_token, deadline=deadline):
+            if result.char_offset in clean_offsets and get_interested_pii(result, classification_config):
+                misses += 1
+            yield result
+    finally:
+        if clean_offsets:
+            comprehend.classify_metrics.add_pre_screen_miss_count(misses)
+
+
+def _get_clients(s3ol_access_point: str, request_id: str) -> Tuple[S3Client, ComprehendClient, MetricsPublisher]:
+    """Fetch the clients cached for given access point and prepare them for serving a new request."""
+    s3 = CLIENT_REGISTRY.s3_client(s3ol_access_point, endpoint_url=S3_ENDPOINT_URL)
+    s3.begin_request()
+    comprehend = CLIENT_REGISTRY.comprehend_client(s3ol_access_point, endpoint_url=COMPREHEND_ENDPOINT_URL)
+    comprehend.begin_request(session_id=request_id)
+    return s3, comprehend, CLIENT_REGISTRY.cloudwatch_client()
+
+
+def create_segmenters(text: Union[str, MappedText], comprehend: ComprehendClient, deadline: Deadline,
+                      detect_entities: bool = True) -> Tuple[Segmenter, Segmenter]:
+    """
+    Return the segmenters of given text for classification and for entity detection.
+
+    The segments are as large as DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES and DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES allow, unless
+    SEGMENT_SIZE_PLANNING is on, in which case their sizes are planned for the text, a window of it if it was spilled to disk,
+    given the latencies comprehend has shown so far, the number of calls allowed in flight and the time left.
+    """
+    classification_size, detection_size = DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES, DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES
+    if SEGMENT_SIZE_PLANNING and len(text) > 0:
+        if isinstance(text, MappedText):
+            text_length, bytes_per_char = min(len(text), SPILL_WINDOW_SIZE + 2 * SPILL_WINDOW_CONTEXT_SIZE), text.byte_size / len(text)
+        else:
+            text_length, bytes_per_char = len(text), 1.0 if text.isascii() else len(text.encode('utf-8')) / len(text)
+        plan = plan_segment_sizes(text_length, bytes_per_char, comprehend.classification_latency, comprehend.detection_latency,
+                                  comprehend.classification_concurrency, comprehend.detection_concurrency,
+                                  deadline.remaining_time_in_millis(), classify=not (detect_entities and REDACTION_API_ONLY),
+                                  detect_entities=detect_entities)
+        LOG.info(f"Planned segments of {text_length} characters: {plan}, {plan.billed_units} units billed at most, "
+                 f"{plan.min_billed_units} at least, {plan.estimated_time:.0f} ms expected")
+        classification_size, detection_size = plan.classification_size, plan.detection_size
+    return Segmenter(classification_size, deadline=deadline), Segmenter(detection_size, deadline=deadline)
+
+
+def download_object(s3: S3Client, event, cancellation_token: CancellationToken = None,
+                    deadline: Deadline = None) -> Tuple[Union[str, MappedText], Mapping, S3_STATUS_CODES, Optional[PartialObject]]:
+    """
+    Download the requested object, returning its text, the response headers and status code, and the requested range if any.
+
+    A requested range is downloaded along with PARTIAL_OBJECT_CONTEXT_SIZE bytes of context on each side, so that the pii
+    entities at its edges can be detected, less the multibyte characters cut at the edges of the context. Other requests,
+    including the ones for a part number, are passed on as they are, and a part cutting a character is rejected.
+    A whole object larger than SPILL_THRESHOLD bytes is spilled to disk, and its text is a MappedText to close once processed.
+    """
+    headers = event[USER_REQUEST][HEADERS]
+    range_request = RangeRequest.from_headers(headers) if IS_PARTIAL_OBJECT_SUPPORTED else None
+    if range_request is not None:
+        headers = dict(headers, **{RANGE: range_request.widened(PARTIAL_OBJECT_CONTEXT_SIZE)})
+    text, http_headers, status_code = s3.download_file_from_presigned_url(event[GET_OBJECT_CONTEXT][INPUT_S3_URL], headers,
+                                                                          cancellation_token, deadline,
+                                                                          spill_threshold=SPILL_THRESHOLD if range_request is None else 0,
+                                                                          trim_partial_characters=range_request is not None)
+    partial_object = None if range_request is None else PartialObject(text, http_headers, range_request)
+    return text, http_headers, status_code, partial_object
+
+
+def publish_metrics(cloud_watch: MetricsPublisher, s3: S3Client, comprehend: ComprehendClient, processed_document: bool,
                     processed_pii_document: bool, language_code: str, s3ol_access_point: str, pii_entities: List[str]):
     """Publish metrics from the function execution."""
     try:
-        cloud_watch.publish_metrics(s3.download_metrics.metrics + s3.write_get_object_metrics.metrics +
-                                    comprehend.classify_metrics.metrics + comprehend.detection_metrics.metrics)
-        if processed_document:
-            cloud_watch.put_document_processed_metric(language_code, s3ol_access_point)
-            if processed_pii_document:
-                cloud_watch.put_pii_document_processed_metric(language_code, s3ol_access_point)
-                cloud_watch.put_pii_document_types_metric(pii_entities, language_code, s3ol_access_point)
+        try:
+            cloud_watch.publish_metrics(s3.download_metrics.metrics + s3.write_get_object_metrics.metrics +
+                                        comprehend.classify_metrics.metrics + comprehend.detection_metrics.metrics)
+            if processed_document:
+                cloud_watch.put_document_processed_metric(language_code, s3ol_access_point)
+                if processed_pii_document:
+                    cloud_watch.put_pii_document_processed_metric(language_code, s3ol_access_point)
+                    cloud_watch.put_pii_document_types_metric(pii_entities, language_code, s3ol_access_point)
+        finally:
+            cloud_watch.flush()
     except Exception as e:
         LOG.error(f"Error publishing metrics to cloudwatch. :{e} {traceback.print_exc()}")
 
 
 def redact(text, classification_segmenter: Segmenter, detection_segmenter: Segmenter,
-           redactor: Redactor, comprehend: ComprehendClient, redaction_config: RedactionConfig, language_code) -> Document:
+           redactor: Redactor, comprehend: ComprehendClient, redaction_config: RedactionConfig, language_code,
+           cancellation_token: CancellationToken = None, deadline: Deadline = None) -> Document:
     """
     Redact pii data from given text. Logic for redacting:- .
 
@@ -70,23 +178,39 @@ def redact(text, classification_segmenter: Segmenter, detection_segmenter: Segme
              2.3.2 redact the pii entities from the chunk
         2.4 merge all chunks
     3. merge all subsegments
+
+    Steps 2.1 and 2.3.1 are pipelined: the chunks of a subsegment are submitted for entity detection as soon as its own
+    classification comes back, while the classification of the other subsegments is still in progress.
+
+    Cancelling the token stops the redaction between segments and steps, raising TaskCancelledException. Comprehend calls which
+    can't complete before the deadline aren't started, raising DeadlineExceededException.
     """
     if REDACTION_API_ONLY:
         doc = Document(text)
         documents = [doc]
-        docs_for_entity_detection = detection_segmenter.segment(doc.text, doc.char_offset)
+        docs_with_pii_entities = comprehend.detect_pii_documents(detection_segmenter.segment(doc.text, doc.char_offset), language_code,
+                                                                 cancellation_token=cancellation_token, deadline=deadline)
     else:
-        documents = comprehend.contains_pii_entities(classification_segmenter.segment(text), language_code)
-        pii_docs = [doc for doc in documents if len(get_interested_pii(doc, redaction_config)) > 0]
+        documents = []
+        pii_docs = []
+
+        def docs_for_entity_detection():
+            for classified_doc in classify_segments(classification_segmenter.segment(text), comprehend, redaction_config, language_code,
+                                                    cancellation_token=cancellation_token, deadline=deadline):
+                documents.append(classified_doc)
+                if len(get_interested_pii(classified_doc, redaction_config)) > 0:
+                    pii_docs.append(classified_doc)
+                    yield from detection_segmenter.segment(classified_doc.text, classified_doc.char_offset)
+
+        docs_with_pii_entities = comprehend.detect_pii_documents(docs_for_entity_detection(), language_code,
+                                                                 cancellation_token=cancellation_token, deadline=deadline)
         if not pii_docs:
             LOG.debug("Document doesn't have any pii. Nothing to redact.")
             text = classification_segmenter.de_segment(documents).text
             return Document(text, redacted_text=text)
-        docs_for_entity_detection = []
-        for pii_doc in pii_docs:
-            docs_for_entity_detection.extend(detection_segmenter.segment(pii_doc.text, pii_doc.char_offset))
 
-    docs_with_pii_entities = comprehend.detect_pii_documents(docs_for_entity_detection, language_code)
+    if cancellation_token is not None:
+        cancellation_token.raise_if_cancelled()
     resultant_doc = classification_segmenter.de_segment(documents + docs_with_pii_entities)
     assert len(resultant_doc.text) == len(text), "Not able to recover original document after segmentation and desegmentation."
     redacted_text = redactor.redact(text, resultant_doc.pii_entities)
@@ -94,8 +218,99 @@ def redact(text, classification_segmenter: Segmenter, detection_segmenter: Segme
     return resultant_doc
 
 
+def redact_incrementally(text, classification_segmenter: Segmenter, detection_segmenter: Segmenter,
+                         incremental_redactor: IncrementalRedactor, comprehend: ComprehendClient, redaction_config: RedactionConfig,
+                         language_code, cancellation_token: CancellationToken = None, deadline: Deadline = None) -> Iterator[str]:
+    """
+    Redact pii data from given text like redact does, yielding the redacted text piece by piece in document order.
+
+    Once every segment has been submitted for entity detection, the text up to the first segment still in flight is redacted and
+    yielded as soon as the segments over it have come back, so the beginning of the redacted text can be sent back while the
+    rest is still being detected. The pii classification of the text is merged into the incremental redactor.
+    """
+    if REDACTION_API_ONLY:
+        docs_for_entity_detection = detection_segmenter.segment(text)
+    else:
+        def docs_for_entity_detection():
+            for classified_doc in classify_segments(classification_segmenter.segment(text), comprehend, redaction_config, language_code,
+                                                    cancellation_token=cancellation_token, deadline=deadline):
+                incremental_redactor.add_classification(classified_doc)
+                if len(get_interested_pii(classified_doc, redaction_config)) > 0:
+                    yield from detection_segmenter.segment(classified_doc.text, classified_doc.char_offset)
+
+        docs_for_entity_detection = docs_for_entity_detection()
+
+    for doc_with_pii_entities in comprehend.detect_pii_documents_as_completed(
+            map(incremental_redactor.expect, docs_for_entity_detection), language_code, cancellation_token=cancellation_token,
+            deadline=deadline):
+        redacted_text = incremental_redactor.add(doc_with_pii_entities)
+        if redacted_text:
+            yield redacted_text
+    if cancellation_token is not None:
+        cancellation_token.raise_if_cancelled()
+    yield incremental_redactor.finish()
+
+
+def redact_in_windows(text: MappedText, redacted_file: BinaryIO, classification_segmenter: Segmenter, detection_segmenter: Segmenter,
+                      redactor: Redactor, comprehend: ComprehendClient, redaction_config: RedactionConfig, language_code,
+                      window_size: int = SPILL_WINDOW_SIZE, cancellation_token: CancellationToken = None,
+                      deadline: Deadline = None) -> Dict[str, float]:
+    """
+    Redact pii data from a text spilled to disk a window at a time, writing the redacted text to given file.
+
+    Every window is redacted like a text of its own along with SPILL_WINDOW_CONTEXT_SIZE characters of context on each side, so
+    that the pii entities at its edges are detected. A window stops before the groups of overlapping entities which reach into
+    the context after it, and which are redacted with the next window instead. Only a window of the text is held in memory at a
+    time. Return the pii classification of the whole text.
+    """
+    pii_classification = {}
+    position = 0
+    while position < len(text):
+        if cancellation_token is not None:
+            cancellation_token.raise_if_cancelled()
+        context_begin = max(position - SPILL_WINDOW_CONTEXT_SIZE, 0)
+        window_end = min(position + window_size, len(text))
+        window_text = text[context_begin:min(window_end + SPILL_WINDOW_CONTEXT_SIZE, len(text))]
+        document = redact(window_text, classification_segmenter, detection_segmenter, redactor, comprehend, redaction_config,
+                          language_code, cancellation_token, deadline)
+        for name, score in document.pii_classification.items():
+            pii_classification[name] = max(score, pii_classification.get(name, score))
+        begin, end = position - context_begin, window_end - context_begin
+        if window_end < len(text):
+            entities = document.pii_entities
+            for span_begin, span_end in zip(*IntervalIndex(entities.begin_offsets, entities.end_offsets).merged_spans()):
+                # a span reaching back before the window is cut, so that every window moves on
+                if begin < span_begin < end < span_end:
+                    end = span_begin
+                    break
+        redacted_file.write(redactor.redact(window_text[begin:end], document.pii_entities.clipped(begin, end)).encode('utf-8'))
+        position = context_begin + end
+    return pii_classification
+
+
+def classify_in_windows(text: MappedText, classification_segmenter: Segmenter, comprehend: ComprehendClient,
+                        detection_config: ClassificationConfig, language_code, stop_on_first_match: bool = False,
+                        window_size: int = SPILL_WINDOW_SIZE, cancellation_token: CancellationToken = None,
+                        deadline: Deadline = None) -> List[str]:
+    """
+    Detect pii data from a text spilled to disk like classify does, a window at a time.
+
+    Consecutive windows overlap by SPILL_WINDOW_CONTEXT_SIZE characters, so that the pii at their edges is classified with some
+    context. With stop_on_first_match, the windows after the first one found to contain pii of interest aren't classified.
+    """
+    pii_types = set()
+    for window_begin in range(0, len(text), window_size):
+        window_text = text[max(window_begin - SPILL_WINDOW_CONTEXT_SIZE, 0):window_begin + window_size]
+        pii_types |= set(classify(window_text, classification_segmenter, comprehend, detection_config, language_code,
+                                  stop_on_first_match, cancellation_token, deadline))
+        if stop_on_first_match and pii_types:
+            break
+    return list(pii_types)
+
+
 def classify(text, classification_segmenter: Segmenter, comprehend: ComprehendClient,
-             detection_config: ClassificationConfig, language_code) -> List[str]:
+             detection_config: ClassificationConfig, language_code, stop_on_first_match: bool = False,
+             cancellation_token: CancellationToken = None, deadline: Deadline = None) -> List[str]:
     """
     Detect pii data from given text. Logic for detecting:- .
 
@@ -106,8 +321,18 @@ def classify(text, classification_segmenter: Segmenter, comprehend: ComprehendCl
         2.2 if it contains pii that is in the detection config then return those pii, else move to the next segment
     3. If no pii detected, return empty list, else list of pii types found that is also in the detection config
        and above the given threshold
+
+    With stop_on_first_match, the pii types of the first segment found to contain pii of interest are returned right away and
+    the classification of the remaining segments is abandoned. Cancelling the token abandons it too, raising
+    TaskCancelledException. Comprehend calls which can't complete before the deadline aren't started, raising
+    DeadlineExceededException.
     """
-    pii_classified_documents = comprehend.contains_pii_entities(classification_segmenter.segment(text), language_code)
+    def contains_interested_pii(doc: Document) -> bool:
+        return len(get_interested_pii(doc, detection_config)) > 0
+
+    pii_classified_documents = classify_segments(
+        classification_segmenter.segment(text), comprehend, detection_config, language_code,
+        stop_when=contains_interested_pii if stop_on_first_match else None, cancellation_token=cancellation_token, deadline=deadline)
     pii_types = set()
     for doc in pii_classified_documents:
         doc_pii_types = get_interested_pii(doc, detection_config)
@@ -126,41 +351,88 @@ def redact_pii_documents_handler(event, context):
     redaction_config = RedactionConfig(**invoke_args)
     object_get_context = event[GET_OBJECT_CONTEXT]
     s3ol_access_point = event[S3OL_CONFIGURATION][S3OL_ACCESS_POINT_ARN]
-    s3 = S3Client(s3ol_access_point)
-    cloud_watch = CloudWatchClient()
-    comprehend = ComprehendClient(s3ol_access_point=s3ol_access_point, session_id=event[REQUEST_ID], user_agent=DEFAULT_USER_AGENT,
-                                  endpoint_url=COMPREHEND_ENDPOINT_URL)
-
+    s3, comprehend, cloud_watch = _get_clients(s3ol_access_point, event[REQUEST_ID])
     exception_handler = ExceptionHandler(s3)
 
     LOG.debug("Pii Entity Types to be redacted:" + str(redaction_config.pii_entity_types))
     processed_document = False
     document = Document('')
 
+    # cancelled when the time runs out, so that the abandoned task stops instead of competing with the next invocations
+    cancellation_token = CancellationToken()
+    deadline = Deadline(context.get_remaining_time_in_millis() - RESERVED_TIME_FOR_CLEANUP)
     try:
         def time_bound_task():
             nonlocal processed_document
             nonlocal document
             PartialObjectRequestValidator.validate(event)
-            pii_classification_segmenter = Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES)
-            pii_redaction_segmenter = Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES)
             redactor = Redactor(redaction_config)
             time1 = time.time()
-            text, http_headers, status_code = s3.download_file_from_presigned_url(object_get_context[INPUT_S3_URL],
-                                                                                  event[USER_REQUEST][HEADERS])
+            text, http_headers, status_code, partial_object = download_object(s3, event, cancellation_token, deadline)
             time2 = time.time()
             LOG.info(f"Downloaded the file in : {(time2 - time1)} seconds")
-            document = redact(text, pii_classification_segmenter, pii_redaction_segmenter, redactor,
-                              comprehend, redaction_config, language_code)
+            pii_classification_segmenter, pii_redaction_segmenter = create_segmenters(text, comprehend, deadline)
+            if isinstance(text, MappedText):
+                # neither held in memory nor cached
+                with text, spill_file() as redacted_file:
+                    LOG.info(f"Redacting the {len(text)} characters of the object spilled to disk")
+                    document = Document('', pii_classification=redact_in_windows(
+                        text, redacted_file, pii_classification_segmenter, pii_redaction_segmenter, redactor, comprehend,
+                        redaction_config, language_code, cancellation_token=cancellation_token, deadline=deadline))
+                    processed_document = True
+                    LOG.info(f"Pii redaction completed within {(time.time() - time2)} seconds. Returning back the response to S3")
+                    http_headers[CONTENT_LENGTH] = redacted_file.tell()
+                    redacted_file.seek(0)
+                    cancellation_token.raise_if_cancelled()
+                    s3.respond_back_with_data(redacted_file, http_headers, object_get_context[REQUEST_ROUTE],
+                                              object_get_context[REQUEST_TOKEN], status_code)
+                return
+            # the result of a range is the redaction of the range alone. Planned segment sizes follow the latencies observed, so
+            # results are keyed by whether they are planned rather than by the sizes planned, which would rarely be the same twice
+            cache_key = RESULT_CACHE.key(http_headers, 'redaction', language_code, vars(redaction_config), REDACTION_API_ONLY,
+                                         DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES, DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES,
+                                         SEGMENT_SIZE_PLANNING, PII_PRE_SCREEN_POLICY.name,
+                                         partial_object and partial_object.requested)
+            cached_result = RESULT_CACHE.get(cache_key)
+            if cached_result is None and partial_object is None and 0 < STREAMING_RESPONSE_THRESHOLD <= len(text):
+                # sent back as it is redacted, so the redacted text is neither held as a whole nor cached, and its length isn't known
+                incremental_redactor = IncrementalRedactor(text, redactor)
+                redacted_text_chunks = redact_incrementally(text, pii_classification_segmenter, pii_redaction_segmenter,
+                                                            incremental_redactor, comprehend, redaction_config, language_code,
+                                                            cancellation_token, deadline)
+                http_headers.pop(CONTENT_LENGTH, None)
+                cancellation_token.raise_if_cancelled()
+                LOG.info("Streaming the redacted document back to S3")
+                s3.respond_back_with_data(redacted_text_chunks, http_headers, object_get_context[REQUEST_ROUTE],
+                                          object_get_context[REQUEST_TOKEN], status_code)
+                document = Document(text, pii_classification=incremental_redactor.pii_classification)
+                processed_document = True
+                LOG.info(f"Pii redaction and streaming completed within {(time.time() - time2)} seconds")
+                return
+            if cached_result is not None:
+                LOG.info("Found the redacted document in the result cache")
+                document = Document(text, pii_classification=cached_result[PII_CLASSIFICATION],
+                                    redacted_text=cached_result[REDACTED_TEXT])
+            else:
+                document = redact(text, pii_classification_segmenter, pii_redaction_segmenter, redactor,
+                                  comprehend, redaction_config, language_code, cancellation_token, deadline)
+                if partial_object is not None:
+                    document.redacted_text = partial_object.redact(document.pii_entities, redactor)
+                RESULT_CACHE.put(cache_key, {REDACTED_TEXT: document.redacted_text, PII_CLASSIFICATION: document.pii_classification})
             processed_document = True
             time1 = time.time()
             LOG.info(f"Pii redaction completed within {(time1 - time2)} seconds. Returning back the response to S3")
             redacted_text_bytes = document.redacted_text.encode('utf-8')
             http_headers[CONTENT_LENGTH] = len(redacted_text_bytes)
+            if partial_object is not None:
+                http_headers[CONTENT_RANGE] = content_range(partial_object.characters, partial_object.object_size)
+                status_code = S3_STATUS_CODES.PARTIAL_CONTENT_206
+            # a request which ran out of time has already been answered with an error
+            cancellation_token.raise_if_cancelled()
             s3.respond_back_with_data(redacted_text_bytes, http_headers, object_get_context[REQUEST_ROUTE],
                                       object_get_context[REQUEST_TOKEN], status_code)
 
-        execute_task_with_timeout(context.get_remaining_time_in_millis() - RESERVED_TIME_FOR_CLEANUP, time_bound_task)
+        execute_task_with_timeout(deadline.remaining_time_in_millis(), time_bound_task, cancellation_token)
     except Exception as generated_exception:
         exception_handler.handle_exception(generated_exception, object_get_context[REQUEST_ROUTE], object_get_context[REQUEST_TOKEN])
     finally:
@@ -183,21 +455,18 @@ def pii_access_control_handler(event, context):
     detection_config = ClassificationConfig(**invoke_args)
     object_get_context = event[GET_OBJECT_CONTEXT]
     s3ol_access_point = event[S3OL_CONFIGURATION][S3OL_ACCESS_POINT_ARN]
-
-    s3 = S3Client(s3ol_access_point)
-    cloud_watch = CloudWatchClient()
-    comprehend = ComprehendClient(session_id=event[REQUEST_ID], user_agent=DEFAULT_USER_AGENT, endpoint_url=COMPREHEND_ENDPOINT_URL,
-                                  s3ol_access_point=s3ol_access_point)
+    s3, comprehend, cloud_watch = _get_clients(s3ol_access_point, event[REQUEST_ID])
     exception_handler = ExceptionHandler(s3)
 
     LOG.debug("Pii Entity Types to be detected:" + str(detection_config.pii_entity_types))
 
-    pii_classification_segmenter = Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES)
-
     processed_document = False
     processed_pii_document = False
     pii_entities = []
 
+    # cancelled when the time runs out, so that the abandoned task stops instead of competing with the next invocations
+    cancellation_token = CancellationToken()
+    deadline = Deadline(context.get_remaining_time_in_millis() - RESERVED_TIME_FOR_CLEANUP)
     try:
         def time_bound_task():
             nonlocal processed_document
@@ -205,11 +474,39 @@ def pii_access_control_handler(event, context):
             nonlocal pii_entities
             PartialObjectRequestValidator.validate(event)
             time1 = time.time()
-            text, http_headers, status_code = s3.download_file_from_presigned_url(object_get_context[INPUT_S3_URL],
-                                                                                  event[USER_REQUEST][HEADERS])
+            text, http_headers, status_code, partial_object = download_object(s3, event, cancellation_token, deadline)
             time2 = time.time()
             LOG.info(f"Downloaded the file in : {(time2 - time1)} seconds")
-            pii_entities = classify(text, pii_classification_segmenter, comprehend, detection_config, language_code)
+            pii_classification_segmenter, _ = create_segmenters(text, comprehend, deadline, detect_entities=False)
+            if isinstance(text, MappedText):
+                # neither held in memory nor cached, and passed back from the file it was spilled to
+                with text:
+                    LOG.info(f"Classifying the {len(text)} characters of the object spilled to disk")
+                    pii_entities = classify_in_windows(text, pii_classification_segmenter, comprehend, detection_config, language_code,
+                                                       stop_on_first_match=ACCESS_CONTROL_SHORT_CIRCUIT,
+                                                       cancellation_token=cancellation_token, deadline=deadline)
+                    processed_document = True
+                    LOG.info(f"Pii detection completed within {(time.time() - time2)} seconds. Returning back the response to S3")
+                    if len(pii_entities) > 0:
+                        processed_pii_document = True
+                        raise RestrictedDocumentException()
+                    text.file.seek(0)
+                    cancellation_token.raise_if_cancelled()
+                    s3.respond_back_with_data(text.file, http_headers, object_get_context[REQUEST_ROUTE],
+                                              object_get_context[REQUEST_TOKEN], status_code)
+                return
+            cache_key = RESULT_CACHE.key(http_headers, 'classification', language_code, vars(detection_config),
+                                         ACCESS_CONTROL_SHORT_CIRCUIT, DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES, SEGMENT_SIZE_PLANNING,
+                                         PII_PRE_SCREEN_POLICY.name)
+            cached_result = RESULT_CACHE.get(cache_key)
+            if cached_result is not None:
+                LOG.info("Found the pii classification of the document in the result cache")
+                pii_entities = cached_result[INTERESTED_PII_ENTITY_TYPES]
+            else:
+                pii_entities = classify(text, pii_classification_segmenter, comprehend, detection_config, language_code,
+                                        stop_on_first_match=ACCESS_CONTROL_SHORT_CIRCUIT, cancellation_token=cancellation_token,
+                                        deadline=deadline)
+                RESULT_CACHE.put(cache_key, {INTERESTED_PII_ENTITY_TYPES: pii_entities})
             time1 = time.time()
 
             processed_document = True
@@ -218,13 +515,20 @@ def pii_access_control_handler(event, context):
                 processed_pii_document = True
                 raise RestrictedDocumentException()
             else:
-                text_bytes = text.encode('utf-8')
+                if partial_object is None:
+                    text_bytes = text.encode('utf-8')
+                else:
+                    text_bytes = partial_object.requested_bytes()
+                    http_headers[CONTENT_RANGE] = content_range(partial_object.requested, partial_object.object_size)
+                    status_code = S3_STATUS_CODES.PARTIAL_CONTENT_206
                 http_headers[CONTENT_LENGTH] = len(text_bytes)
+                # a request which ran out of time has already been answered with an error
+                cancellation_token.raise_if_cancelled()
                 s3.respond_back_with_data(text_bytes, http_headers, object_get_context[REQUEST_ROUTE],
                                           object_get_context[REQUEST_TOKEN],
                                           status_code)
 
-        execute_task_with_timeout(context.get_remaining_time_in_millis() - RESERVED_TIME_FOR_CLEANUP, time_bound_task)
+        execute_task_with_timeout(deadline.remaining_time_in_millis(), time_bound_task, cancellation_token)
     except Exception as generated_exception:
         exception_handler.handle_exception(generated_exception, object_get_context[REQUEST_ROUTE], object_get_context[REQUEST_TOKEN])
     finally:
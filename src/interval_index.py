@@ -0,0 +1,88 @@
+"""Index of text spans answering overlap queries."""
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, compress, islice, repeat
+from operator import ge, le, sub
+from typing import Iterable, List, Sequence, Tuple
+
+
+class IntervalIndex:
+    """
+    Static index of half open [begin, end) spans, like the offsets of pii entities.
+
+    The spans are sorted by begin offset, next to the running maximum of their end offsets. Both are sorted, so the spans
+    overlapping a query are found with two binary searches: they begin before the end of the query, and come after the last
+    span at which the running maximum end is still at or before the begin of the query. A query costs O(log n + k) for spans
+    that are short compared to the distance between them, which is how entities are spread over a text.
+
+    Spans are referred to by their position in the begin and end offsets the index was built from. The index is built without
+    any per span python code, and spans which are already sorted and don't overlap, the common case, are indexed as they are.
+    """
+
+    def __init__(self, begins: Sequence[int], ends: Sequence[int]):
+        self.begins = begins
+        self.ends = ends
+        self._disjoint = all(map(le, ends, islice(begins, 1, None)))
+        if self._disjoint:
+            self._order = range(len(begins))
+            self._begins = begins
+            self._ends = self._reach = ends
+        else:
+            self._order = sorted(range(len(begins)), key=begins.__getitem__)
+            self._begins = list(map(begins.__getitem__, self._order))
+            self._ends = list(map(ends.__getitem__, self._order))
+            self._reach = list(accumulate(self._ends, max))
+
+    def __len__(self) -> int:
+        """Return the number of spans in the index."""
+        return len(self._order)
+
+    def overlapping(self, begin: int, end: int) -> List[int]:
+        """Return the positions of the spans overlapping [begin, end), sorted by begin offset."""
+        first = bisect_right(self._reach, begin)
+        last = bisect_left(self._begins, end)
+        return [self._order[i] for i in range(first, last) if self._ends[i] > begin]
+
+    def _cluster_bounds(self) -> Tuple[Sequence[int], Sequence[int]]:
+        # a cluster starts at every span which begins at or after the end of all the spans before it
+        if self._disjoint:
+            return range(len(self._order)), range(1, len(self._order) + 1)
+        starts = [0] + list(compress(range(1, len(self._order)), map(ge, islice(self._begins, 1, None), self._reach)))
+        return starts, starts[1:] + [len(self._order)]
+
+    def clusters(self) -> Iterable[List[int]]:
+        """
+        Yield the groups of spans which overlap each other, directly or through other spans, sorted by begin offset.
+
+        The spans of a group are sorted by begin offset too, and a span overlapping no other span is a group of its own.
+        """
+        for start, stop in zip(*self._cluster_bounds()):
+            yield list(self._order[start:stop])
+
+    def merged_spans(self) -> Tuple[Sequence[int], Sequence[int]]:
+        """Return the begin and the end offsets of the groups of spans which overlap each other, in the order of clusters()."""
+        if self._disjoint:
+            return self._begins, self._ends
+        starts, stops = self._cluster_bounds()
+        return list(map(self._begins.__getitem__, starts)), list(map(self._reach.__getitem__, map(sub, stops, repeat(1))))
+
+    def resolve_by_score(self, scores: List[float], groups: List = None) -> List[int]:
+        """
+        Return the positions of the spans kept when overlapping spans are resolved by score, sorted by begin offset.
+
+        Spans are considered from the highest score down and a span is dropped when it overlaps a span already kept. Spans of
+        the same group, when groups are given, don't conflict with each other. Ties go to the span which begins first.
+        """
+        kept = [True] * len(self._order)
+        for start, stop in zip(*self._cluster_bounds()):
+            if stop - start == 1:
+                continue
+            cluster = self._order[start:stop]
+            if groups is not None and len({groups[i] for i in cluster}) == 1:
+                continue
+            for i in cluster:
+                kept[i] = False
+            # the cluster is sorted by begin offset and sorted is stable, so ties go to the span which begins first
+            for i in sorted(cluster, key=lambda i: -scores[i]):
+                kept[i] = not any(kept[j] and (groups is None or groups[j] != groups[i])
+                                  for j in self.overlapping(self.begins[i], self.ends[i]))
+        return list(compress(self._order, map(kept.__getitem__, self._order)))
@@ -0,0 +1,144 @@
+"""Support for GetObject requests of a range of bytes of an object."""
+import re
+from typing import Mapping, NamedTuple, Optional, Tuple
+
+from constants import CONTENT_RANGE, RANGE
+from data_object import EntityStore
+from exceptions import InvalidRangeException, InvalidRequestException
+from processors import Redactor, Utf8ByteIndex
+
+# a character starting within a range can end up to that many bytes after it
+MAX_UTF8_CONTINUATION_BYTES = 3
+
+_RANGE_RE = re.compile(r'^bytes=(?:(\d+)-(\d*)|-(\d+))$')
+_CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class ByteRange(NamedTuple):
+    """Range of bytes of an object, both ends included."""
+
+    first: int
+    last: int
+
+    def __len__(self) -> int:
+        """Return the number of bytes in the range."""
+        return self.last - self.first + 1
+
+
+def parse_content_range(content_range: str) -> Tuple[ByteRange, Optional[int]]:
+    """Parse the value of a Content-Range header into the range of bytes it holds and the size of the object, if known."""
+    match = _CONTENT_RANGE_RE.match(content_range.strip())
+    if match is None:
+        raise ValueError(f"Invalid Content-Range {content_range}")
+    first, last, object_size = match.groups()
+    return ByteRange(int(first), int(last)), None if object_size == '*' else int(object_size)
+
+
+def content_range(byte_range: ByteRange, object_size: int) -> str:
+    """Return the value of the Content-Range header of given range of bytes of an object of given size."""
+    return f"bytes {byte_range.first}-{byte_range.last}/{object_size}"
+
+
+class RangeRequest(NamedTuple):
+    """
+    Range of bytes requested with the Range header of a GetObject request.
+
+    Either first (and optionally last) is set, or suffix_length for a range of the last bytes of the object.
+    Refer https://tools.ietf.org/html/rfc7233#section-2.1 for the syntax of the header.
+    """
+
+    first: Optional[int]
+    last: Optional[int]
+    suffix_length: Optional[int]
+
+    @classmethod
+    def from_headers(cls, headers: Mapping) -> Optional['RangeRequest']:
+        """
+        Parse the Range header of the request, if any.
+
+        A malformed header is ignored, like S3 does, and None is returned as if there was none.
+        """
+        value = headers.get(RANGE) if headers else None
+        if value is None:
+            return None
+        if ',' in value:
+            raise InvalidRequestException("Multiple byte ranges are not supported")
+        match = _RANGE_RE.match(value.strip())
+        if match is None:
+            return None
+        first, last, suffix_length = match.groups()
+        if suffix_length is not None:
+            return cls(None, None, int(suffix_length))
+        if last and int(last) < int(first):
+            return None
+        return cls(int(first), int(last) if last else None, None)
+
+    def widened(self, context_size: int) -> str:
+        """
+        Return the value of the Range header requesting this range with context_size more bytes on each side.
+
+        The range is widened by at least a character on each side, so that the characters cut by the widened range, which are
+        left out of the downloaded text, are outside of this range.
+        """
+        margin = max(context_size, MAX_UTF8_CONTINUATION_BYTES)
+        if self.suffix_length is not None:
+            return f"bytes=-{self.suffix_length + margin}"
+        last = '' if self.last is None else self.last + margin
+        return f"bytes={max(self.first - margin, 0)}-{last}"
+
+    def resolve(self, object_size: int) -> ByteRange:
+        """Return the bytes of an object of given size this range refers to, raising InvalidRangeException if there are none."""
+        if self.suffix_length is not None:
+            if self.suffix_length == 0 or object_size == 0:
+                raise InvalidRangeException("The requested range is not satisfiable")
+            return ByteRange(max(object_size - self.suffix_length, 0), object_size - 1)
+        if self.first >= object_size:
+            raise InvalidRangeException("The requested range is not satisfiable")
+        return ByteRange(self.first, object_size - 1 if self.last is None else min(self.last, object_size - 1))
+
+
+class PartialObject:
+    """
+    Requested range of an object, downloaded along with a window of context on each side.
+
+    The whole window is processed so that the pii entities at the edges of the range are detected with their context, but only
+    the requested range is returned. Offsets are computed on the bytes of the object, which don't match the characters of the
+    text when it has multibyte characters. The text returned after redaction is made of the characters starting within the
+    requested range, a character cut by the range being returned whole if it starts within it and not at all otherwise, so
+    that reading consecutive ranges returns every character exactly once.
+    """
+
+    def __init__(self, text: str, http_headers: Mapping, range_request: RangeRequest):
+        self.text = text
+        byte_index = Utf8ByteIndex(text)
+        window_size = byte_index.byte_offset(len(text))
+        if http_headers.get(CONTENT_RANGE):
+            window, object_size = parse_content_range(http_headers[CONTENT_RANGE])
+        else:
+            # the whole object was returned
+            window, object_size = ByteRange(0, window_size - 1), window_size
+        self.window = window
+        self.object_size = object_size
+        self.requested = range_request.resolve(object_size)
+        first = self.requested.first - window.first
+        last = self.requested.last - window.first
+        self.begin = byte_index.char_offset_at_most(first)
+        if byte_index.byte_offset(self.begin) < first:
+            self.begin += 1
+        self.end = len(text) if last >= window_size - 1 else max(byte_index.char_offset_at_most(last) + 1, self.begin)
+        # the bytes of the object holding the characters returned, if any
+        self.characters = self.requested if self.begin == self.end else ByteRange(
+            window.first + byte_index.byte_offset(self.begin), window.first + byte_index.byte_offset(self.end) - 1)
+
+    def requested_bytes(self) -> bytes:
+        """Return the requested bytes of the object, as they are."""
+        return self.text.encode('utf-8')[self.requested.first - self.window.first:self.requested.last - self.window.first + 1]
+
+    def redact(self, pii_entities: EntityStore, redactor: Redactor) -> str:
+        """
+        Redact the characters in the requested range, given the pii entities found in the whole window.
+
+        The redacted characters take as many bytes as the original ones, so that the response holds exactly the bytes of the
+        object its Content-Range refers to.
+        """
+        return redactor.redact(self.text[self.begin:self.end], pii_entities.clipped(self.begin, self.end), preserve_byte_length=True)
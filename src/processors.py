@@ -1,24 +1,70 @@
 """Text processors."""
 
 # must be the first import in files with lambda function handlers
-from copy import deepcopy
-from typing import List
+import re
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate, chain, compress, repeat
+from operator import ge, mul, sub
+from typing import Callable, Dict, Iterable, List, Optional, Pattern, Tuple, Union
 
 import lambdalogging
 from config import SUBSEGMENT_OVERLAPPING_TOKENS, MAX_CHARS_OVERLAP
-from constants import ENTITY_TYPE, BEGIN_OFFSET, END_OFFSET, ALL, REPLACE_WITH_PII_ENTITY_TYPE, SCORE
-from data_object import Document
+from constants import ALL, REPLACE_WITH_PII_ENTITY_TYPE, PII_PRE_SCREEN_POLICY_VALID_VALUES
+from data_object import Document, EntityStore, SegmentResult, entity_type_id
 from data_object import RedactionConfig
 from exceptions import InvalidConfigurationException
+from interval_index import IntervalIndex
+from util import Deadline
 
 LOG = lambdalogging.getLogger(__name__)
 
 
+class Utf8ByteIndex:
+    """
+    Map character offsets of a text to byte offsets in its utf-8 encoding and back.
+
+    The byte offset of every BLOCK_SIZE-th character is precomputed once, so a lookup only needs to encode at most BLOCK_SIZE
+    characters instead of the whole prefix of the text. Pure ascii text maps one to one and needs no index at all.
+    """
+
+    BLOCK_SIZE = 64
+
+    def __init__(self, text: str):
+        self.text = text
+        self.is_ascii = text.isascii()
+        self.block_byte_offsets = None
+        if not self.is_ascii:
+            block_sizes = (len(text[i:i + self.BLOCK_SIZE].encode('utf-8')) for i in range(0, len(text), self.BLOCK_SIZE))
+            self.block_byte_offsets = array('q', accumulate(block_sizes, initial=0))
+
+    def byte_offset(self, char_offset: int) -> int:
+        """Return the offset in the utf-8 encoding at which the character at given offset starts."""
+        if self.is_ascii:
+            return char_offset
+        block = char_offset // self.BLOCK_SIZE
+        block_start = block * self.BLOCK_SIZE
+        return self.block_byte_offsets[block] + len(self.text[block_start:char_offset].encode('utf-8'))
+
+    def char_offset_at_most(self, byte_offset: int) -> int:
+        """Return the largest character offset whose byte offset in the utf-8 encoding does not exceed given byte offset."""
+        if self.is_ascii:
+            return min(byte_offset, len(self.text))
+        block = bisect_right(self.block_byte_offsets, byte_offset) - 1
+        # the last entry of the index is the size of the whole text, which need not be a multiple of BLOCK_SIZE characters
+        block_start = min(block * self.BLOCK_SIZE, len(self.text))
+        remaining_bytes = byte_offset - self.block_byte_offsets[block]
+        block_bytes = self.text[block_start:block_start + self.BLOCK_SIZE].encode('utf-8')[:remaining_bytes]
+        # the cut can fall in the middle of a multi byte character, which is then not counted
+        return block_start + len(block_bytes.decode('utf-8', errors='ignore'))
+
+
 class Segmenter:
     """Offer functionality to segment and desegment."""
 
     def __init__(self, max_doc_size: int, overlap_tokens: int = SUBSEGMENT_OVERLAPPING_TOKENS,
-                 max_overlapping_chars: int = MAX_CHARS_OVERLAP, **kwargs):
+                 max_overlapping_chars: int = MAX_CHARS_OVERLAP, deadline: Deadline = None, **kwargs):
+        self.deadline = deadline
         self.max_overlapping_chars = int(max_overlapping_chars)
         self.overlap_tokens = int(overlap_tokens)
         self.max_doc_size = int(max_doc_size)
@@ -27,58 +73,6 @@ class Segmenter:
             raise InvalidConfigurationException(
                 f"Maximum text size limit ({self.max_doc_size} bytes) is too less to perform segmentation")
 
-    def _trim_to_max_bytes(self, s, max_bytes):
-        """
-        Ensure that the UTF-8 encoding of a string has not more than max_bytes bytes.
-
-        The table below summarizes the format of these different octet types.
-           Char. number range  |        UTF-8 octet sequence
-              (hexadecimal)    |              (binary)
-           --------------------+---------------------------------------------
-           0000 0000-0000 007F | 0xxxxxxx
-           0000 0080-0000 07FF | 110xxxxx 10xxxxxx
-           0000 0800-0000 FFFF | 1110xxxx 10xxxxxx 10xxxxxx
-           0001 0000-0010 FFFF | 11110xxx 10xxxxxx 10xxxxxx 10xxxxxx
-        """
-
-        def safe_b_of_i(b, i):
-            try:
-                return b[i]
-            except IndexError:
-                return 0
-
-        # Edge cases
-        if s == '' or max_bytes < 1:
-            return ''
-
-        # cut it twice to avoid encoding potentially GBs of string just to get e.g. 10 bytes?
-        bytes_array = s[:max_bytes].encode('utf-8')[:max_bytes]
-
-        # find the first byte from end which contains the starting byte of a utf8 character which is this format 11xxxxxx for
-        # multi byte character. For single byte character the format is 0xxxxxxx as described above
-        if bytes_array[-1] & 0b10000000:
-            last_11xxxxxx_index = [
-                i
-                for i in range(-1, -5, -1)
-                if safe_b_of_i(bytes_array, i) & 0b11000000 == 0b11000000
-            ][0]
-            # As described above in the table , we can determine the total size(in bytes) of char from the first byte itself
-            starting_byte = bytes_array[last_11xxxxxx_index]
-            if not starting_byte & 0b00100000:
-                last_char_length = 2
-            elif not starting_byte & 0b00010000:
-                last_char_length = 3
-            elif not starting_byte & 0b00001000:
-                last_char_length = 4
-            else:
-                raise Exception(f"Unexpected utf-8 {starting_byte} byte encountered")
-
-            if last_char_length > -last_11xxxxxx_index:
-                # remove the incomplete character
-                bytes_array = bytes_array[:last_11xxxxxx_index]
-
-        return bytes_array.decode('utf-8')
-
     def _trim_partial_trailing_word(self, text):
         # find the first space moving backwards
         original_length = len(text)
@@ -112,78 +106,41 @@ class Segmenter:
                 existing_results[name] = score
         return existing_results
 
-    def _is_overlapping_annotations(self, entity_a, entity_b) -> int:
+    def _merge_pii_annotation_results(self, segments: List[Union[Document, SegmentResult]]) -> EntityStore:
         """
-        Determine if one entity overlaps with another.
-        It will return :
-         1 if entity_b, lies on right side of the entity
-         0 if entity_b overlaps with entity_a
-         -1 if entity_b lies on left side of the entity
-        """
-        if entity_a[END_OFFSET] < entity_b[BEGIN_OFFSET]:
-            return 1
-        if entity_a[BEGIN_OFFSET] > entity_b[END_OFFSET]:
-            return -1
-        else:
-            return 0
+        Merge the pii entities of the segments into one store of entities sorted by begin offset.
 
-    def _resolve_overlapped_annotation(self, entity_a, entity_b) -> List:
-        """Merge two overlapping entity annotations."""
-        if entity_a[SCORE] >= entity_b[SCORE]:
-            return [entity_a]
-        else:
-            return [entity_b]
-
-    def _merge_pii_annotation_results(self, segment: Document, existing_annotations: List = []):
-
-        if not existing_annotations:
-            existing_annotations.extend(segment.pii_entities)
-            return
-
-        for pii_entity in segment.pii_entities:
-            k = len(existing_annotations) - 1
-            while k > 0:
-                overlap_result = self._is_overlapping_annotations(existing_annotations[k], pii_entity)
-                if overlap_result > 0:
-                    existing_annotations.append(pii_entity)
-                    break
-                elif overlap_result == 0:
-                    LOG.debug("Annotation: " + str(existing_annotations[k]) + " conflicts with: " + str(pii_entity))
-                    resolved_annotation = self._resolve_overlapped_annotation(existing_annotations[k], pii_entity)
-                    LOG.debug("Deleting annotation:" + str(existing_annotations[k]))
-                    del existing_annotations[k]
-                    for i, annotation in enumerate(resolved_annotation):
-                        LOG.debug("Adding annotation:" + str(annotation))
-                        existing_annotations.insert(k + i, annotation)
-                    break
-                else:
-                    k -= 1
-
-        return existing_annotations
-
-    def _relocate_annotation(self, annotations: List, offset: int):
-        """Shift the annotated entities by given offset."""
-        annotations_copy = deepcopy(annotations)
-        for annotation in annotations_copy:
-            annotation[END_OFFSET] += offset
-            annotation[BEGIN_OFFSET] += offset
-        return annotations_copy
+        Segments overlap, so an entity conflicts with the entities of other segments it overlaps with. Conflicts are resolved
+        in favour of the higher score, while entities reported by the same segment are kept as comprehend returned them.
+        """
+        pii_entities = EntityStore.concatenate(segment.pii_entities.shifted(segment.char_offset) for segment in segments)
+        segment_indexes = list(chain.from_iterable(repeat(i, len(segment.pii_entities)) for i, segment in enumerate(segments)))
+        index = IntervalIndex(pii_entities.begin_offsets, pii_entities.end_offsets)
+        kept_positions = index.resolve_by_score(pii_entities.scores, groups=segment_indexes)
+        if len(kept_positions) < len(pii_entities):
+            LOG.debug(f"Dropped {len(pii_entities) - len(kept_positions)} pii entities conflicting with other segments")
+        return pii_entities.take(kept_positions)
 
     def segment(self, text: str, char_offset=0) -> List[Document]:
-        """Segment the text into segments of max_doc_length with overlap_tokens."""
+        """Segment the text into segments of max_doc_length with overlap_tokens, checking the deadline between segments."""
         segments = []
         starting_index = 0
-        while len(text[starting_index:].encode()) > self.max_doc_size:
-            trimmed_text = self._trim_to_max_bytes(text[starting_index:], self.max_doc_size)
-            trimmed_text = self._trim_partial_trailing_word(trimmed_text)
+        byte_index = Utf8ByteIndex(text)
+        total_bytes = byte_index.byte_offset(len(text))
+        while total_bytes - byte_index.byte_offset(starting_index) > self.max_doc_size:
+            if self.deadline is not None:
+                self.deadline.check("segmentation")
+            # longest run of characters starting at starting_index whose utf-8 encoding fits within max_doc_size bytes
+            ending_index = byte_index.char_offset_at_most(byte_index.byte_offset(starting_index) + self.max_doc_size)
+            trimmed_text = self._trim_partial_trailing_word(text[starting_index:ending_index])
             segments.append(Document(text=trimmed_text, char_offset=char_offset + starting_index))
             starting_index = starting_index + self._find_trailing_overlapping_tokens_start_index(trimmed_text) + 1
         # Add the remaining segment
-        if starting_index < len(text) - 1:
+        if starting_index < len(text):
             segments.append(Document(text=text[starting_index:], char_offset=char_offset + starting_index))
         return segments
 
-    def de_segment(self, segments: List[Document]) -> Document:
+    def de_segment(self, segments: List[Union[Document, SegmentResult]]) -> Document:
         """
         Merge the segments back into one big text. It also merges back the pii classification result.
         Handles conflicting result on overlapping text between two text segments in the following ways:
@@ -192,18 +149,19 @@ class Segmenter:
         2. For pii entity annotations, for a conflicting annotation span a higher priority
             is given to the one with a higher confidence threshold
         """
-        merged_text = ""
+        segments = sorted(segments, key=lambda x: x.char_offset)
         pii_classification = {}
-        pii_entities = []
-        segments.sort(key=lambda x: x.char_offset)
+        text_parts = []
+        merged_length = 0
         for segment in segments:
-            offset_adjusted_segment = Document(text=segment.text, char_offset=segment.char_offset,
-                                               pii_entities=self._relocate_annotation(segment.pii_entities, segment.char_offset),
-                                               pii_classification=segment.pii_classification)
             self._merge_classifcation_results(segment, pii_classification)
-            self._merge_pii_annotation_results(offset_adjusted_segment, pii_entities)
-            merged_text = merged_text + segment.text[len(merged_text) - segment.char_offset:]
-        return Document(text=merged_text, char_offset=0, pii_classification=pii_classification, pii_entities=pii_entities)
+            # only the part of the segment beyond what has been merged so far is new
+            new_text_start = merged_length - segment.char_offset
+            if new_text_start < len(segment.text):
+                text_parts.append(segment.text[max(new_text_start, 0):])
+                merged_length = segment.char_offset + len(segment.text)
+        pii_entities = self._merge_pii_annotation_results(segments)
+        return Document(text=''.join(text_parts), char_offset=0, pii_classification=pii_classification, pii_entities=pii_entities)
 
 
 class Redactor:
@@ -212,37 +170,232 @@ class Redactor:
     def __init__(self, redaction_config: RedactionConfig):
         self.redaction_config = redaction_config
 
-    def redact(self, input_text, entities_list):
-        """Redact the pii entities from given text."""
-        doc_parts_list = []
-        prev_entity = None
-        for entity in entities_list:
-            if entity[SCORE] < self.redaction_config.confidence_threshold:
-                continue
-            entity_type = entity[ENTITY_TYPE]
-            begin_offset = entity[BEGIN_OFFSET]
-            end_offset = entity[END_OFFSET]
-            if prev_entity is None:
-                doc_parts_list.append(input_text[:begin_offset])
-            else:
-                doc_parts_list.append(input_text[prev_entity[END_OFFSET]:begin_offset])
-
-            if ALL in self.redaction_config.pii_entity_types or entity_type in self.redaction_config.pii_entity_types:
-                # Redact this entity type
-                if self.redaction_config.mask_mode == REPLACE_WITH_PII_ENTITY_TYPE:
-                    # Replace with PII Entity Type
-                    doc_parts_list.append(f"[{entity_type}]")
-                else:
-                    # Replace with MaskCharacter
-                    entity_length = end_offset - begin_offset
-                    doc_parts_list.append(self.redaction_config.mask_character * entity_length)
-            else:
-                # Don't redact this entity type
-                doc_parts_list.append(input_text[begin_offset:end_offset])
-
-            prev_entity = entity
-        if prev_entity is not None:
-            doc_parts_list.append(input_text[prev_entity[END_OFFSET]:])
+    def redact(self, input_text, entities_list, preserve_byte_length: bool = False):
+        """
+        Redact the pii entities from given text.
+
+        Entities to redact which overlap each other are redacted together as one span, so that no part of any of them is left
+        in the text. A span replaced with a pii entity type gets the type of its entity with the highest score. With
+        preserve_byte_length, every span is replaced by as many utf-8 bytes as it holds, rather than characters: a span is masked
+        with a mask character per byte, and its entity type is cut or padded with the mask character to fit the span.
+        """
+        entities = entities_list if isinstance(entities_list, EntityStore) else EntityStore.from_entities(entities_list)
+        confidence_threshold = self.redaction_config.confidence_threshold
+        entities_to_redact = entities
+        if ALL not in self.redaction_config.pii_entity_types:
+            type_ids = {entity_type_id(entity_type) for entity_type in self.redaction_config.pii_entity_types}
+            entities_to_redact = entities.take(i for i, type_id in enumerate(entities.type_ids)
+                                               if type_id in type_ids and entities.scores[i] >= confidence_threshold)
+        elif entities and min(entities.scores) < confidence_threshold:
+            entities_to_redact = entities.take(compress(range(len(entities)), map(ge, entities.scores, repeat(confidence_threshold))))
+        if not entities_to_redact:
+            return input_text
+        index = IntervalIndex(entities_to_redact.begin_offsets, entities_to_redact.end_offsets)
+        begin_offsets, end_offsets = index.merged_spans()
+        if self.redaction_config.mask_mode == REPLACE_WITH_PII_ENTITY_TYPE:
+            # Replace with PII Entity Type
+            replacements = [f"[{entities_to_redact.entity_type(max(cluster, key=entities_to_redact.scores.__getitem__))}]"
+                            for cluster in index.clusters()]
+            if preserve_byte_length:
+                replacements = [self._fit_to_bytes(replacement, len(input_text[begin:end].encode('utf-8')))
+                                for replacement, begin, end in zip(replacements, begin_offsets, end_offsets)]
+        elif preserve_byte_length:
+            replacements = [self._fit_to_bytes('', len(input_text[begin:end].encode('utf-8')))
+                            for begin, end in zip(begin_offsets, end_offsets)]
         else:
-            doc_parts_list.append(input_text)
-        return ''.join([doc_part for doc_part in doc_parts_list])
+            # Replace with MaskCharacter
+            replacements = map(mul, repeat(self.redaction_config.mask_character), map(sub, end_offsets, begin_offsets))
+        # the text in between the redacted spans, the first one starting at the beginning of the text
+        kept_parts = map(input_text.__getitem__, map(slice, chain([0], end_offsets), begin_offsets))
+        return ''.join(chain(chain.from_iterable(zip(kept_parts, replacements)), [input_text[end_offsets[-1]:]]))
+
+    def _fit_to_bytes(self, replacement: str, byte_length: int) -> str:
+        """Cut given replacement at a character boundary, or pad it with the mask character, to exactly byte_length utf-8 bytes."""
+        mask_character = self.redaction_config.mask_character
+        # a multibyte mask character can't pad every length, the remaining bytes are padded with an ascii one
+        filler = mask_character if len(mask_character.encode('utf-8')) == 1 else '*'
+        fitted = replacement.encode('utf-8')[:byte_length].decode('utf-8', errors='ignore')
+        fitted += mask_character * ((byte_length - len(fitted.encode('utf-8'))) // len(mask_character.encode('utf-8')))
+        return fitted + filler * (byte_length - len(fitted.encode('utf-8')))
+
+
+class IncrementalRedactor:
+    """
+    Redact a text in document order, piece by piece, as the pii entities of its segments come in.
+
+    The segments sent for entity detection are registered with expect(), and their results are handed to add() in any order. The
+    text is redacted up to the first segment still expected: the entities found before it can't conflict with the entities yet
+    to come, except for the groups of overlapping entities crossing into it, which are held back until it comes in. Conflicts
+    are resolved by score like Segmenter.de_segment does, so the pieces add up to the redaction of the whole text.
+    """
+
+    def __init__(self, text: str, redactor: Redactor):
+        self.text = text
+        self.redactor = redactor
+        self.pii_classification: Dict[str, float] = {}
+        self.position = 0
+        # char offsets of the expected segments, sorted, and the entities received beyond the text redacted so far, along with
+        # the index of the segment of each of them
+        self._expected: List[int] = []
+        self._received: List[Tuple[List[int], EntityStore]] = []
+        self._segment_count = 0
+
+    def expect(self, segment: Document) -> Document:
+        """Register a segment whose pii entities are to come, returning it."""
+        insort(self._expected, segment.char_offset)
+        return segment
+
+    def add_classification(self, result: Union[Document, SegmentResult]):
+        """Merge the pii classification of a segment into the classification of the text."""
+        for name, score in result.pii_classification.items():
+            self.pii_classification[name] = max(score, self.pii_classification.get(name, score))
+
+    def add(self, result: Union[Document, SegmentResult]) -> str:
+        """Add the pii entities of an expected segment, returning the redaction of the text they complete, if any."""
+        self.add_classification(result)
+        del self._expected[bisect_left(self._expected, result.char_offset)]
+        if result.pii_entities:
+            self._received.append(([self._segment_count] * len(result.pii_entities), result.pii_entities.shifted(result.char_offset)))
+        self._segment_count += 1
+        # the entities of a segment begin at or after its char offset, so nothing is completed before the first expected segment
+        if self._expected and self._expected[0] <= result.char_offset:
+            return ''
+        return self._redact_until(self._expected[0] if self._expected else len(self.text))
+
+    def finish(self) -> str:
+        """Return the redaction of the rest of the text, once every expected segment has been added."""
+        assert not self._expected, f"{len(self._expected)} segments are still expected"
+        return self._redact_until(len(self.text))
+
+    def _redact_until(self, boundary: int) -> str:
+        entities = EntityStore.concatenate(store for _, store in self._received)
+        groups = list(chain.from_iterable(segments for segments, _ in self._received))
+        # the text is cut before the first group of overlapping entities which reaches past the boundary
+        before_boundary = [i for i, begin in enumerate(entities.begin_offsets) if begin < boundary]
+        index = IntervalIndex([entities.begin_offsets[i] for i in before_boundary], [entities.end_offsets[i] for i in before_boundary])
+        end = boundary
+        for cluster in index.clusters():
+            if max(index.ends[i] for i in cluster) > boundary:
+                end = index.begins[cluster[0]]
+                break
+        done = [i for i in before_boundary if entities.end_offsets[i] <= end]
+        if end <= self.position and not done:
+            return ''
+        completed = entities.take(done)
+        done_groups = [groups[i] for i in done]
+        kept_positions = IntervalIndex(completed.begin_offsets, completed.end_offsets).resolve_by_score(completed.scores, done_groups)
+        redacted_text = self.redactor.redact(self.text[self.position:end], completed.take(kept_positions).shifted(-self.position))
+        done = set(done)
+        remaining = [i for i in range(len(entities)) if i not in done]
+        self._received = [([groups[i] for i in remaining], entities.take(remaining))]
+        self.position = end
+        return redacted_text
+
+
+def luhn_checksum_valid(number: str) -> bool:
+    """Check whether the digits of given number, separators aside, pass the Luhn checksum of payment card numbers."""
+    digits = [int(char) for char in number if char.isdigit()]
+    checksum = sum(digits[-1::-2]) + sum(sum(divmod(2 * digit, 10)) for digit in digits[-2::-2])
+    return checksum % 10 == 0
+
+
+# patterns of the values of the entity types which can be screened for locally, deliberately loose so that they rather match too
+# much than miss a value comprehend would detect. A value is only a candidate if it also passes the validator of its type, if any
+_PRE_SCREEN_PATTERNS = {
+    'EMAIL': [r'[\w.%+-]+@[\w-]+(?:\.[\w-]+)+'],
+    # numbers separated by spaces only are taken for phone numbers with a country code or an area code in parentheses, so that
+    # columns of numeric values aren't
+    'PHONE': [r'(?<![\w+.-])\+\d{1,3}[\s.-]?(?:\(\d{1,4}\)|\d{1,4})[\s.-]?\d{3,4}[\s.-]?\d{3,4}(?![\w.-])',
+              r'(?<![\w.-])\(\d{1,4}\)[\s.-]?\d{3,4}[\s.-]?\d{3,4}(?![\w.-])',
+              r'(?<![\w.-])(?:\d{2,4}([.-]))?\d{3}([.-])\d{4}(?![\w.-])'],
+    'SSN': [r'(?<![\w-])\d{3}([- ])\d{2}\1\d{4}(?![\w-])'],
+    'CREDIT_DEBIT_NUMBER': [r'(?<![\w-])\d{4}([ -]?)\d{4,6}\1\d{4,5}(?:\1\d{1,4})?(?![\w-])'],
+    'CREDIT_DEBIT_EXPIRY': [r'(?<![\w/])(?:0?[1-9]|1[0-2])\s?[/-]\s?(?:\d{2}|\d{4})(?![\w/])'],
+    'IP_ADDRESS': [r'(?<![\w.])(?:\d{1,3}\.){3}\d{1,3}(?![\w.])', r'(?<![\w:])(?:[0-9A-Fa-f]{0,4}:){2,7}[0-9A-Fa-f]{1,4}(?![\w:])'],
+    'MAC_ADDRESS': [r'(?<![\w:-])[0-9A-Fa-f]{2}([:-])(?:[0-9A-Fa-f]{2}\1){4}[0-9A-Fa-f]{2}(?![\w:-])'],
+    'URL': [r'(?i:\b(?:https?|ftp)://|\bwww\.)\S+'],
+    'AWS_ACCESS_KEY': [r'\b(?:AKIA|ASIA|AIDA|AROA)[0-9A-Z]{16}\b'],
+    'AWS_SECRET_KEY': [r'(?<![A-Za-z0-9/+])[A-Za-z0-9/+]{40}(?![A-Za-z0-9/+=])'],
+    'INTERNATIONAL_BANK_ACCOUNT_NUMBER': [r'\b[A-Z]{2}\d{2}(?: ?[A-Z0-9]){11,30}\b'],
+    'SWIFT_CODE': [r'\b[A-Z]{4}[A-Z]{2}[A-Z0-9]{2}(?:[A-Z0-9]{3})?\b'],
+}
+_PRE_SCREEN_VALIDATORS = {
+    'CREDIT_DEBIT_NUMBER': luhn_checksum_valid,
+}
+# keywords which values of the entity types are usually introduced with, values such as passwords or pins having no shape of
+# their own. The keywords of a type are matched at once, as a single case insensitive alternation
+_PRE_SCREEN_KEYWORDS = {
+    'EMAIL': ['email', 'e-mail'],
+    'PHONE': ['phone', 'telephone', 'tel', 'mobile', 'cell', 'fax'],
+    'SSN': ['ssn', 'social security'],
+    'CREDIT_DEBIT_NUMBER': ['credit card', 'debit card', 'card number', 'card no', 'visa', 'mastercard', 'amex'],
+    'CREDIT_DEBIT_CVV': ['cvv', 'cvv2', 'cvc', 'cvc2', 'security code'],
+    'CREDIT_DEBIT_EXPIRY': ['expiry', 'expiration', 'expires', 'exp date', 'valid thru'],
+    'BANK_ACCOUNT_NUMBER': ['account number', 'account no', 'acct', 'bank account'],
+    'BANK_ROUTING': ['routing', 'aba'],
+    'PASSWORD': ['password', 'passwd', 'pwd', 'passphrase', 'passcode'],
+    'USERNAME': ['username', 'user name', 'userid', 'user id', 'login'],
+    'PIN': ['pin'],
+    'PASSPORT_NUMBER': ['passport'],
+    'DRIVER_ID': ["driver's license", 'drivers license', 'driving licence', 'license number', 'licence number'],
+    'AWS_SECRET_KEY': ['aws_secret_access_key', 'secret access key', 'secret key'],
+}
+
+
+def _compile_pre_screen_rules() -> Dict[str, List[Tuple[Pattern, Optional[Callable[[str], bool]]]]]:
+    rules = {}
+    for entity_type in set(_PRE_SCREEN_PATTERNS) | set(_PRE_SCREEN_KEYWORDS):
+        validator = _PRE_SCREEN_VALIDATORS.get(entity_type)
+        type_rules = [(re.compile(pattern), validator) for pattern in _PRE_SCREEN_PATTERNS.get(entity_type, [])]
+        if entity_type in _PRE_SCREEN_KEYWORDS:
+            keywords = '|'.join(re.escape(keyword) for keyword in _PRE_SCREEN_KEYWORDS[entity_type])
+            type_rules.append((re.compile(rf'(?i:\b(?:{keywords})\b)'), None))
+        rules[entity_type] = type_rules
+    return rules
+
+
+_PRE_SCREEN_RULES = _compile_pre_screen_rules()
+
+
+class PiiPreScreen:
+    """
+    Screen segments locally for candidate pii before they are sent to comprehend for classification.
+
+    The entity types of interest which have a local pattern are looked for with regular expressions, along with the keywords
+    their values are usually introduced with. A segment without any candidate is clean, and the policy decides what happens to
+    it: SKIP doesn't send it to comprehend at all, DEPRIORITIZE sends it after the segments with candidates. Entity types such as
+    NAME or ADDRESS can't be screened for locally, so when they are of interest, ALL included, clean segments may still hold
+    pii and SKIP falls back to DEPRIORITIZE.
+    """
+
+    def __init__(self, pii_entity_types: List[str], policy: PII_PRE_SCREEN_POLICY_VALID_VALUES):
+        self.policy = policy
+        if ALL in pii_entity_types:
+            screened_types = list(_PRE_SCREEN_RULES)
+            self.unscreened_types = [ALL]
+        else:
+            screened_types = [entity_type for entity_type in pii_entity_types if entity_type in _PRE_SCREEN_RULES]
+            self.unscreened_types = [entity_type for entity_type in pii_entity_types if entity_type not in _PRE_SCREEN_RULES]
+        self.rules = [rule for entity_type in screened_types for rule in _PRE_SCREEN_RULES[entity_type]]
+        self.skips_clean_segments = policy is PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP and not self.unscreened_types
+        if policy is PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP and self.unscreened_types:
+            LOG.warning(f"Entity types {self.unscreened_types} can't be screened for locally, "
+                        f"clean segments are deprioritized instead of skipped")
+
+    def has_candidates(self, text: str) -> bool:
+        """Check whether given text holds a candidate value of any of the entity types of interest."""
+        for pattern, validator in self.rules:
+            if validator is None:
+                if pattern.search(text) is not None:
+                    return True
+            elif any(validator(match.group()) for match in pattern.finditer(text)):
+                return True
+        return False
+
+    def partition(self, segments: Iterable[Document]) -> Tuple[List[Document], List[Document]]:
+        """Split given segments into the ones holding candidate pii and the clean ones, both in their original order."""
+        candidates = []
+        clean = []
+        for segment in segments:
+            (candidates if self.has_candidates(segment.text) else clean).append(segment)
+        return candidates, clean
@@ -0,0 +1,160 @@
+"""Process-wide scheduler of the background work done by the lambda function handlers."""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+import lambdalogging
+from exceptions import TaskCancelledException
+
+LOG = lambdalogging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class CancellationToken:
+    """
+    Flag raised when the work done on behalf of a request should stop, e.g. because the request ran out of time.
+
+    Long running work checks the token between its steps, and callbacks registered on the token interrupt the work which can't
+    check it, such as cancelling queued tasks or closing a connection blocked on a read.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        """Return whether cancellation has been requested."""
+        return self._event.is_set()
+
+    def cancel(self):
+        """Request cancellation and run the registered callbacks."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                LOG.warning("Error occurred while running a cancellation callback", exc_info=True)
+
+    def add_callback(self, callback: Callable[[], None]):
+        """Register a callback to run on cancellation, running it right away if cancellation has already been requested."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        """Unregister a callback, if it hasn't run yet."""
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        """Raise TaskCancelledException if cancellation has been requested."""
+        if self._event.is_set():
+            raise TaskCancelledException()
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep for given number of seconds or until cancellation is requested, returning whether it was."""
+        return self._event.wait(timeout)
+
+
+class TaskGroup:
+    """
+    Tasks submitted to a shared pool on behalf of one request.
+
+    The pool outlives the request, so the group keeps track of the tasks it submitted in order to cancel the ones that haven't
+    started yet, and to wait for the ones that have, when the request is done with them. Once cancelled, the group refuses new
+    tasks. Used as a context manager, the group is cancelled and waited for when its block raises. A group created with a
+    cancellation token is cancelled along with it.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, cancellation_token: CancellationToken = None):
+        self.executor = executor
+        self.futures: List[Future] = []
+        self._cancelled = False
+        self._lock = threading.Lock()
+        if cancellation_token is not None:
+            cancellation_token.add_callback(self.cancel)
+
+    @property
+    def cancelled(self) -> bool:
+        """Return whether the group has been cancelled."""
+        return self._cancelled
+
+    def submit(self, function: Callable[..., T], *args, **kwargs) -> Future:
+        """Submit a task to the pool of the group and return its future."""
+        with self._lock:
+            if self._cancelled:
+                raise TaskCancelledException()
+            future = self.executor.submit(function, *args, **kwargs)
+            self.futures.append(future)
+            return future
+
+    def cancel(self) -> int:
+        """Cancel the tasks which haven't started yet and refuse new ones, returning the number of tasks still running."""
+        with self._lock:
+            self._cancelled = True
+            futures = list(self.futures)
+        return sum(not future.cancel() and not future.done() for future in futures)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait for the tasks of the group to complete, returning whether they all did within the timeout."""
+        with self._lock:
+            futures = list(self.futures)
+        return not wait(futures, timeout=timeout).not_done
+
+    def __enter__(self) -> 'TaskGroup':
+        """Return the group itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Cancel the group and wait for its running tasks when the block raised."""
+        if exc_type is not None:
+            self.cancel()
+            self.wait()
+
+
+class Scheduler:
+    """
+    Long-lived worker pools shared by every request served by the Lambda execution environment.
+
+    Creating a thread pool per call spawns and tears down threads on every request. Pools are instead created on first use and
+    kept for the life of the process, keyed by name and size, so that a warm container reuses the threads of the previous
+    invocations. Requests submit their work through task groups, which scope cancellation to the request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools: Dict[Tuple[str, int], ThreadPoolExecutor] = {}
+
+    def pool(self, name: str, max_workers: int) -> ThreadPoolExecutor:
+        """Return the pool of given name and size, creating it on first use."""
+        key = (name, max_workers)
+        with self._lock:
+            if key not in self._pools:
+                LOG.debug(f"Creating pool {name} of {max_workers} workers")
+                self._pools[key] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            return self._pools[key]
+
+    def task_group(self, name: str, max_workers: int, cancellation_token: CancellationToken = None) -> TaskGroup:
+        """Return a new task group running on the pool of given name and size, cancelled along with given token."""
+        return TaskGroup(self.pool(name, max_workers), cancellation_token)
+
+    def shutdown(self, wait: bool = True):
+        """Shut down and forget all the pools."""
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.shutdown(wait=wait)
+
+
+SCHEDULER = Scheduler()
@@ -0,0 +1,178 @@
+"""Choice of the sizes of the segments sent to comprehend, per request."""
+import math
+import threading
+from typing import NamedTuple, Optional
+
+import lambdalogging
+from config import DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES, DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES, MAX_CHARS_OVERLAP, \
+    SEGMENT_PLAN_MAX_EXTRA_UNITS
+from constants import COMPREHEND_BILLING_UNIT_SIZE, COMPREHEND_MIN_BILLED_UNITS, COMPREHEND_BASE_LATENCY_PRIOR, \
+    COMPREHEND_LATENCY_PER_CHAR_PRIOR, MIN_PLANNED_SEGMENT_SIZE
+
+LOG = lambdalogging.getLogger(__name__)
+
+
+class LatencyModel:
+    """
+    Latency of the calls to a comprehend api as a function of the number of characters they send, learnt from the calls made.
+
+    The latency is modelled as a fixed cost per call plus a cost per character, fitted by least squares on exponentially weighted
+    moving averages of the sizes and latencies observed, so that the model follows the service as it speeds up or slows down.
+    As long as the calls observed are about the same size, which they are when segments are cut to the same size, the cost per
+    character can't be fitted and the prior one is used, the fixed cost being fitted to the latencies observed.
+    """
+
+    def __init__(self, base_latency: float = COMPREHEND_BASE_LATENCY_PRIOR, latency_per_char: float = COMPREHEND_LATENCY_PER_CHAR_PRIOR,
+                 smoothing: float = 0.1):
+        self.base_latency = base_latency
+        self.latency_per_char = latency_per_char
+        self.smoothing = smoothing
+        self.sample_count = 0
+        self._mean_size = 0.0
+        self._mean_latency = 0.0
+        self._size_variance = 0.0
+        self._covariance = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, size: int, latency: float):
+        """Add the latency in milliseconds of a call which sent given number of characters."""
+        with self._lock:
+            self.sample_count += 1
+            if self.sample_count == 1:
+                self._mean_size, self._mean_latency = float(size), float(latency)
+                return
+            size_delta = size - self._mean_size
+            latency_delta = latency - self._mean_latency
+            self._mean_size += self.smoothing * size_delta
+            self._mean_latency += self.smoothing * latency_delta
+            self._size_variance = (1 - self.smoothing) * (self._size_variance + self.smoothing * size_delta * size_delta)
+            self._covariance = (1 - self.smoothing) * (self._covariance + self.smoothing * size_delta * latency_delta)
+
+    def estimate(self, size: int) -> float:
+        """Return the expected latency in milliseconds of a call sending given number of characters."""
+        with self._lock:
+            if self.sample_count == 0:
+                return self.base_latency + self.latency_per_char * size
+            latency_per_char = self.latency_per_char
+            # sizes spread by less than a tenth of their mean don't tell the cost per character apart from noise
+            if self._size_variance > (0.1 * self._mean_size) ** 2:
+                latency_per_char = max(0.0, self._covariance / self._size_variance)
+            base_latency = max(0.0, self._mean_latency - latency_per_char * self._mean_size)
+            return base_latency + latency_per_char * size
+
+
+class StagePlan(NamedTuple):
+    """Segments of one kind of comprehend call planned for a text, sizes in characters and times in milliseconds."""
+
+    segment_size: int
+    segment_count: int
+    billed_units: int
+    estimated_time: float
+
+
+class SegmentPlan(NamedTuple):
+    """Sizes in bytes of the segments to classify and to detect entities in, along with what they are expected to cost."""
+
+    classification_size: int
+    detection_size: int
+    classification: Optional[StagePlan]
+    detection: Optional[StagePlan]
+    min_billed_units: int
+
+    @property
+    def billed_units(self) -> int:
+        """Return the number of units billed by comprehend for the calls of the plan."""
+        return sum(stage.billed_units for stage in (self.classification, self.detection) if stage is not None)
+
+    @property
+    def estimated_time(self) -> float:
+        """Return the expected time in milliseconds taken by the calls of the plan."""
+        return sum(stage.estimated_time for stage in (self.classification, self.detection) if stage is not None)
+
+
+def billed_units(size: int) -> int:
+    """Return the number of units comprehend bills for a call sending given number of characters."""
+    return max(math.ceil(size / COMPREHEND_BILLING_UNIT_SIZE), COMPREHEND_MIN_BILLED_UNITS)
+
+
+def _stage_plan(text_length: int, segment_size: int, overlap_size: int, latency: LatencyModel, concurrency: int) -> StagePlan:
+    if text_length <= segment_size:
+        return StagePlan(text_length, 1, billed_units(text_length), latency.estimate(text_length))
+    # every segment after the first one repeats the overlap of the previous one
+    segment_count = math.ceil((text_length - overlap_size) / (segment_size - overlap_size))
+    last_segment_size = text_length - (segment_count - 1) * (segment_size - overlap_size)
+    units = (segment_count - 1) * billed_units(segment_size) + billed_units(last_segment_size)
+    rounds = math.ceil(segment_count / concurrency)
+    return StagePlan(segment_size, segment_count, units, rounds * latency.estimate(segment_size))
+
+
+def _plan_stage(text_length: int, max_size: int, overlap_size: int, latency: LatencyModel, concurrency: int,
+                max_units: Optional[int]) -> StagePlan:
+    """
+    Return the fastest plan of the segments of a text billed at most max_units, or the fastest plan at all without max_units.
+
+    The candidates are the largest segments, which are billed the least, and the segments cut to keep every thread busy for one
+    round of calls, two rounds, and so on down to MIN_PLANNED_SEGMENT_SIZE. Sizes are rounded up to whole billing units.
+    """
+    def candidate(segment_count: int) -> StagePlan:
+        size = math.ceil((text_length - overlap_size) / segment_count) + overlap_size if segment_count > 1 else text_length
+        size = COMPREHEND_BILLING_UNIT_SIZE * math.ceil(size / COMPREHEND_BILLING_UNIT_SIZE)
+        return _stage_plan(text_length, max(min(size, max_size), min_size), overlap_size, latency, concurrency)
+
+    min_size = min(max(MIN_PLANNED_SEGMENT_SIZE, 5 * overlap_size), max_size)
+    largest = _stage_plan(text_length, max_size, overlap_size, latency, concurrency)
+    candidates = [largest] + [candidate(segment_count) for segment_count in range(concurrency, math.ceil(text_length / min_size) + 1,
+                                                                                  concurrency)]
+    affordable = [plan for plan in candidates if max_units is None or plan.billed_units <= max_units] or [largest]
+    return min(affordable, key=lambda plan: (plan.estimated_time, plan.billed_units))
+
+
+def plan_segment_sizes(text_length: int, bytes_per_char: float, classification_latency: LatencyModel,
+                       detection_latency: LatencyModel, classification_concurrency: int, detection_concurrency: int,
+                       remaining_time: Optional[int] = None, classify: bool = True, detect_entities: bool = True,
+                       max_classification_size: int = DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES,
+                       max_detection_size: int = DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES, overlap_size: int = MAX_CHARS_OVERLAP,
+                       max_extra_units: float = SEGMENT_PLAN_MAX_EXTRA_UNITS) -> SegmentPlan:
+    """
+    Plan the sizes of the segments of a text of given length, to classify it and to detect the entities of its segments with pii.
+
+    Smaller segments are sent in parallel and each of them comes back sooner, but comprehend bills every call by units of
+    COMPREHEND_BILLING_UNIT_SIZE characters, with a minimum per call, and segments repeat the overlap of the previous one, so
+    they cost more units. Each stage gets the fastest segments, given the latency observed for its api and the number of calls
+    allowed in flight, which are billed at most max_extra_units more than the largest segments allowed. If that plan isn't
+    expected to complete in the remaining time, the fastest segments are planned whatever they cost. Entity detection is
+    planned as if every segment had pii, and its segments are never larger than the classification ones. The maximum sizes are
+    in bytes like the sizes planned, which are converted from characters with the average bytes_per_char of the text. A text
+    sent in a single segment is planned the maximum size, which it fits in whatever its length.
+    """
+    def to_chars(size: int) -> int:
+        return max(int(size / bytes_per_char), 1)
+
+    def to_bytes(stage: StagePlan, max_size: int) -> int:
+        return max_size if stage.segment_count == 1 else min(int(stage.segment_size * bytes_per_char), max_size)
+
+    def plan_stage(max_size: int, latency: LatencyModel, concurrency: int, cost_bound: bool) -> StagePlan:
+        max_units = math.floor((1 + max_extra_units) * _stage_plan(text_length, max_size, overlap_size, latency, concurrency).billed_units)
+        return _plan_stage(text_length, max_size, overlap_size, latency, concurrency, max_units if cost_bound else None)
+
+    def plan_stages(cost_bound: bool) -> SegmentPlan:
+        classification = None
+        classification_size = max_classification_size
+        if classify:
+            classification = plan_stage(to_chars(max_classification_size), classification_latency, classification_concurrency,
+                                        cost_bound)
+            classification_size = to_bytes(classification, max_classification_size)
+        detection = None
+        detection_size = max_detection_size
+        if detect_entities:
+            detection = plan_stage(to_chars(min(max_detection_size, classification_size)), detection_latency, detection_concurrency,
+                                   cost_bound)
+            detection_size = to_bytes(detection, min(max_detection_size, classification_size))
+        min_units = (classify + detect_entities) * billed_units(text_length)
+        return SegmentPlan(classification_size, detection_size, classification, detection, min_units)
+
+    plan = plan_stages(cost_bound=True)
+    if remaining_time is not None and plan.estimated_time > remaining_time:
+        LOG.debug(f"Segments billed near the lower bound take {plan.estimated_time:.0f} ms, more than the {remaining_time} ms left")
+        plan = plan_stages(cost_bound=False)
+    return plan
@@ -0,0 +1,84 @@
+"""Support for processing objects spilled to disk instead of being held in memory."""
+import codecs
+import mmap
+import tempfile
+from array import array
+from typing import BinaryIO
+
+from config import SPILL_DIRECTORY
+
+
+def spill_file() -> BinaryIO:
+    """Return a new temporary file in SPILL_DIRECTORY, deleted once closed."""
+    return tempfile.TemporaryFile(dir=SPILL_DIRECTORY or None)
+
+
+class MappedText:
+    """
+    Utf-8 text of a file, memory mapped and decoded a slice at a time.
+
+    The text reads like a str of the characters of the file, whose slices are decoded on demand, so that a text larger than the
+    memory of the function can be processed a window at a time. The file is scanned once to index the byte offset of every
+    BLOCK_SIZE-th character, which takes 8 bytes per block, and a slice then only decodes the blocks it starts and ends in on top
+    of its own bytes. The text owns the file, which is closed and deleted along with it.
+    """
+
+    BLOCK_SIZE = 4096
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        file.flush()
+        file.seek(0, 2)
+        self.byte_size = file.tell()
+        # an empty file can't be mapped
+        self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self.byte_size else b''
+        self.block_byte_offsets = array('q', [0])
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        remaining_chars = ''
+        for start in range(0, self.byte_size, self.READ_SIZE):
+            is_last_read = start + self.READ_SIZE >= self.byte_size
+            chars = remaining_chars + decoder.decode(self.mmap[start:start + self.READ_SIZE], final=is_last_read)
+            whole_blocks = len(chars) - len(chars) % self.BLOCK_SIZE
+            for block_start in range(0, whole_blocks, self.BLOCK_SIZE):
+                block_size = len(chars[block_start:block_start + self.BLOCK_SIZE].encode('utf-8'))
+                self.block_byte_offsets.append(self.block_byte_offsets[-1] + block_size)
+            remaining_chars = chars[whole_blocks:]
+        self.length = (len(self.block_byte_offsets) - 1) * self.BLOCK_SIZE + len(remaining_chars)
+
+    def __len__(self) -> int:
+        """Return the number of characters of the text."""
+        return self.length
+
+    def byte_offset(self, char_offset: int) -> int:
+        """Return the offset in the file at which the character at given offset starts."""
+        if char_offset >= self.length:
+            return self.byte_size
+        block = char_offset // self.BLOCK_SIZE
+        block_start = self.block_byte_offsets[block]
+        block_end = self.block_byte_offsets[block + 1] if block + 1 < len(self.block_byte_offsets) else self.byte_size
+        block_text = self.mmap[block_start:block_end].decode('utf-8')
+        return block_start + len(block_text[:char_offset - block * self.BLOCK_SIZE].encode('utf-8'))
+
+    def __getitem__(self, key: slice) -> str:
+        """Return the characters of given slice of the text."""
+        begin, end, step = key.indices(self.length)
+        if step != 1:
+            raise ValueError("Only contiguous slices of a mapped text are supported")
+        if begin >= end:
+            return ''
+        return self.mmap[self.byte_offset(begin):self.byte_offset(end)].decode('utf-8')
+
+    def close(self):
+        """Unmap and delete the file."""
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+        self.file.close()
+
+    def __enter__(self) -> 'MappedText':
+        """Return the text itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the text."""
+        self.close()
@@ -1,26 +1,58 @@
 """Utility Class."""
-import concurrent
+import time
 from concurrent.futures._base import TimeoutError
 
 import lambdalogging
-from exceptions import TimeoutException
+from constants import REQUEST_POOL, REQUEST_POOL_THREAD_COUNT
+from exceptions import DeadlineExceededException, TimeoutException
+from scheduler import SCHEDULER, CancellationToken
 
 LOG = lambdalogging.getLogger(__name__)
 
 
-def execute_task_with_timeout(timeout_in_millis, task):
+class Deadline:
+    """
+    Point in time by which the work done for a request has to be complete.
+
+    The deadline is handed down to every step of the request, which derive the timeouts of their calls from it and refuse to
+    start work which can't complete in the remaining time. A request which is going to run out of time then fails fast with a
+    precise error, instead of spending its whole budget first.
+    """
+
+    def __init__(self, timeout_in_millis: int):
+        self.expiry_time = time.monotonic() + timeout_in_millis / 1000
+
+    def remaining_time_in_millis(self) -> int:
+        """Return the time left before the deadline in milliseconds, 0 once it has passed."""
+        return max(0, int((self.expiry_time - time.monotonic()) * 1000))
+
+    def timeout(self, max_timeout_in_sec: float) -> float:
+        """Return the timeout in seconds of a call which may take at most given time, but mustn't run past the deadline."""
+        return max(0.0, min(max_timeout_in_sec, self.expiry_time - time.monotonic()))
+
+    def check(self, operation: str, required_time_in_millis: int = 0):
+        """Raise DeadlineExceededException unless more than given time is left to perform given operation."""
+        remaining_time_in_millis = self.remaining_time_in_millis()
+        if remaining_time_in_millis <= required_time_in_millis:
+            raise DeadlineExceededException(operation, remaining_time_in_millis)
+
+
+def execute_task_with_timeout(timeout_in_millis, task, cancellation_token: CancellationToken = None):
     """
     Execute a given task within a given time limit.
     :param timeout_in_millis: milliseconds to timeout
     :param task: task to execute
+    :param cancellation_token: token checked by the task, cancelled when the time limit is exceeded
     :raise: TimeoutException
     """
-    timeout_in_sec = int(timeout_in_millis / 1000)
+    timeout_in_sec = timeout_in_millis / 1000
+    tasks = SCHEDULER.task_group(REQUEST_POOL, REQUEST_POOL_THREAD_COUNT, cancellation_token)
+    future_result = tasks.submit(task)
     try:
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        future_result = executor.submit(task)
         return future_result.result(timeout=timeout_in_sec)
     except TimeoutError:
-        # Free up the resources
-        executor.shutdown(wait=False)
+        # the pool is shared with the next invocations, so the task is told to stop rather than the pool shut down
+        tasks.cancel()
+        if cancellation_token is not None:
+            cancellation_token.cancel()
         raise TimeoutException()
@@ -0,0 +1,27 @@
+from benchmark.benchmark_base import BaseBenchmark
+from benchmark.stand_ins import PII_PATTERNS
+from handler import pii_access_control_handler
+
+
+class PiiAccessControlBenchmark(BaseBenchmark):
+    PAYLOAD = {"pii_entity_types": ["ALL"]}
+
+    def verify_response(self, response: dict, pii_density: float) -> int:
+        if response['status_code'] == 200:
+            return sum(len(pattern.findall(response['body'].decode('utf-8'))) for _, pattern in PII_PATTERNS)
+        assert response['status_code'] == 403, response
+        return 0
+
+    def test_access_control_with_varying_file_sizes(self):
+        variations = [(1, 0.1),
+                      (5, 0.0),
+                      (5, 0.1),
+                      (50, 0.0),
+                      (50, 0.1),
+                      (1000, 0.0),
+                      (1000, 0.1),
+                      (1500, 0.0),
+                      (1500, 0.1)
+                      ]
+        for file_size, pii_density in variations:
+            self.run_variation(pii_access_control_handler, file_size, pii_density)
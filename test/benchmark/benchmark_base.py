@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import random
+import resource
+import time
+import zlib
+from copy import deepcopy
+from statistics import quantiles
+from unittest import TestCase
+from unittest.mock import patch
+
+from benchmark.stand_ins import StandInServer
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'data')
+WORDS = ("the of and to in is that for it as was with be by on not he this are or his from at which but have an they you were her "
+         "she there been one all we their has would when if so no will more can its who about some what into time only other new "
+         "could these two may first then do any like my now over such our man me even most made after also did many before must "
+         "through back years where much your way well down should because each just those people how too little state good very "
+         "make world still own see men work long get here between both life being under never day same another know while last "
+         "might us great old year off come since against go came right used take three").split()
+PII_SENTENCES = ["My social security number is {:03d}-{:02d}-{:04d}.",
+                 "Please charge the card {:04d}-{:04d}-{:04d}-{:04d} for the order.",
+                 "Call me back at {:03d}-{:03d}-{:04d} after lunch.",
+                 "Send the statement to user{}@example.com today."]
+
+
+class LambdaContext:
+    """Stand-in for the context object lambda passes to the function handlers."""
+
+    def __init__(self, timeout_in_millis: int):
+        self.deadline = time.time() + timeout_in_millis / 1000
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self.deadline - time.time()) * 1000)
+
+
+class BaseBenchmark(TestCase):
+    """
+    Drive a lambda function handler end to end against local stand-ins for s3 and comprehend, no aws account needed.
+
+    Every invocation downloads a different generated object, so neither the result cache nor the segment cache turn the
+    benchmark into a cache benchmark.
+    """
+
+    ITERATIONS = int(os.getenv('BENCHMARK_ITERATIONS', 10))
+    S3_LATENCY = float(os.getenv('BENCHMARK_S3_LATENCY', 0.01))
+    COMPREHEND_LATENCY = float(os.getenv('BENCHMARK_COMPREHEND_LATENCY', 0.05))
+    COMPREHEND_TPS = float(os.getenv('BENCHMARK_COMPREHEND_TPS')) if os.getenv('BENCHMARK_COMPREHEND_TPS') else None
+    LAMBDA_TIMEOUT_MILLIS = 60000
+    PAYLOAD = {}
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.server = StandInServer(s3_latency=cls.S3_LATENCY, comprehend_latency=cls.COMPREHEND_LATENCY,
+                                   comprehend_tps=cls.COMPREHEND_TPS).start()
+        cls.patches = [patch('handler.S3_ENDPOINT_URL', cls.server.endpoint_url),
+                       patch('handler.COMPREHEND_ENDPOINT_URL', cls.server.endpoint_url)]
+        for endpoint_patch in cls.patches:
+            endpoint_patch.start()
+        with open(os.path.join(DATA_PATH, 'sample_event.json'), 'r') as file_pointer:
+            cls.sample_event = json.load(file_pointer)
+        cls.results = []
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        for endpoint_patch in cls.patches:
+            endpoint_patch.stop()
+        cls.server.stop()
+        logging.info("Benchmark results:\n" + cls.format_results(cls.results))
+        if os.getenv('BENCHMARK_OUTPUT'):
+            with open(os.getenv('BENCHMARK_OUTPUT'), 'w') as file_pointer:
+                json.dump(cls.results, file_pointer, indent=2)
+        super().tearDownClass()
+
+    @staticmethod
+    def generate_text(size_in_kb: int, pii_density: float, seed: int) -> str:
+        """Generate a text of about given size in which given fraction of the sentences contain pii."""
+        rand = random.Random(seed)
+        sentences = []
+        size = 0
+        while size < size_in_kb * 1000:
+            if rand.random() < pii_density:
+                template = rand.choice(PII_SENTENCES)
+                sentence = template.format(*(rand.randint(0, 999) for _ in range(template.count('{'))))
+            else:
+                sentence = ' '.join(rand.choice(WORDS) for _ in range(rand.randint(5, 20))).capitalize() + '.'
+            sentences.append(sentence)
+            size += len(sentence) + 1
+        return ' '.join(sentences)
+
+    def create_event(self, object_url: str, request_token: str) -> dict:
+        event = deepcopy(self.sample_event)
+        event['getObjectContext']['inputS3Url'] = object_url
+        event['getObjectContext']['outputToken'] = request_token
+        event['configuration']['payload'] = json.dumps(self.PAYLOAD)
+        event['userRequest']['headers'] = {}
+        return event
+
+    def run_variation(self, handler, file_size: int, pii_density: float) -> dict:
+        logging.info(f"Running benchmark for {file_size} KB files where {pii_density * 100}% of the sentences contain pii")
+        events = []
+        for i in range(self.ITERATIONS):
+            name = f"{self.id()}_{file_size}_{pii_density}_{i}"
+            content = self.generate_text(file_size, pii_density, seed=zlib.crc32(name.encode('utf-8'))).encode('utf-8')
+            events.append(self.create_event(self.server.put_object(name, content), name))
+        self.server.reset_counters()
+
+        latencies = []
+        leaked_pii = 0
+        start_time = time.time()
+        for event in events:
+            invocation_start_time = time.time()
+            handler(event, LambdaContext(self.LAMBDA_TIMEOUT_MILLIS))
+            latencies.append((time.time() - invocation_start_time) * 1000)
+            response = self.server.write_get_object_responses.pop(event['getObjectContext']['outputToken'])
+            leaked_pii += self.verify_response(response, pii_density)
+        elapsed_time = time.time() - start_time
+
+        percentiles = quantiles(latencies, n=100, method='inclusive')
+        result = {'file_size_kb': file_size, 'pii_density': pii_density, 'iterations': self.ITERATIONS,
+                  'p50_ms': round(percentiles[49], 1), 'p95_ms': round(percentiles[94], 1), 'p99_ms': round(percentiles[98], 1),
+                  'throughput_per_s': round(self.ITERATIONS / elapsed_time, 2),
+                  'throughput_kb_per_s': round(self.ITERATIONS * file_size / elapsed_time, 1),
+                  # ru_maxrss is in kilobytes on linux. It is the peak of the whole process so far, so variations should be run from
+                  # the smallest to the largest file
+                  'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                  'leaked_pii': leaked_pii, 'api_calls': dict(self.server.api_calls),
+                  'throttled_calls': dict(self.server.throttled_calls)}
+        logging.info(json.dumps(result))
+        self.results.append(result)
+        return result
+
+    def verify_response(self, response: dict, pii_density: float) -> int:
+        """Check the response written back to s3 and return the number of pii entities it leaked."""
+        raise NotImplementedError
+
+    @staticmethod
+    def format_results(results) -> str:
+        columns = ['file_size_kb', 'pii_density', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_per_s', 'throughput_kb_per_s', 'peak_rss_mb',
+                   'leaked_pii']
+        lines = [' | '.join(f"{column:>19}" for column in columns)]
+        for result in results:
+            lines.append(' | '.join(f"{result[column]:>19}" for column in columns))
+        return '\n'.join(lines)
@@ -0,0 +1,16 @@
+"""Setup benchmark environment."""
+
+import os
+import sys
+
+# the configuration is read when the app code is imported, so it has to be in place before the benchmarks import it
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('PUBLISH_CLOUD_WATCH_METRICS', 'false')
+os.environ.setdefault('DOCUMENT_MAX_SIZE', str(2 * 1024 * 1024))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+# make sure benchmarks can import the app code
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, my_path + '/../../src/')
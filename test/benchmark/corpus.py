@@ -0,0 +1,45 @@
+import random
+import re
+
+from constants import BEGIN_OFFSET, END_OFFSET, ENTITY_TYPE, SCORE
+
+ASCII_WORDS = ("the of and to in is that for it as was with be by on not he this are or his from at which but have an they you "
+               "were her she there been one all we their has would when if so no will more can its who about some what into time "
+               "only other new could these two may first then do any like my now over such our man me even most made after").split()
+MULTIBYTE_WORDS = ("naïve café résumé über straße façade piñata 東京 大阪 北京 上海 서울 부산 москва привет γειά σου 😀 🎉 🚀 ✓ "
+                   "zürich señor coöperate").split()
+BLOB_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+ENTITY_RE = re.compile(r'\b\d{3}-\d{2}-\d{4}\b')
+
+# the kinds of text the processors are benchmarked with, with the fraction of words which are pii entities
+KINDS = {
+    'ascii': 0.01,
+    'multibyte': 0.01,
+    'blob': 0.0,
+    'dense': 0.3,
+}
+
+
+def generate_text(kind: str, size: int, seed: int = 0) -> str:
+    """Generate about `size` characters of given kind of text."""
+    rand = random.Random(seed)
+    if kind == 'blob':
+        return ''.join(rand.choices(BLOB_ALPHABET, k=size))
+    words = MULTIBYTE_WORDS + ASCII_WORDS if kind == 'multibyte' else ASCII_WORDS
+    entity_fraction = KINDS[kind]
+    parts = []
+    length = 0
+    while length < size:
+        if rand.random() < entity_fraction:
+            word = f"{rand.randint(100, 999)}-{rand.randint(10, 99)}-{rand.randint(1000, 9999)}"
+        else:
+            word = rand.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return ' '.join(parts)
+
+
+def find_entities(text: str, offset: int = 0):
+    """Return the pii entities comprehend would find in given text, relative to given offset."""
+    return [{ENTITY_TYPE: 'SSN', SCORE: 0.9, BEGIN_OFFSET: match.start() - offset, END_OFFSET: match.end() - offset}
+            for match in ENTITY_RE.finditer(text)]
@@ -0,0 +1,100 @@
+import gc
+import json
+import logging
+import os
+import time
+from statistics import median
+from unittest import TestCase
+
+
+def _calibration_workload():
+    total = 0
+    words = []
+    for i in range(200000):
+        total += i * i % 7
+        words.append(str(i))
+    return total, ' '.join(words)
+
+
+class BaseMicrobenchmark(TestCase):
+    """
+    Time pure cpu functions and compare the timings against baselines recorded in a json file.
+
+    Timings are normalized by the time a fixed calibration workload takes on the same machine right before, so that baselines
+    recorded on one machine remain meaningful on another, and on a machine whose speed drifts. A benchmark fails when its
+    normalized time exceeds the baseline by more than BENCHMARK_TOLERANCE. Benchmarks without a baseline, and benchmarks whose
+    fastest run takes less than MIN_CHECKED_TIME, which timer resolution and scheduling noise dominate, only report their
+    timing. Baselines are (re)recorded by running with BENCHMARK_UPDATE_BASELINE=true.
+    """
+
+    BASELINE_FILE = None
+    TOLERANCE = float(os.getenv('BENCHMARK_TOLERANCE', 0.5))
+    UPDATE_BASELINE = os.getenv('BENCHMARK_UPDATE_BASELINE', 'false').lower() == 'true'
+    MIN_TIME = 0.2
+    MIN_CHECKED_TIME = 0.01
+    MIN_REPEATS = 3
+    MAX_REPEATS = 100
+    ATTEMPTS = 3
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        cls.baselines = {}
+        if os.path.exists(cls.BASELINE_FILE):
+            with open(cls.BASELINE_FILE, 'r') as file_pointer:
+                cls.baselines = json.load(file_pointer)
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if cls.UPDATE_BASELINE:
+            with open(cls.BASELINE_FILE, 'w') as file_pointer:
+                json.dump(dict(sorted({**cls.baselines, **cls.results}.items())), file_pointer, indent=2)
+                file_pointer.write('\n')
+            logging.info(f"Recorded {len(cls.results)} baselines in {cls.BASELINE_FILE}")
+        super().tearDownClass()
+
+    @staticmethod
+    def _time_once(setup, function) -> float:
+        arguments = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start_time = time.perf_counter()
+            function(*arguments) if arguments is not None else function()
+            return time.perf_counter() - start_time
+        finally:
+            gc.enable()
+
+    def _measure_once(self, setup, function):
+        calibration_time = min(self._time_once(lambda: None, _calibration_workload) for _ in range(self.MIN_REPEATS))
+        timings = []
+        while len(timings) < self.MIN_REPEATS or (len(timings) < self.MAX_REPEATS and sum(timings) < self.MIN_TIME):
+            timings.append(self._time_once(setup, function))
+        return min(timings), min(timings) / calibration_time
+
+    def measure(self, name: str, setup, function):
+        """
+        Time function called with the arguments returned by setup, which isn't timed, and check it against its baseline.
+
+        The function is run at least MIN_REPEATS times, and then up to MAX_REPEATS times until MIN_TIME has elapsed. The fastest
+        run is kept, with the garbage collector disabled while the function runs. Shared machines are noisy, so a measurement
+        beyond the tolerance is taken again up to ATTEMPTS times before failing, and a baseline is the median of ATTEMPTS
+        measurements.
+        """
+        measurements = []
+        baseline = self.baselines.get(name)
+        checked = False
+        while len(measurements) < self.ATTEMPTS:
+            best_time, normalized_time = self._measure_once(setup, function)
+            measurements.append(normalized_time)
+            checked = baseline is not None and best_time >= self.MIN_CHECKED_TIME
+            comparison = f", {(normalized_time / baseline - 1) * 100:+.0f}% against baseline" if baseline else ""
+            reported_only = "" if checked or not baseline else ", too short to be checked"
+            logging.info(f"{name}: {best_time * 1000:.2f} ms ({normalized_time:.4g} normalized{comparison}{reported_only})")
+            if not self.UPDATE_BASELINE and (not checked or normalized_time <= baseline * (1 + self.TOLERANCE)):
+                break
+        self.results[name] = float(f"{median(measurements):.4g}")
+        if checked and not self.UPDATE_BASELINE:
+            self.assertLessEqual(min(measurements), baseline * (1 + self.TOLERANCE),
+                                 f"{name} regressed: {min(measurements):.4g} against a baseline of {baseline:.4g}")
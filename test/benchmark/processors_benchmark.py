@@ -0,0 +1,63 @@
+import os
+from functools import lru_cache
+
+from benchmark.corpus import KINDS, find_entities, generate_text
+from benchmark.microbenchmark_base import BaseMicrobenchmark
+from config import DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES
+from data_object import Document, EntityStore, RedactionConfig
+from processors import Redactor, Segmenter
+
+SIZES = {'1KB': 1000, '100KB': 100 * 1000, '1MB': 1000 * 1000, '10MB': 10 * 1000 * 1000}
+
+
+@lru_cache(maxsize=None)
+def _text(kind: str, size: str) -> str:
+    return generate_text(kind, SIZES[size], seed=len(kind) * 31 + SIZES[size])
+
+
+@lru_cache(maxsize=None)
+def _segments(kind: str, size: str):
+    # segments annotated the way comprehend would, with the entity offsets relative to the segments
+    return [(segment.text, segment.char_offset, find_entities(segment.text))
+            for segment in Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES).segment(_text(kind, size))]
+
+
+class ProcessorsMicrobenchmark(BaseMicrobenchmark):
+    """Microbenchmarks of the cpu bound hot paths of the redaction, which are run on every segment and every document."""
+
+    BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'processors_baseline.json')
+
+    def _cases(self):
+        for kind in KINDS:
+            for size in SIZES:
+                yield kind, size
+
+    def test_segment(self):
+        segmenter = Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES)
+        for kind, size in self._cases():
+            with self.subTest(kind=kind, size=size):
+                text = _text(kind, size)
+                self.measure(f"segment/{kind}/{size}", lambda: (text,), segmenter.segment)
+
+    def test_de_segment(self):
+        segmenter = Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES)
+        for kind, size in self._cases():
+            with self.subTest(kind=kind, size=size):
+                segments = _segments(kind, size)
+
+                def setup():
+                    return [Document(text, char_offset=char_offset, pii_entities=EntityStore.from_entities(entities))
+                            for text, char_offset, entities in segments],
+
+                document = segmenter.de_segment(setup()[0])
+                assert document.text == _text(kind, size)
+                self.measure(f"de_segment/{kind}/{size}", setup, segmenter.de_segment)
+
+    def test_redact(self):
+        redactor = Redactor(RedactionConfig())
+        for kind, size in self._cases():
+            with self.subTest(kind=kind, size=size):
+                text = _text(kind, size)
+                # the redactor is handed the entity store de_segment returns
+                entities = EntityStore.from_entities(find_entities(text))
+                self.measure(f"redact/{kind}/{size}", lambda: (text, entities), redactor.redact)
@@ -0,0 +1,27 @@
+from benchmark.benchmark_base import BaseBenchmark
+from benchmark.stand_ins import PII_PATTERNS
+from handler import redact_pii_documents_handler
+
+
+class PiiRedactionBenchmark(BaseBenchmark):
+    PAYLOAD = {"pii_entity_types": ["ALL"], "mask_mode": "MASK", "mask_character": "*"}
+
+    def verify_response(self, response: dict, pii_density: float) -> int:
+        assert response['status_code'] == 200, response
+        redacted_text = response['body'].decode('utf-8')
+        return sum(len(pattern.findall(redacted_text)) for _, pattern in PII_PATTERNS)
+
+    def test_redaction_with_varying_file_sizes(self):
+        variations = [(1, 0.1),
+                      (5, 0.0),
+                      (5, 0.1),
+                      (50, 0.0),
+                      (50, 0.1),
+                      (50, 0.5),
+                      (1000, 0.0),
+                      (1000, 0.1),
+                      (1500, 0.0),
+                      (1500, 0.1)
+                      ]
+        for file_size, pii_density in variations:
+            self.run_variation(redact_pii_documents_handler, file_size, pii_density)
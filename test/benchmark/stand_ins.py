@@ -0,0 +1,175 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# patterns standing in for the pii that comprehend would find, with the entity type reported for each
+PII_PATTERNS = [
+    ('SSN', re.compile(r'\b\d{3}-\d{2}-\d{4}\b')),
+    ('CREDIT_DEBIT_NUMBER', re.compile(r'\b\d{4}-\d{4}-\d{4}-\d{4}\b')),
+    ('PHONE', re.compile(r'\b\d{3}-\d{3}-\d{4}\b')),
+    ('EMAIL', re.compile(r'\b[\w.]+@[\w.]+\.\w+\b')),
+]
+PII_SCORE = 0.99
+
+
+class TokenBucket:
+    """Rate limiter letting through `rate` calls per second on average, with bursts of up to `rate` calls."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class StandInServer:
+    """
+    Local http server standing in for the services the lambda functions call.
+
+    It serves objects through fake presigned urls, records the WriteGetObjectResponse calls, and answers comprehend's
+    ContainsPiiEntities and DetectPiiEntities apis by matching a few regular expressions. Latency can be added to every call, and
+    comprehend calls beyond `comprehend_tps` per api and second are throttled like the real service does.
+    """
+
+    def __init__(self, s3_latency: float = 0.0, comprehend_latency: float = 0.0, comprehend_tps: float = None):
+        self.s3_latency = s3_latency
+        self.comprehend_latency = comprehend_latency
+        self.comprehend_tps = comprehend_tps
+        self.objects = {}
+        self.write_get_object_responses = {}
+        self.api_calls = {}
+        self.throttled_calls = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def endpoint_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _request_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def put_object(self, name: str, content: bytes) -> str:
+        """Store an object and return a fake presigned url to download it."""
+        self.objects[name] = content
+        return f"{self.endpoint_url}/objects/{name}?X-Amz-SignedHeaders=host&X-Amz-Signature=0"
+
+    def reset_counters(self):
+        with self._lock:
+            self.api_calls.clear()
+            self.throttled_calls.clear()
+            self._buckets.clear()
+
+    def _count(self, counters: dict, api: str):
+        with self._lock:
+            counters[api] = counters.get(api, 0) + 1
+
+    def _is_throttled(self, api: str) -> bool:
+        if self.comprehend_tps is None:
+            return False
+        with self._lock:
+            bucket = self._buckets.setdefault(api, TokenBucket(self.comprehend_tps))
+        return not bucket.try_acquire()
+
+
+def _find_pii(text: str):
+    # like comprehend, report the entities in the order they appear in the text
+    return sorted(((entity_type, match.start(), match.end()) for entity_type, pattern in PII_PATTERNS for match in pattern.finditer(text)),
+                  key=lambda entity: entity[1])
+
+
+def _request_handler(server: StandInServer):
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _read_body(self) -> bytes:
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                body = bytearray()
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                    if size == 0:
+                        # skip the trailers up to the final empty line
+                        while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                            pass
+                        return bytes(body)
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _respond(self, status: int, body: bytes = b'', headers: dict = None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            time.sleep(server.s3_latency)
+            name = urlparse(self.path).path[len('/objects/'):]
+            if name not in server.objects:
+                body = b'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>NoSuchKey</Code><Message>Not found</Message></Error>'
+                self._respond(404, body)
+                return
+            content = server.objects[name]
+            self._respond(200, content, {'ETag': f'"{hashlib.md5(content).hexdigest()}"', 'Content-Type': 'text/plain'})
+
+        def do_POST(self):
+            body = self._read_body()
+            target = self.headers.get('X-Amz-Target')
+            if target is not None:
+                self._comprehend(target.split('.')[-1], json.loads(body))
+            else:
+                time.sleep(server.s3_latency)
+                server._count(server.api_calls, 'WriteGetObjectResponse')
+                server.write_get_object_responses[self.headers.get('x-amz-request-token')] = {
+                    'status_code': int(self.headers.get('x-amz-fwd-status', 200)),
+                    'error_code': self.headers.get('x-amz-fwd-error-code'),
+                    'body': body}
+                self._respond(200)
+
+        def _comprehend(self, api: str, request: dict):
+            if server._is_throttled(api):
+                server._count(server.throttled_calls, api)
+                self._respond(400, json.dumps({'__type': 'ThrottlingException', 'message': 'Rate exceeded'}).encode('utf-8'),
+                              {'Content-Type': 'application/x-amz-json-1.1'})
+                return
+            time.sleep(server.comprehend_latency)
+            server._count(server.api_calls, api)
+            entities = _find_pii(request['Text'])
+            if api == 'ContainsPiiEntities':
+                response = {'Labels': [{'Name': entity_type, 'Score': PII_SCORE} for entity_type in {entity[0] for entity in entities}]}
+            else:
+                response = {'Entities': [{'Type': entity_type, 'Score': PII_SCORE, 'BeginOffset': begin_offset, 'EndOffset': end_offset}
+                                         for entity_type, begin_offset, end_offset in entities]}
+            self._respond(200, json.dumps(response).encode('utf-8'), {'Content-Type': 'application/x-amz-json-1.1'})
+
+    return RequestHandler
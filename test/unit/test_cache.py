@@ -0,0 +1,110 @@
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from cache import LruCache, FileResultCacheStore, ResultCache, ResultCacheStore
+
+
+class LruCacheTest(TestCase):
+    def test_get_and_put(self):
+        cache = LruCache(10)
+        assert cache.get('a') is None
+        assert cache.get('a', 'default') == 'default'
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        assert 'a' in cache
+        assert len(cache) == 1
+
+    def test_evicts_least_recently_used(self):
+        cache = LruCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+
+    def test_evicts_by_size(self):
+        cache = LruCache(10, size_of=len)
+        cache.put('a', 'x' * 4)
+        cache.put('b', 'x' * 4)
+        cache.put('c', 'x' * 4)
+        assert 'a' not in cache
+        assert cache.size == 8
+        cache.put('b', 'x' * 2)
+        assert cache.size == 6
+
+    def test_value_larger_than_max_size_not_cached(self):
+        cache = LruCache(10, size_of=len)
+        cache.put('a', 'x' * 4)
+        cache.put('b', 'x' * 11)
+        assert 'b' not in cache
+        assert 'a' in cache
+
+    def test_clear(self):
+        cache = LruCache(10)
+        cache.put('a', 1)
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.size == 0
+
+
+class ResultCacheStoreTest(TestCase):
+    def test_incomplete_store_not_created(self):
+        class GetOnlyStore(ResultCacheStore):
+            def get(self, key):
+                return None
+
+        self.assertRaises(TypeError, GetOnlyStore)
+
+
+class FileResultCacheStoreTest(TestCase):
+    def test_get_and_put(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileResultCacheStore(directory)
+            assert store.get('key') is None
+            store.put('key', {'redacted_text': 'Some **** text'})
+            assert store.get('key') == {'redacted_text': 'Some **** text'}
+            assert FileResultCacheStore(directory).get('key') == {'redacted_text': 'Some **** text'}
+
+
+class ResultCacheTest(TestCase):
+    def test_key(self):
+        headers = {'ETag': '"etag1"', 'Content-Length': '16'}
+        key = ResultCache.key(headers, 'redaction', {'mask_character': '*'})
+        assert key == ResultCache.key(dict(headers), 'redaction', {'mask_character': '*'})
+        assert key != ResultCache.key(headers, 'redaction', {'mask_character': '#'})
+        assert key != ResultCache.key(headers, 'classification', {'mask_character': '*'})
+        assert key != ResultCache.key({'ETag': '"etag2"', 'Content-Length': '16'}, 'redaction', {'mask_character': '*'})
+        assert key != ResultCache.key(dict(headers, **{'x-amz-version-id': 'v2'}), 'redaction', {'mask_character': '*'})
+
+    def test_key_without_etag(self):
+        assert ResultCache.key({'Content-Length': '16'}, 'redaction') is None
+
+    def test_get_and_put_local_tier(self):
+        cache = ResultCache(LruCache(10))
+        assert cache.get('key') is None
+        cache.put('key', {'a': 'b'})
+        assert cache.get('key') == {'a': 'b'}
+        cache.put(None, {'a': 'b'})
+        assert cache.get(None) is None
+        cache.clear()
+        assert cache.get('key') is None
+
+    def test_shared_tier_hit_promoted_to_local_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ResultCache(LruCache(10), FileResultCacheStore(directory)).put('key', {'a': 'b'})
+            local_tier = LruCache(10)
+            cache = ResultCache(local_tier, FileResultCacheStore(directory))
+            assert cache.get('key') == {'a': 'b'}
+            assert local_tier.get('key') == {'a': 'b'}
+
+    def test_shared_tier_failures_are_cache_misses(self):
+        shared_tier = MagicMock()
+        shared_tier.get.side_effect = OSError("Read-only file system")
+        shared_tier.put.side_effect = OSError("Read-only file system")
+        cache = ResultCache(LruCache(10), shared_tier)
+        assert cache.get('key') is None
+        cache.put('key', {'a': 'b'})
+        assert cache.get('key') == {'a': 'b'}
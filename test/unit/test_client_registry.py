@@ -0,0 +1,59 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from clients.client_registry import ClientRegistry
+from clients.cloudwatch_client import BackgroundMetricsPublisher, EmbeddedMetricFormatClient
+from constants import METRICS_PUBLISHER_VALID_VALUES
+
+S3OL_ACCESS_POINT_TEST = "arn:aws:s3-object-lambda:us-east-1:000000000000:accesspoint/myPiiAp"
+OTHER_S3OL_ACCESS_POINT_TEST = "arn:aws:s3-object-lambda:us-east-1:000000000000:accesspoint/myOtherPiiAp"
+
+
+class ClientRegistryTest(TestCase):
+    @patch('clients.client_registry.S3Client')
+    def test_s3_client_reused_per_access_point(self, s3_client):
+        registry = ClientRegistry()
+        first = registry.s3_client(S3OL_ACCESS_POINT_TEST)
+        assert registry.s3_client(S3OL_ACCESS_POINT_TEST) is first
+        s3_client.assert_called_once_with(S3OL_ACCESS_POINT_TEST, endpoint_url=None)
+        registry.s3_client(S3OL_ACCESS_POINT_TEST, endpoint_url="http://localhost:8080")
+        registry.s3_client(OTHER_S3OL_ACCESS_POINT_TEST)
+        assert s3_client.call_count == 3
+
+    @patch('clients.client_registry.ComprehendClient')
+    def test_comprehend_client_keyed_by_access_point_and_endpoint(self, comprehend_client):
+        registry = ClientRegistry()
+        first = registry.comprehend_client(S3OL_ACCESS_POINT_TEST)
+        assert registry.comprehend_client(S3OL_ACCESS_POINT_TEST) is first
+        assert comprehend_client.call_count == 1
+        registry.comprehend_client(S3OL_ACCESS_POINT_TEST, endpoint_url="https://localhost:8080")
+        registry.comprehend_client(OTHER_S3OL_ACCESS_POINT_TEST)
+        assert comprehend_client.call_count == 3
+
+    @patch('clients.client_registry.CloudWatchClient')
+    def test_cloudwatch_client_reused(self, cloudwatch_client):
+        registry = ClientRegistry()
+        assert registry.cloudwatch_client() is registry.cloudwatch_client()
+        cloudwatch_client.assert_called_once()
+
+    @patch('clients.client_registry.CloudWatchClient')
+    def test_embedded_metric_format_client(self, cloudwatch_client):
+        registry = ClientRegistry()
+        assert isinstance(registry.cloudwatch_client(METRICS_PUBLISHER_VALID_VALUES.EMBEDDED_METRIC_FORMAT), EmbeddedMetricFormatClient)
+        cloudwatch_client.assert_not_called()
+
+    @patch('clients.client_registry.CloudWatchClient')
+    def test_background_metrics_publisher(self, cloudwatch_client):
+        registry = ClientRegistry()
+        publisher = registry.cloudwatch_client(METRICS_PUBLISHER_VALID_VALUES.PUT_METRIC_DATA, max_lag_in_millis=500)
+        assert isinstance(publisher, BackgroundMetricsPublisher)
+        assert publisher.publisher is cloudwatch_client.return_value
+        publisher.shutdown()
+
+    @patch('clients.client_registry.S3Client')
+    def test_clear(self, s3_client):
+        registry = ClientRegistry()
+        registry.s3_client(S3OL_ACCESS_POINT_TEST)
+        registry.clear()
+        registry.s3_client(S3OL_ACCESS_POINT_TEST)
+        assert s3_client.call_count == 2
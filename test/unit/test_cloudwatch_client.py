@@ -1,7 +1,12 @@
+import json
+from io import StringIO
+from queue import Queue
+from time import sleep, time
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 
-from clients.cloudwatch_client import CloudWatchClient
+from clients.cloudwatch_client import BackgroundMetricsPublisher, CloudWatchClient, EmbeddedMetricFormatClient, Histogram, \
+    Metrics
 
 S3OL_ACCESS_POINT_TEST = "arn:aws:s3-object-lambda:us-east-1:000000000000:accesspoint/myPiiAp"
 
@@ -56,3 +61,131 @@ class CloudWatchClientTest(TestCase):
             assert len(chunk) <= cloudwatch.MAX_METRIC_DATA
             total_metrics += len(chunk)
         assert total_metrics == 10
+
+
+class MetricsTest(TestCase):
+    def test_samples_aggregated_per_metric(self):
+        metrics = Metrics("Comprehend", "DetectPiiEntities", S3OL_ACCESS_POINT_TEST)
+        metrics.add_latency(0, 0.1)
+        metrics.add_fault_count(0)
+        metrics.add_latency(1, 1.2)
+        metrics.add_fault_count(2)
+        metrics.add_latency(2, 2.1)
+        metrics.add_cache_hit_count(3)
+        latency, fault_count, cache_hit_count = metrics.metrics
+        assert latency['MetricName'] == 'Latency'
+        assert latency['Unit'] == 'Milliseconds'
+        assert latency['Values'] == [100, 200]
+        assert latency['Counts'] == [2, 1]
+        assert [dimension['Name'] for dimension in latency['Dimensions']] == ['API', 'S3ObjectLambdaAccessPoint', 'Service']
+        assert fault_count['StatisticValues'] == {'SampleCount': 2, 'Sum': 2, 'Minimum': 0, 'Maximum': 2}
+        assert cache_hit_count['Value'] == 3
+        assert 'StatisticValues' not in cache_hit_count
+
+    def test_histogram_split_across_datums(self):
+        metrics = Metrics("S3", "DownloadPresignedUrl", S3OL_ACCESS_POINT_TEST)
+        for i in range(Histogram.MAX_VALUES + 10):
+            metrics.add_latency(0, i / 1000)
+        first, second = metrics.metrics
+        assert len(first['Values']) == Histogram.MAX_VALUES
+        assert second['Values'] == list(range(Histogram.MAX_VALUES, Histogram.MAX_VALUES + 10))
+
+
+class EmbeddedMetricFormatClientTest(TestCase):
+    def test_flush_writes_one_line_per_dimensions(self):
+        stream = StringIO()
+        client = EmbeddedMetricFormatClient(stream=stream)
+        metrics = Metrics("Comprehend", "DetectPiiEntities", S3OL_ACCESS_POINT_TEST)
+        metrics.add_latency(1, 1.5)
+        metrics.add_latency(2, 2.25)
+        metrics.add_latency(3, 3.25)
+        metrics.add_fault_count()
+        metrics.add_fault_count(2)
+        client.publish_metrics(metrics.metrics)
+        client.put_document_processed_metric('en', S3OL_ACCESS_POINT_TEST)
+        assert stream.getvalue() == ''
+
+        client.flush()
+        lines = stream.getvalue().splitlines()
+        assert len(lines) == 2
+        comprehend_metrics, documents_processed = [json.loads(line) for line in lines]
+        directive = comprehend_metrics['_aws']['CloudWatchMetrics'][0]
+        assert directive['Namespace'] == 'ComprehendS3ObjectLambda'
+        assert directive['Dimensions'] == [['API', 'S3ObjectLambdaAccessPoint', 'Service']]
+        assert directive['Metrics'] == [{'Name': 'Latency', 'Unit': 'Milliseconds'}, {'Name': 'ErrorCount', 'Unit': 'Count'}]
+        assert comprehend_metrics['API'] == 'DetectPiiEntities'
+        assert comprehend_metrics['Service'] == 'Comprehend'
+        assert comprehend_metrics['S3ObjectLambdaAccessPoint'] == S3OL_ACCESS_POINT_TEST
+        assert comprehend_metrics['Latency'] == [500, 250, 250]
+        assert comprehend_metrics['ErrorCount'] == 3
+        assert documents_processed['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Language', 'S3ObjectLambdaAccessPoint']]
+        assert documents_processed['DocumentsProcessed'] == 1.0
+
+        client.flush()
+        assert len(stream.getvalue().splitlines()) == 2
+
+    def test_metric_values_split_across_lines(self):
+        client = EmbeddedMetricFormatClient()
+        metrics = Metrics("S3", "DownloadPresignedUrl", S3OL_ACCESS_POINT_TEST)
+        for i in range(client.MAX_VALUES_PER_METRIC + 1):
+            metrics.add_latency(0, i / 1000)
+        metrics.add_fault_count()
+        documents = client.emf_documents(metrics.metrics, 1234)
+        assert len(documents) == 2
+        assert len(documents[0]['Latency']) == client.MAX_VALUES_PER_METRIC
+        assert documents[0]['ErrorCount'] == 1
+        assert documents[1]['Latency'] == 100
+        assert 'ErrorCount' not in documents[1]
+        assert documents[1]['_aws']['CloudWatchMetrics'][0]['Metrics'] == [{'Name': 'Latency', 'Unit': 'Milliseconds'}]
+        assert all(document['_aws']['Timestamp'] == 1234 for document in documents)
+
+
+class BackgroundMetricsPublisherTest(TestCase):
+    def _published(self, publisher: MagicMock, count: int, timeout: float = 2):
+        deadline = time() + timeout
+        while sum(len(call_args[0][0]) for call_args in publisher.publish_metrics.call_args_list) < count and time() < deadline:
+            sleep(0.01)
+        return [metric for call_args in publisher.publish_metrics.call_args_list for metric in call_args[0][0]]
+
+    def test_flush_publishes_in_background(self):
+        publisher = MagicMock()
+        background_publisher = BackgroundMetricsPublisher(publisher, max_lag_in_millis=60 * 1000)
+        background_publisher.put_document_processed_metric('en', S3OL_ACCESS_POINT_TEST)
+        background_publisher.put_pii_document_types_metric(['SSN', 'PHONE'], 'en', S3OL_ACCESS_POINT_TEST)
+        sleep(0.05)
+        publisher.publish_metrics.assert_not_called()
+
+        background_publisher.flush()
+        metrics = self._published(publisher, 3)
+        assert [metric['MetricName'] for metric in metrics] == ['DocumentsProcessed'] + ['PiiDocumentTypesProcessed'] * 2
+        publisher.publish_metrics.assert_called_once()
+        publisher.flush.assert_called_once()
+        background_publisher.shutdown()
+
+    def test_metrics_published_after_max_lag(self):
+        publisher = MagicMock()
+        background_publisher = BackgroundMetricsPublisher(publisher, max_lag_in_millis=100)
+        start_time = time()
+        background_publisher.put_document_processed_metric('en', S3OL_ACCESS_POINT_TEST)
+        assert len(self._published(publisher, 1)) == 1
+        assert time() - start_time >= 0.1
+        background_publisher.shutdown()
+
+    def test_shutdown_drains_the_queue(self):
+        publisher = MagicMock()
+        publisher.publish_metrics.side_effect = [Exception("Some error"), None]
+        background_publisher = BackgroundMetricsPublisher(publisher, max_lag_in_millis=60 * 1000)
+        background_publisher.put_document_processed_metric('en', S3OL_ACCESS_POINT_TEST)
+        background_publisher.flush()
+        background_publisher.put_pii_document_processed_metric('en', S3OL_ACCESS_POINT_TEST)
+        background_publisher.shutdown()
+        assert publisher.publish_metrics.call_count == 2
+        assert publisher.publish_metrics.call_args[0][0][0]['MetricName'] == 'PiiDocumentsProcessed'
+
+    def test_metrics_dropped_when_queue_full(self):
+        publisher = MagicMock()
+        background_publisher = BackgroundMetricsPublisher(publisher, max_lag_in_millis=60 * 1000, max_queue_size=2)
+        # the worker stays blocked on the queue it started with, so that the queue swapped in is not drained
+        with patch.object(background_publisher, '_queue', Queue(maxsize=2)):
+            background_publisher.put_pii_document_types_metric(['SSN', 'PHONE', 'EMAIL'], 'en', S3OL_ACCESS_POINT_TEST)
+            assert background_publisher._queue.qsize() == 2
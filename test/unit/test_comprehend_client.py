@@ -3,10 +3,14 @@ from unittest import TestCase
 from unittest.mock import patch, MagicMock, call
 
 from botocore.awsrequest import AWSRequest
+from botocore.exceptions import ClientError
 
 from clients.comprehend_client import ComprehendClient
-from constants import BEGIN_OFFSET, END_OFFSET, ENTITY_TYPE, SCORE
-from data_object import Document
+from constants import BEGIN_OFFSET, END_OFFSET, ENTITY_TYPE, SCORE, CONTAINS_PII_ENTITIES, MIN_TIME_FOR_API_CALL
+from data_object import Document, SegmentResult
+from exceptions import DeadlineExceededException, TaskCancelledException
+from scheduler import CancellationToken
+from util import Deadline
 
 
 class ComprehendClientTest(TestCase):
@@ -15,13 +19,231 @@ class ComprehendClientTest(TestCase):
         mocked_client = MagicMock()
         mocked_boto3.client.return_value = mocked_client
         comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn")
-        mocked_client.meta.events.register.assert_called_with('before-sign.comprehend.*', comprehend_client._add_session_header)
+        mocked_client.meta.events.register.assert_has_calls([call('before-sign.comprehend.*', comprehend_client._add_session_header),
+                                                             call('before-send.comprehend.*', comprehend_client._check_deadline)])
         request = AWSRequest()
         comprehend_client._add_session_header(request)
         assert len(request.headers.get('x-amzn-session-id')) >= 10
         assert comprehend_client.classification_executor_service._max_workers == 20
         assert comprehend_client.redaction_executor_service._max_workers == 8
 
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_client_reused_across_requests(self, mocked_boto3):
+        classification_result = {'Labels': [{'Name': 'SSN', 'Score': 0.1234}], 'ResponseMetadata': {'RetryAttempts': 0}}
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        mocked_client.contains_pii_entities.return_value = classification_result
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn")
+        comprehend_client.begin_request(session_id="FirstRequest")
+        comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en')
+        assert len(comprehend_client.classify_metrics.metrics) == 5
+
+        comprehend_client.begin_request(session_id="SecondRequest")
+        assert len(comprehend_client.classify_metrics.metrics) == 0
+        docs = comprehend_client.contains_pii_entities([Document(text="Some other text")], language='en')
+        assert docs[0].pii_classification == {'SSN': 0.1234}
+        assert len(comprehend_client.classify_metrics.metrics) == 5
+        request = AWSRequest()
+        comprehend_client._add_session_header(request)
+        assert request.headers.get('x-amzn-session-id') == "SecondRequest"
+        mocked_boto3.client.assert_called_once()
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_call_outliving_its_request(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn")
+        comprehend_client.begin_request(session_id="FirstRequest")
+        first_request_metrics = comprehend_client.classify_metrics
+        request = AWSRequest()
+
+        def next_request_begins(Text, LanguageCode):
+            # as if the first request timed out and the next one began while its call was in flight on the shared pool
+            comprehend_client.begin_request(session_id="SecondRequest")
+            comprehend_client._add_session_header(request)
+            return {'Labels': [], 'ResponseMetadata': {'RetryAttempts': 0}}
+
+        mocked_client.contains_pii_entities.side_effect = next_request_begins
+        comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en')
+        assert request.headers.get('x-amzn-session-id') == "FirstRequest"
+        assert 'Latency' in [metric['MetricName'] for metric in first_request_metrics.metrics]
+        assert comprehend_client.classify_metrics.metrics == []
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_coalesces_duplicate_segments(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        mocked_client.contains_pii_entities.return_value = {'Labels': [{'Name': 'SSN', 'Score': 0.9}],
+                                                            'ResponseMetadata': {'RetryAttempts': 0}}
+        mocked_client.detect_pii_entities.return_value = {'Entities': [{BEGIN_OFFSET: 0, END_OFFSET: 4, ENTITY_TYPE: 'SSN', SCORE: 0.9}],
+                                                          'ResponseMetadata': {'RetryAttempts': 0}}
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn")
+        documents = [Document(text="Some Random text", char_offset=i * 16) for i in range(5)] + [Document(text="Other text")]
+
+        classified_docs = comprehend_client.contains_pii_entities(documents, language='en')
+        assert mocked_client.contains_pii_entities.call_count == 2
+        assert sorted(doc.char_offset for doc in classified_docs) == [0, 0, 16, 32, 48, 64]
+        assert all(doc.pii_classification == {'SSN': 0.9} for doc in classified_docs)
+        metrics = {metric['MetricName']: metric for metric in comprehend_client.classify_metrics.metrics}
+        assert metrics['SegmentCacheHitCount']['Value'] == 4
+        assert metrics['SegmentCacheMissCount']['Value'] == 2
+        assert sum(metrics['Latency']['Counts']) == 2
+
+        detected_docs = comprehend_client.detect_pii_documents(documents, language='en')
+        assert mocked_client.detect_pii_entities.call_count == 2
+        assert len(detected_docs) == 6
+        # entity stores are never modified, so documents with the same text share one
+        assert detected_docs[0].pii_entities is detected_docs[1].pii_entities
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_results_refer_to_input_documents(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        mocked_client.contains_pii_entities.return_value = {'Labels': [{'Name': 'SSN', 'Score': 0.9}],
+                                                            'ResponseMetadata': {'RetryAttempts': 0}}
+        mocked_client.detect_pii_entities.return_value = {'Entities': [{BEGIN_OFFSET: 0, END_OFFSET: 4, ENTITY_TYPE: 'SSN', SCORE: 0.8}],
+                                                          'ResponseMetadata': {'RetryAttempts': 0}}
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn")
+        documents = [Document(text="Some Random text", char_offset=i * 16) for i in range(3)]
+
+        for results in (comprehend_client.contains_pii_entities(documents, language='en'),
+                        comprehend_client.detect_pii_documents(documents, language='en')):
+            assert sorted(id(result.segment) for result in results) == sorted(id(document) for document in documents)
+            for result in results:
+                assert isinstance(result, SegmentResult)
+                assert result.text is result.segment.text
+                with self.assertRaises(TypeError):
+                    result.pii_classification['EMAIL'] = 0.9
+        assert all(document.pii_classification == {} and document.pii_entities == [] for document in documents)
+        assert results[0].pii_classification == {'SSN': 0.8}
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_calls_cancelled_with_token(self, mocked_boto3):
+        cancellation_token = CancellationToken()
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+
+        def mocked_api_call(**kwargs):
+            # the request times out while the first call is in flight
+            cancellation_token.cancel()
+            return {'Labels': [{'Name': 'SSN', 'Score': 0.9}], 'ResponseMetadata': {'RetryAttempts': 0}}
+
+        mocked_client.contains_pii_entities.side_effect = mocked_api_call
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn", pii_classification_thread_count=1,
+                                             adaptive_concurrency=False)
+        documents = [Document(text=f"Some Random text {i}") for i in range(5)]
+        with self.assertRaises(TaskCancelledException):
+            comprehend_client.contains_pii_entities(documents, language='en', cancellation_token=cancellation_token)
+        assert mocked_client.contains_pii_entities.call_count == 1
+        with self.assertRaises(TaskCancelledException):
+            comprehend_client.detect_pii_documents(documents, language='en', cancellation_token=cancellation_token)
+        assert mocked_client.detect_pii_entities.call_count == 0
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_calls_refused_past_deadline(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn")
+        documents = [Document(text=f"Some Random text {i}") for i in range(5)]
+        with self.assertRaises(DeadlineExceededException) as e:
+            comprehend_client.contains_pii_entities(documents, language='en', deadline=Deadline(MIN_TIME_FOR_API_CALL))
+        assert e.exception.operation == CONTAINS_PII_ENTITIES
+        with self.assertRaises(DeadlineExceededException):
+            comprehend_client.detect_pii_documents(documents, language='en', deadline=Deadline(MIN_TIME_FOR_API_CALL))
+        assert mocked_client.contains_pii_entities.call_count == 0
+        assert mocked_client.detect_pii_entities.call_count == 0
+
+        # retries go through the before-send hook too, on the thread making the call
+        comprehend_client._check_deadline(request=None)
+        comprehend_client._call_context.deadline = Deadline(60000)
+        comprehend_client._check_deadline(request=None)
+        comprehend_client._call_context.deadline = Deadline(0)
+        with self.assertRaises(DeadlineExceededException):
+            comprehend_client._check_deadline(request=None)
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_waits_until_deadline(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+
+        def mocked_api_call(**kwargs):
+            sleep(0.5)
+            return {'Labels': [], 'ResponseMetadata': {'RetryAttempts': 0}}
+
+        mocked_client.contains_pii_entities.side_effect = mocked_api_call
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn")
+        start_time = time()
+        with self.assertRaises(DeadlineExceededException):
+            comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en',
+                                                    deadline=Deadline(MIN_TIME_FOR_API_CALL + 100))
+        assert time() - start_time < 0.45
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_segment_cache_across_requests(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        mocked_client.contains_pii_entities.return_value = {'Labels': [{'Name': 'SSN', 'Score': 0.9}],
+                                                            'ResponseMetadata': {'RetryAttempts': 0}}
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn")
+        comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en')
+
+        comprehend_client.begin_request(session_id="SecondRequest")
+        docs = comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en')
+        assert docs[0].pii_classification == {'SSN': 0.9}
+        comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='es')
+        assert mocked_client.contains_pii_entities.call_count == 2
+        assert [(metric['MetricName'], metric['StatisticValues']) for metric in comprehend_client.classify_metrics.metrics[:2]] == \
+               [('SegmentCacheHitCount', {'SampleCount': 2, 'Sum': 1, 'Minimum': 0, 'Maximum': 1}),
+                ('SegmentCacheMissCount', {'SampleCount': 2, 'Sum': 1, 'Minimum': 0, 'Maximum': 1})]
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_segment_cache_disabled(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        mocked_client.contains_pii_entities.return_value = {'Labels': [], 'ResponseMetadata': {'RetryAttempts': 0}}
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn", segment_cache_max_size=0)
+        comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en')
+        comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en')
+        assert mocked_client.contains_pii_entities.call_count == 2
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_backs_off_when_throttled(self, mocked_boto3):
+        throttling_error = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'ContainsPiiEntities')
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn", pii_classification_thread_count=8)
+
+        mocked_client.contains_pii_entities.return_value = {'Labels': [], 'ResponseMetadata': {'RetryAttempts': 2}}
+        comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en')
+        assert comprehend_client.classification_limiter.limit == 4
+        assert comprehend_client.classify_metrics.metrics[-1]['MetricName'] == 'ConcurrencyLimit'
+        assert comprehend_client.classify_metrics.metrics[-1]['Value'] == 4
+
+        mocked_client.contains_pii_entities.side_effect = throttling_error
+        with self.assertRaises(ClientError):
+            comprehend_client.contains_pii_entities([Document(text="Some other text")], language='en')
+        assert comprehend_client.classification_limiter.limit == 2
+
+        mocked_client.contains_pii_entities.side_effect = None
+        mocked_client.contains_pii_entities.return_value = {'Labels': [], 'ResponseMetadata': {'RetryAttempts': 0}}
+        comprehend_client.contains_pii_entities([Document(text=f"Some Random text {i}") for i in range(10)], language='en')
+        assert comprehend_client.classification_limiter.limit > 2
+        assert comprehend_client.classification_limiter.in_flight == 0
+        assert comprehend_client.classification_concurrency == comprehend_client.classification_limiter.limit
+        # only the calls which weren't retried tell how long a call takes
+        assert comprehend_client.classification_latency.sample_count == 10
+
+    @patch('clients.comprehend_client.boto3')
+    def test_comprehend_without_adaptive_concurrency(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        mocked_client.contains_pii_entities.return_value = {'Labels': [], 'ResponseMetadata': {'RetryAttempts': 2}}
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn", adaptive_concurrency=False)
+        comprehend_client.contains_pii_entities([Document(text="Some Random text")], language='en')
+        assert comprehend_client.classification_limiter is None
+        assert comprehend_client.classification_concurrency == 20
+        assert 'ConcurrencyLimit' not in [metric['MetricName'] for metric in comprehend_client.classify_metrics.metrics]
+
     @patch('clients.comprehend_client.boto3')
     def test_comprehend_detect_pii_entities(self, mocked_boto3):
         DUMMY_PII_ENTITY = {BEGIN_OFFSET: 12, END_OFFSET: 14, ENTITY_TYPE: 'SSN', SCORE: 0.345}
@@ -36,16 +258,18 @@ class ComprehendClientTest(TestCase):
         mocked_client.detect_pii_entities.side_effect = mocked_api_call
         start_time = time()
         docs_with_pii_entity = comprehend_client.detect_pii_documents(
-            documents=[Document(text="Some Random 1mb_pii_text", ) for i in range(1, 20)],
+            documents=[Document(text=f"Some Random 1mb_pii_text {i}", ) for i in range(1, 20)],
             language='en')
         end_time = time()
-        mocked_client.detect_pii_entities.assert_has_calls([call(Text="Some Random 1mb_pii_text", LanguageCode='en') for i in range(1, 20)])
+        mocked_client.detect_pii_entities.assert_has_calls([call(Text=f"Some Random 1mb_pii_text {i}", LanguageCode='en')
+                                                            for i in range(1, 20)], any_order=True)
 
-        assert len(comprehend_client.detection_metrics.metrics) == 38
-        for i in range(0, 19, 2):
-            assert comprehend_client.detection_metrics.metrics[i]['MetricName'] == 'ErrorCount'
-            assert comprehend_client.detection_metrics.metrics[i]['Value'] == 0
-            assert comprehend_client.detection_metrics.metrics[i + 1]['MetricName'] == 'Latency'
+        # the samples of the 19 calls are aggregated into one datum per metric
+        metrics = {metric['MetricName']: metric for metric in comprehend_client.detection_metrics.metrics}
+        assert len(comprehend_client.detection_metrics.metrics) == 5
+        assert metrics['ErrorCount']['StatisticValues'] == {'SampleCount': 19, 'Sum': 0, 'Minimum': 0, 'Maximum': 0}
+        assert sum(metrics['Latency']['Counts']) == 19
+        assert all(value >= 100 for value in metrics['Latency']['Values'])
         assert len(comprehend_client.classify_metrics.metrics) == 0
 
         # should be around 0.4 : 20 calls with 5 thread counts , where each call taking 0.1 seconds to complete
@@ -68,18 +292,18 @@ class ComprehendClientTest(TestCase):
         mocked_client.contains_pii_entities.side_effect = mocked_api_call
         start_time = time()
         docs_with_pii_classification = comprehend_client.contains_pii_entities(
-            documents=[Document(text="Some Random 1mb_pii_text", ) for i in range(1, 4)],
+            documents=[Document(text=f"Some Random 1mb_pii_text {i}", ) for i in range(1, 4)],
             language='en')
         end_time = time()
 
         mocked_client.contains_pii_entities.assert_has_calls(
-            [call(Text="Some Random 1mb_pii_text", LanguageCode='en') for i in range(1, 4)])
+            [call(Text=f"Some Random 1mb_pii_text {i}", LanguageCode='en') for i in range(1, 4)], any_order=True)
         # should be around 0.2 : 4 calls with 2 thread counts , where each call taking 0.1 seconds to complete
         assert 0.2 <= end_time - start_time < 0.3
-        assert len(comprehend_client.classify_metrics.metrics) == 6
-        for i in range(0, 6, 2):
-            assert comprehend_client.classify_metrics.metrics[i]['MetricName'] == 'ErrorCount'
-            assert comprehend_client.classify_metrics.metrics[i + 1]['MetricName'] == 'Latency'
+        metrics = {metric['MetricName']: metric for metric in comprehend_client.classify_metrics.metrics}
+        assert len(comprehend_client.classify_metrics.metrics) == 5
+        assert metrics['ErrorCount']['StatisticValues']['SampleCount'] == 3
+        assert sum(metrics['Latency']['Counts']) == 3
 
         assert len(comprehend_client.detection_metrics.metrics) == 0
         for doc in docs_with_pii_classification:
@@ -96,25 +320,25 @@ class ComprehendClientTest(TestCase):
         mocked_client.contains_pii_entities.side_effect = [classification_result, classification_result, api_invocation_exception,
                                                            classification_result]
         try:
-            comprehend_client.contains_pii_entities(documents=[Document(text="Some Random 1mb_pii_text", ) for i in range(0, 4)],
+            comprehend_client.contains_pii_entities(documents=[Document(text=f"Some Random 1mb_pii_text {i}", ) for i in range(0, 4)],
                                                     language='en')
 
             assert False, "Expected an exception "
         except Exception as e:
             assert e == api_invocation_exception
-        mocked_client.contains_pii_entities.assert_has_calls(
-            [call(Text="Some Random 1mb_pii_text", LanguageCode='en') for i in range(0, 4)])
-        assert len(comprehend_client.classify_metrics.metrics) == 8  # 4 latency metrics and 1 fault
+        # the calls which haven't started when the failure comes back are cancelled
+        call_count = mocked_client.contains_pii_entities.call_count
+        assert 3 <= call_count <= 4
+        # one datum per metric: latency, retry counts and faults, cache hit/miss and limit
+        assert len(comprehend_client.classify_metrics.metrics) == 5
         assert len(comprehend_client.detection_metrics.metrics) == 0
         assert comprehend_client.classify_metrics.service_name == "Comprehend"
         assert comprehend_client.classify_metrics.s3ol_access_point_arn == "Some_access_point_arn"
         assert comprehend_client.classify_metrics.api == "ContainsPiiEntities"
-        metric_count = {"ErrorCount": 0, "Latency": 0}
-        for i in range(0, 8):
-            metric_name = comprehend_client.classify_metrics.metrics[i]['MetricName']
-            metric_count[metric_name] += 1
-        assert metric_count['ErrorCount'] == 4
-        assert metric_count['Latency'] == 4
+        metrics = {metric['MetricName']: metric for metric in comprehend_client.classify_metrics.metrics}
+        assert metrics['ErrorCount']['StatisticValues']['SampleCount'] == call_count
+        assert metrics['ErrorCount']['StatisticValues']['Sum'] == 1
+        assert sum(metrics['Latency'].get('Counts', [1])) == call_count
 
     @patch('clients.comprehend_client.boto3')
     def test_comprehend_detect_pii_entities_failure(self, mocked_boto3):
@@ -127,21 +351,22 @@ class ComprehendClientTest(TestCase):
         mocked_client.detect_pii_entities.side_effect = [DUMMY_PII_ENTITY, DUMMY_PII_ENTITY, api_invocation_exception,
                                                          DUMMY_PII_ENTITY]
         try:
-            comprehend_client.detect_pii_documents(documents=[Document(text="Some Random 1mb_pii_text", ) for i in range(0, 4)],
+            comprehend_client.detect_pii_documents(documents=[Document(text=f"Some Random 1mb_pii_text {i}", ) for i in range(0, 4)],
                                                    language='en')
 
             assert False, "Expected an exception "
         except Exception as e:
             assert e == api_invocation_exception
-        mocked_client.detect_pii_entities.assert_has_calls([call(Text="Some Random 1mb_pii_text", LanguageCode='en') for i in range(0, 4)])
-        assert len(comprehend_client.detection_metrics.metrics) == 8  # 4 latency metrics and 1 fault
+        # the calls which haven't started when the failure comes back are cancelled
+        call_count = mocked_client.detect_pii_entities.call_count
+        assert 3 <= call_count <= 4
+        # one datum per metric: latency, retry counts and faults, cache hit/miss and limit
+        assert len(comprehend_client.detection_metrics.metrics) == 5
         assert len(comprehend_client.classify_metrics.metrics) == 0
         assert comprehend_client.detection_metrics.service_name == "Comprehend"
         assert comprehend_client.detection_metrics.s3ol_access_point_arn == "Some_access_point_arn"
         assert comprehend_client.detection_metrics.api == "DetectPiiEntities"
-        metric_count = {"ErrorCount": 0, "Latency": 0}
-        for i in range(0, 8):
-            metric_name = comprehend_client.detection_metrics.metrics[i]['MetricName']
-            metric_count[metric_name] += 1
-        assert metric_count['ErrorCount'] == 4
-        assert metric_count['Latency'] == 4
+        metrics = {metric['MetricName']: metric for metric in comprehend_client.detection_metrics.metrics}
+        assert metrics['ErrorCount']['StatisticValues']['SampleCount'] == call_count
+        assert metrics['ErrorCount']['StatisticValues']['Sum'] == 1
+        assert sum(metrics['Latency'].get('Counts', [1])) == call_count
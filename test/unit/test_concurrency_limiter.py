@@ -0,0 +1,116 @@
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+from time import sleep
+from unittest import TestCase
+
+from concurrency_limiter import AdaptiveConcurrencyLimiter
+from exceptions import DeadlineExceededException, TaskCancelledException
+from util import Deadline
+
+
+class AdaptiveConcurrencyLimiterTest(TestCase):
+    def test_additive_increase(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=10, initial_limit=2)
+        assert limiter.limit == 2
+        for _ in range(2):
+            limiter.release(limiter.acquire(), throttled=False)
+        assert limiter.limit == 2
+        limiter.release(limiter.acquire(), throttled=False)
+        assert limiter.limit == 3
+        for _ in range(100):
+            limiter.release(limiter.acquire(), throttled=False)
+        assert limiter.limit == 10
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=16)
+        limiter.release(limiter.acquire(), throttled=True)
+        assert limiter.limit == 8
+        limiter.release(limiter.acquire(), throttled=True)
+        assert limiter.limit == 4
+        for _ in range(10):
+            limiter.release(limiter.acquire(), throttled=True)
+        assert limiter.limit == 1
+
+    def test_calls_in_flight_before_a_decrease_dont_decrease_again(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=16)
+        start_times = [limiter.acquire() for _ in range(4)]
+        for start_time in start_times:
+            limiter.release(start_time, throttled=True)
+        assert limiter.limit == 8
+        assert limiter.in_flight == 0
+
+    def test_limits_calls_in_flight(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=3)
+        in_flight = []
+        max_in_flight = 0
+        lock = threading.Lock()
+
+        def call():
+            nonlocal max_in_flight
+            with lock:
+                in_flight.append(1)
+                max_in_flight = max(max_in_flight, len(in_flight))
+            sleep(0.01)
+            with lock:
+                in_flight.pop()
+            return 'response'
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(lambda _: limiter.run(call, lambda response: False), range(30)))
+        assert results == ['response'] * 30
+        assert max_in_flight == 3
+
+    def test_run_with_throttling_error(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=4)
+        error = Exception("Rate exceeded")
+
+        def call():
+            raise error
+
+        with self.assertRaises(Exception) as context:
+            limiter.run(call, lambda response_or_error: response_or_error is error)
+        assert context.exception is error
+        assert limiter.limit == 2
+        assert limiter.in_flight == 0
+
+    def test_call_cancelled_while_waiting_isnt_made(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=1)
+        first_call_started = threading.Event()
+        first_call_released = threading.Event()
+        cancelled = False
+        calls = []
+
+        def first_call():
+            first_call_started.set()
+            first_call_released.wait()
+            return 'first'
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(limiter.run, first_call, lambda response: False)
+            first_call_started.wait()
+            second = executor.submit(limiter.run, lambda: calls.append('second'), lambda response: False,
+                                     is_cancelled=lambda: cancelled)
+            sleep(0.02)
+            cancelled = True
+            # the slot comes free after the cancellation
+            first_call_released.set()
+            assert first.result() == 'first'
+            with self.assertRaises(TaskCancelledException):
+                second.result()
+        assert calls == []
+        assert limiter.in_flight == 0
+
+    def test_call_cancelled_once_allowed_gives_its_slot_back(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=1)
+        with self.assertRaises(TaskCancelledException):
+            limiter.acquire(is_cancelled=lambda: True)
+        assert limiter.in_flight == 0
+        assert limiter.limit == 1
+
+    def test_wait_for_a_slot_bounded_by_deadline(self):
+        limiter = AdaptiveConcurrencyLimiter(max_limit=1)
+        start_time = limiter.acquire()
+        with self.assertRaises(DeadlineExceededException):
+            limiter.acquire(deadline=Deadline(50))
+        limiter.release(start_time, throttled=False)
+        assert limiter.in_flight == 0
@@ -1,12 +1,68 @@
+from types import MappingProxyType
 from unittest import TestCase
 
-from data_object import PiiConfig
+from data_object import Document, EntityStore, PiiConfig, SegmentResult
 from exceptions import InvalidConfigurationException
 
+ENTITIES = [{'Score': 0.234, 'Type': 'SSN', 'BeginOffset': 12, 'EndOffset': 36},
+            {'Score': 0.765, 'Type': 'EMAIL', 'BeginOffset': 28, 'EndOffset': 36},
+            {'Score': 0.534, 'Type': 'SSN', 'BeginOffset': 49, 'EndOffset': 53}]
+
 
 class DataObjectTest(TestCase):
 
     def test_Pii_config_valid_confidence_threshold(self):
         with self.assertRaises(InvalidConfigurationException) as e:
             PiiConfig(confidence_threshold=0.1)
-        assert e.exception.message == 'CONFIDENCE_THRESHOLD is not within allowed range [0.5,1]'
\ No newline at end of file
+        assert e.exception.message == 'CONFIDENCE_THRESHOLD is not within allowed range [0.5,1]'
+
+    def test_entity_store(self):
+        store = EntityStore.from_entities(ENTITIES)
+        assert len(store) == 3
+        assert store[1] == ENTITIES[1]
+        assert list(store) == ENTITIES
+        assert store == ENTITIES
+        assert store != ENTITIES[:2]
+        assert store.entity_type(2) == 'SSN'
+        assert store.type_ids[0] == store.type_ids[2]
+        assert EntityStore.from_entities([]) == []
+
+    def test_entity_store_shifted_and_take(self):
+        store = EntityStore.from_entities(ENTITIES)
+        shifted = store.shifted(100)
+        assert [entity['BeginOffset'] for entity in shifted] == [112, 128, 149]
+        assert [entity['EndOffset'] for entity in shifted] == [136, 136, 153]
+        assert store == ENTITIES
+        assert store.take([2, 0]) == [ENTITIES[2], ENTITIES[0]]
+        assert EntityStore.concatenate([store, shifted.take([1])]) == ENTITIES + [dict(ENTITIES[1], BeginOffset=128, EndOffset=136)]
+
+    def test_entity_store_clipped(self):
+        store = EntityStore.from_entities(ENTITIES)
+        clipped = store.clipped(30, 50)
+        assert clipped == [dict(ENTITIES[0], BeginOffset=0, EndOffset=6), dict(ENTITIES[1], BeginOffset=0, EndOffset=6),
+                           dict(ENTITIES[2], BeginOffset=19, EndOffset=20)]
+        assert store.clipped(36, 49) == []
+
+    def test_document_defaults_are_not_shared(self):
+        first_document = Document(text="Some Random text")
+        first_document.pii_classification['SSN'] = 0.5
+        assert Document(text="Other text").pii_classification == {}
+        assert first_document.pii_entities == []
+
+    def test_document_has_slots(self):
+        document = Document(text="Some Random text", char_offset=5, pii_classification={'SSN': 0.5}, pii_entities=ENTITIES)
+        assert isinstance(document.pii_entities, EntityStore)
+        with self.assertRaises(AttributeError):
+            document.some_attribute = 'value'
+
+    def test_segment_result(self):
+        segment = Document(text="Some Random text", char_offset=5)
+        result = SegmentResult(segment, MappingProxyType({'SSN': 0.5}))
+        assert result.text is segment.text
+        assert result.char_offset == 5
+        assert result.pii_entities == []
+        assert segment.pii_classification == {}
+        with self.assertRaises(AttributeError):
+            result.pii_classification = {}
+        with self.assertRaises(TypeError):
+            result.pii_classification['EMAIL'] = 0.9
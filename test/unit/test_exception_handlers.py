@@ -4,7 +4,7 @@ from unittest.mock import patch, MagicMock
 from constants import S3_STATUS_CODES, S3_ERROR_CODES, UNSUPPORTED_FILE_HANDLING_VALID_VALUES
 from exception_handlers import ExceptionHandler
 from exceptions import UnsupportedFileException, FileSizeLimitExceededException, InvalidConfigurationException, \
-    S3DownloadException, RestrictedDocumentException, TimeoutException
+    S3DownloadException, RestrictedDocumentException, TimeoutException, InvalidRangeException
 
 
 class ExceptionHandlerTest(TestCase):
@@ -46,6 +46,15 @@ class ExceptionHandlerTest(TestCase):
                                                                   "Size of the requested object exceeds maximum file size supported",
                                                                   "SomeRoute", "SomeToken")
 
+    def test_invalid_range_handler(self):
+        s3_client = MagicMock()
+        ExceptionHandler(s3_client).handle_exception(InvalidRangeException("The requested range is not satisfiable"),
+                                                     "SomeRoute", "SomeToken")
+        s3_client.respond_back_with_error.assert_called_once_with(S3_STATUS_CODES.RANGE_NOT_SATISFIABLE_416,
+                                                                  S3_ERROR_CODES.InvalidRange,
+                                                                  "The requested range is not satisfiable",
+                                                                  "SomeRoute", "SomeToken")
+
     def test_default_exception_handler(self):
         s3_client = MagicMock()
         ExceptionHandler(s3_client).handle_exception(Exception(), "SomeRoute", "SomeToken")
@@ -1,25 +1,54 @@
 import json
 import os
+import re
 from copy import deepcopy
 from time import sleep
 from unittest import TestCase
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
 
 from config import DEFAULT_LANGUAGE_CODE, DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES, DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES
 from constants import INPUT_S3_URL, GET_OBJECT_CONTEXT, REQUEST_ROUTE, REQUEST_TOKEN, S3_STATUS_CODES, S3_ERROR_CODES, USER_REQUEST, \
-    HEADERS, CONTENT_LENGTH
-from data_object import Document, RedactionConfig, ClassificationConfig
-from exceptions import UnsupportedFileException, FileSizeLimitExceededException
-from handler import get_interested_pii, redact, redact_pii_documents_handler, classify, pii_access_control_handler
+    HEADERS, CONTENT_LENGTH, CONTENT_RANGE, RANGE, PII_PRE_SCREEN_POLICY_VALID_VALUES, S3OL_CONFIGURATION, PAYLOAD
+from data_object import Document, EntityStore, RedactionConfig, ClassificationConfig, SegmentResult
+from cache import RESULT_CACHE
+from clients.client_registry import CLIENT_REGISTRY
+from clients.comprehend_client import ComprehendClient
+from exceptions import UnsupportedFileException, FileSizeLimitExceededException, RestrictedDocumentException
+from handler import get_interested_pii, redact, redact_pii_documents_handler, classify, pii_access_control_handler, redact_in_windows, \
+    classify_in_windows, create_segmenters
 from processors import Segmenter, Redactor
+from segment_planner import LatencyModel, plan_segment_sizes
+from spill import MappedText, spill_file
+from util import Deadline
 
 this_module_path = os.path.dirname(__file__)
+SSN_RE = re.compile(r'\d{3}-\d{2}-\d{4}')
+
+
+def mocked_ssn_detection() -> MagicMock:
+    """Return a mocked comprehend client which finds the ssns of the documents."""
+    comprehend_client = MagicMock()
+    comprehend_client.contains_pii_entities_as_completed.side_effect = lambda documents, language, **kwargs: [
+        SegmentResult(doc, {'SSN': 0.9} if SSN_RE.search(doc.text) else {}) for doc in documents]
+    comprehend_client.detect_pii_documents.side_effect = lambda documents, language, **kwargs: [
+        SegmentResult(doc, {'SSN': 0.9}, EntityStore.from_entities([{'Score': 0.9, 'Type': 'SSN', 'BeginOffset': match.start(),
+                                                                     'EndOffset': match.end()} for match in SSN_RE.finditer(doc.text)]))
+        for doc in documents]
+    return comprehend_client
+
+
+def mapped_text(text: str) -> MappedText:
+    file = spill_file()
+    file.write(text.encode('utf-8'))
+    return MappedText(file)
 
 
 class HandlersTest(TestCase):
     def setUp(self) -> None:
         self.mocked_context = MagicMock()
         self.mocked_context.get_remaining_time_in_millis.return_value = 60000
+        CLIENT_REGISTRY.clear()
+        RESULT_CACHE.clear()
 
     def test_get_interested_pii_true(self):
         assert len(get_interested_pii(Document(text="Some Random text", pii_classification={'SSN': 0.534}),
@@ -38,32 +67,74 @@ class HandlersTest(TestCase):
     def test_redact_with_pii_and_classification(self):
         comprehend_client = MagicMock()
 
-        comprehend_client.contains_pii_entities.return_value = [Document(text="Some Random text", pii_classification={'SSN': 0.53})]
-        comprehend_client.detect_pii_documents.return_value = [Document(text="Some Random text", pii_classification={'SSN': 0.53},
-                                                                        pii_entities=[{'Score': 0.534, 'Type': 'SSN', 'BeginOffset': 0,
-                                                                                       'EndOffset': 4}])]
+        comprehend_client.contains_pii_entities_as_completed.return_value = [
+            Document(text="Some Random text", pii_classification={'SSN': 0.53})]
+        detected_docs = []
+
+        def _detect_pii_documents(documents, language, cancellation_token=None, deadline=None):
+            detected_docs.extend(documents)
+            return [Document(text="Some Random text", pii_classification={'SSN': 0.53},
+                             pii_entities=[{'Score': 0.534, 'Type': 'SSN', 'BeginOffset': 0, 'EndOffset': 4}])]
+
+        comprehend_client.detect_pii_documents.side_effect = _detect_pii_documents
 
         document = redact("Some Random text", Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES),
                           Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES),
                           Redactor(RedactionConfig()), comprehend_client, RedactionConfig(),
                           DEFAULT_LANGUAGE_CODE)
-        comprehend_client.contains_pii_entities.assert_called_once()
+        comprehend_client.contains_pii_entities_as_completed.assert_called_once()
         comprehend_client.detect_pii_documents.assert_called_once()
+        assert [doc.text for doc in detected_docs] == ["Some Random text"]
         assert document.redacted_text == "**** Random text"
 
     @patch('handler.REDACTION_API_ONLY', False)
     def test_redact_with_no_pii_and_classification(self):
         comprehend_client = MagicMock()
 
-        comprehend_client.contains_pii_entities.return_value = [Document(text="Some Random text", pii_classification={})]
+        comprehend_client.contains_pii_entities_as_completed.return_value = [Document(text="Some Random text", pii_classification={})]
+        detected_docs = []
+
+        def _detect_pii_documents(documents, language, cancellation_token=None, deadline=None):
+            detected_docs.extend(documents)
+            return []
+
+        comprehend_client.detect_pii_documents.side_effect = _detect_pii_documents
         document = redact("Some Random text", Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES),
                           Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES),
                           Redactor(RedactionConfig()), comprehend_client, RedactionConfig(),
                           DEFAULT_LANGUAGE_CODE)
-        comprehend_client.contains_pii_entities.assert_called_once()
-        comprehend_client.detect_pii_documents.assert_not_called()
+        comprehend_client.contains_pii_entities_as_completed.assert_called_once()
+        assert len(detected_docs) == 0
         assert document.redacted_text == "Some Random text"
 
+    @patch('handler.REDACTION_API_ONLY', False)
+    @patch('clients.comprehend_client.boto3')
+    def test_redact_pipelines_classification_and_detection(self, mocked_boto3):
+        text = "Some Random text " * 10
+        events = []
+
+        def _contains_pii_entities(Text, LanguageCode):
+            # the first segment is classified quickly, the others take a while
+            sleep(0.5 if events else 0.05)
+            events.append('classified')
+            return {'Labels': [{'Name': 'SSN', 'Score': 0.9}], 'ResponseMetadata': {'RetryAttempts': 0}}
+
+        def _detect_pii_entities(Text, LanguageCode):
+            events.append('detected')
+            return {'Entities': [], 'ResponseMetadata': {'RetryAttempts': 0}}
+
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        mocked_client.contains_pii_entities.side_effect = _contains_pii_entities
+        mocked_client.detect_pii_entities.side_effect = _detect_pii_entities
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn", pii_classification_thread_count=1)
+
+        document = redact(text, Segmenter(60, overlap_tokens=1), Segmenter(30, overlap_tokens=1), Redactor(RedactionConfig()),
+                          comprehend_client, RedactionConfig(), DEFAULT_LANGUAGE_CODE)
+        assert document.redacted_text == text
+        # entity detection of the first segment doesn't wait for the classification of the remaining segments
+        assert events.index('detected') < len(events) - events[::-1].index('classified') - 1
+
     @patch('handler.REDACTION_API_ONLY', True)
     def test_redact_with_pii_and_only_redaction(self):
         comprehend_client = MagicMock()
@@ -98,30 +169,191 @@ class HandlersTest(TestCase):
     def test_classify_with_no_pii(self):
         comprehend_client = MagicMock()
 
-        comprehend_client.contains_pii_entities.return_value = [Document(text="Some Random text", pii_classification={})]
+        comprehend_client.contains_pii_entities_as_completed.return_value = [Document(text="Some Random text", pii_classification={})]
         entities = classify("Some Random text", Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES), comprehend_client,
                             ClassificationConfig(),
                             DEFAULT_LANGUAGE_CODE)
-        comprehend_client.contains_pii_entities.assert_called_once()
+        comprehend_client.contains_pii_entities_as_completed.assert_called_once()
         assert len(entities) == 0
 
     def test_classify_with_pii(self):
         comprehend_client = MagicMock()
 
-        comprehend_client.contains_pii_entities.return_value = [
+        comprehend_client.contains_pii_entities_as_completed.return_value = [
             Document(text="Some Random text", pii_classification={'SSN': 0.53, 'PHONE': 0.49, 'NAME': 0.99})
         ]
         entities = classify("Some Random text", Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES), comprehend_client,
                             ClassificationConfig(),
                             DEFAULT_LANGUAGE_CODE)
-        comprehend_client.contains_pii_entities.assert_called_once()
+        comprehend_client.contains_pii_entities_as_completed.assert_called_once()
         assert len(entities) == 2
         assert 'SSN' in entities
         assert 'NAME' in entities
 
-    @patch('handler.CloudWatchClient')
+    @patch('clients.comprehend_client.boto3')
+    def test_classify_stops_on_first_match(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+
+        def _contains_pii_entities(Text, LanguageCode):
+            sleep(0.05)
+            return {'Labels': [{'Name': 'SSN', 'Score': 0.9}], 'ResponseMetadata': {'RetryAttempts': 0}}
+
+        mocked_client.contains_pii_entities.side_effect = _contains_pii_entities
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn", pii_classification_thread_count=1)
+
+        text = " ".join(f"Some Random text {i}" for i in range(20))
+        entities = classify(text, Segmenter(50, overlap_tokens=1), comprehend_client, ClassificationConfig(),
+                            DEFAULT_LANGUAGE_CODE, stop_on_first_match=True)
+        assert entities == ['SSN']
+        # the calls that haven't started by the time the first segment is classified are cancelled
+        assert mocked_client.contains_pii_entities.call_count < len(Segmenter(50, overlap_tokens=1).segment(text))
+
+    @patch('clients.comprehend_client.boto3')
+    def test_classify_without_stop_on_first_match(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        mocked_client.contains_pii_entities.return_value = {'Labels': [{'Name': 'SSN', 'Score': 0.9}],
+                                                            'ResponseMetadata': {'RetryAttempts': 0}}
+        comprehend_client = ComprehendClient(s3ol_access_point="some_access_point_arn", pii_classification_thread_count=1)
+
+        entities = classify("Some Random text " * 20, Segmenter(50, overlap_tokens=1), comprehend_client, ClassificationConfig(),
+                            DEFAULT_LANGUAGE_CODE)
+        assert entities == ['SSN']
+        # segments with the same text are classified only once
+        segment_texts = {segment.text for segment in Segmenter(50, overlap_tokens=1).segment("Some Random text " * 20)}
+        assert mocked_client.contains_pii_entities.call_count == len(segment_texts)
+
+    def test_create_segmenters(self):
+        comprehend_client = MagicMock(classification_latency=LatencyModel(), detection_latency=LatencyModel(),
+                                      classification_concurrency=20, detection_concurrency=8)
+        text = "Some Random text " * 6000
+        classification_segmenter, detection_segmenter = create_segmenters(text, comprehend_client, Deadline(60000))
+        assert classification_segmenter.max_doc_size == DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES
+        assert detection_segmenter.max_doc_size == DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES
+        with patch('handler.SEGMENT_SIZE_PLANNING', True):
+            classification_segmenter, detection_segmenter = create_segmenters(text, comprehend_client, Deadline(60000))
+            # the classification of the text is spread over every thread
+            assert classification_segmenter.max_doc_size < DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES
+            assert len(classification_segmenter.segment(text)) <= 20
+            assert detection_segmenter.max_doc_size <= DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES
+            classification_segmenter, _ = create_segmenters("", comprehend_client, Deadline(60000), detect_entities=False)
+            assert classification_segmenter.max_doc_size == DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES
+
+    @patch('handler.PII_PRE_SCREEN_POLICY', PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP)
+    def test_redact_with_pre_screen_skipping_clean_segments(self):
+        comprehend_client = mocked_ssn_detection()
+        text = "Nothing to see here. " * 10 + "My SSN is 123-45-6789. " + "Nothing to see here. " * 10
+        segmenter = Segmenter(60, overlap_tokens=2)
+        redaction_config = RedactionConfig(pii_entity_types=['SSN'])
+        document = redact(text, segmenter, Segmenter(60, overlap_tokens=2), Redactor(redaction_config), comprehend_client,
+                          redaction_config, DEFAULT_LANGUAGE_CODE)
+        assert document.redacted_text == text.replace("123-45-6789", "***********")
+        # only the segments holding the ssn are classified by comprehend
+        classified = list(comprehend_client.contains_pii_entities_as_completed.call_args[0][0])
+        segment_count = len(segmenter.segment(text))
+        assert 0 < len(classified) < segment_count
+        assert all("123-45" in doc.text or "45-6789" in doc.text for doc in classified)
+        comprehend_client.classify_metrics.add_pre_screen_candidate_count.assert_called_once_with(len(classified))
+        comprehend_client.classify_metrics.add_pre_screen_clean_count.assert_called_once_with(segment_count - len(classified))
+        comprehend_client.classify_metrics.add_pre_screen_miss_count.assert_not_called()
+
+    @patch('handler.PII_PRE_SCREEN_POLICY', PII_PRE_SCREEN_POLICY_VALID_VALUES.DEPRIORITIZE)
+    def test_classify_with_pre_screen_deprioritizing_clean_segments(self):
+        comprehend_client = MagicMock()
+        comprehend_client.contains_pii_entities_as_completed.side_effect = lambda documents, language, **kwargs: [
+            SegmentResult(doc, {'NAME': 0.9} if "John" in doc.text else {'SSN': 0.9} if SSN_RE.search(doc.text) else {})
+            for doc in documents]
+        text = "My name is John. Nothing to see here. My SSN is 123-45-6789."
+        segmenter = Segmenter(25, overlap_tokens=1)
+        entities = classify(text, segmenter, comprehend_client, ClassificationConfig(), DEFAULT_LANGUAGE_CODE)
+        assert sorted(entities) == ['NAME', 'SSN']
+        # every segment is classified, the ones with candidates first
+        classified = comprehend_client.contains_pii_entities_as_completed.call_args[0][0]
+        assert len(classified) == len(segmenter.segment(text))
+        assert SSN_RE.search(classified[0].text) and not SSN_RE.search(classified[-1].text)
+        # the name was missed by the pre-screen
+        comprehend_client.classify_metrics.add_pre_screen_miss_count.assert_called_once_with(1)
+
+    @patch('handler.SPILL_WINDOW_CONTEXT_SIZE', 20)
+    def test_redact_in_windows(self):
+        text = "Nämé John SSN 123-45-6789. " * 100
+        expected_redaction = SSN_RE.sub('*' * 11, text)
+        for window_size in [50, 97, 1000, 5000]:
+            with mapped_text(text) as mapped, spill_file() as redacted_file:
+                pii_classification = redact_in_windows(mapped, redacted_file, Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES),
+                                                       Segmenter(DOCUMENT_MAX_SIZE_DETECT_PII_ENTITIES), Redactor(RedactionConfig()),
+                                                       mocked_ssn_detection(), RedactionConfig(), DEFAULT_LANGUAGE_CODE,
+                                                       window_size=window_size)
+                redacted_file.seek(0)
+                assert redacted_file.read().decode('utf-8') == expected_redaction
+                assert pii_classification == {'SSN': 0.9}
+
+    @patch('handler.SPILL_WINDOW_CONTEXT_SIZE', 20)
+    def test_classify_in_windows(self):
+        text = "Some Random text " * 100 + "SSN 123-45-6789 " + "Some Random text " * 100
+        comprehend_client = mocked_ssn_detection()
+        with mapped_text(text) as mapped:
+            assert classify_in_windows(mapped, Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES), comprehend_client,
+                                       ClassificationConfig(), DEFAULT_LANGUAGE_CODE, stop_on_first_match=True, window_size=500) == ['SSN']
+            # the windows after the ssn aren't classified
+            assert comprehend_client.contains_pii_entities_as_completed.call_count == 4
+            assert classify_in_windows(mapped, Segmenter(DOCUMENT_MAX_SIZE_CONTAINS_PII_ENTITIES), comprehend_client,
+                                       ClassificationConfig(pii_entity_types=['NAME']), DEFAULT_LANGUAGE_CODE, window_size=500) == []
+
+    @patch('handler.SPILL_THRESHOLD', 100)
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.ComprehendClient')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_spilled_object(self, s3_client, comprehend_client, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        sample_text = "Nämé John SSN 123-45-6789. " * 10
+        spilled_text = mapped_text(sample_text)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.return_value = spilled_text, {CONTENT_LENGTH: '290', 'ETag': '"abc"'}, \
+                                                                         S3_STATUS_CODES.OK_200
+        responses = []
+        mocked_s3_client.respond_back_with_data.side_effect = lambda data, headers, *args: responses.append((data.read(), dict(headers)))
+        comprehend_client.return_value = mocked_ssn_detection()
+        mocked_cloudwatch = MagicMock()
+        cloudwatch.return_value = mocked_cloudwatch
+
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=100, trim_partial_characters=False)
+        redacted_text = SSN_RE.sub('*' * 11, sample_text).encode('utf-8')
+        assert responses == [(redacted_text, {CONTENT_LENGTH: len(redacted_text), 'ETag': '"abc"'})]
+        # the spilled file is deleted once the object is processed
+        assert spilled_text.file.closed
+        mocked_cloudwatch.put_pii_document_types_metric.assert_called_once_with(['SSN'], ANY, ANY)
+        assert len(RESULT_CACHE.local_tier) == 0
+
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.ComprehendClient')
+    @patch('clients.client_registry.S3Client')
+    def test_detection_handler_spilled_object(self, s3_client, comprehend_client, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        sample_text = "Nämé John. " * 10
+        spilled_text = mapped_text(sample_text)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.return_value = spilled_text, {CONTENT_LENGTH: '120'}, S3_STATUS_CODES.OK_200
+        responses = []
+        mocked_s3_client.respond_back_with_data.side_effect = lambda data, headers, *args: responses.append(data.read())
+        comprehend_client.return_value = mocked_ssn_detection()
+
+        pii_access_control_handler(sample_event, self.mocked_context)
+        # the object is passed back from the file it was spilled to
+        assert responses == [sample_text.encode('utf-8')]
+        assert spilled_text.file.closed
+
+    @patch('clients.client_registry.CloudWatchClient')
     @patch('handler.redact')
-    @patch('handler.S3Client')
+    @patch('clients.client_registry.S3Client')
     def test_redaction_handler_success(self, s3_client, mocked_redact, cloudwatch):
         with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
             sample_event = json.load(file_pointer)
@@ -144,16 +376,233 @@ class HandlersTest(TestCase):
         redact_pii_documents_handler(sample_event, self.mocked_context)
         mocked_redact.assert_called_once()
         mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
-                                                                                  sample_event[USER_REQUEST][HEADERS])
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=0, trim_partial_characters=False)
         mocked_s3_client.respond_back_with_data.assert_called_once_with(sample_redacted_text.encode('utf-8'),
                                                                         expected_response_http_headers,
                                                                         sample_event[GET_OBJECT_CONTEXT][REQUEST_ROUTE],
                                                                         sample_event[GET_OBJECT_CONTEXT][REQUEST_TOKEN],
                                                                         S3_STATUS_CODES.PARTIAL_CONTENT_206)
 
+    @patch('handler.STREAMING_RESPONSE_THRESHOLD', 10)
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.ComprehendClient')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_streaming_response(self, s3_client, comprehend_client, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        sample_text = "My SSN is 123-45-6789 and my name is John"
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.return_value = sample_text, {CONTENT_LENGTH: '41', 'ETag': '"abc"'}, \
+                                                                         S3_STATUS_CODES.OK_200
+        streamed_bodies = []
+        mocked_s3_client.respond_back_with_data.side_effect = lambda data, *args: streamed_bodies.append(list(data))
+        mocked_comprehend_client = MagicMock()
+        comprehend_client.return_value = mocked_comprehend_client
+        mocked_comprehend_client.contains_pii_entities_as_completed.side_effect = \
+            lambda documents, language, **kwargs: [SegmentResult(doc, {'SSN': 0.9}) for doc in documents]
+        ssn = EntityStore.from_entities([{'Score': 0.95, 'Type': 'SSN', 'BeginOffset': 10, 'EndOffset': 21}])
+        mocked_comprehend_client.detect_pii_documents_as_completed.side_effect = \
+            lambda documents, language, **kwargs: [SegmentResult(doc, {'SSN': 0.95}, ssn) for doc in list(documents)]
+        mocked_cloudwatch = MagicMock()
+        cloudwatch.return_value = mocked_cloudwatch
+
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        assert ''.join(streamed_bodies[0]) == "My SSN is *********** and my name is John"
+        # the length of the redacted text isn't known before it is sent
+        mocked_s3_client.respond_back_with_data.assert_called_once_with(ANY, {'ETag': '"abc"'},
+                                                                        sample_event[GET_OBJECT_CONTEXT][REQUEST_ROUTE],
+                                                                        sample_event[GET_OBJECT_CONTEXT][REQUEST_TOKEN],
+                                                                        S3_STATUS_CODES.OK_200)
+        mocked_cloudwatch.put_pii_document_types_metric.assert_called_once_with(['SSN'], ANY, ANY)
+        assert len(RESULT_CACHE.local_tier) == 0
+
+    @patch('validators.IS_PARTIAL_OBJECT_SUPPORTED', True)
+    @patch('handler.IS_PARTIAL_OBJECT_SUPPORTED', True)
+    @patch('clients.client_registry.CloudWatchClient')
     @patch('handler.redact')
-    @patch('handler.CloudWatchClient')
-    @patch('handler.S3Client')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_range_request(self, s3_client, mocked_redact, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        sample_event[USER_REQUEST][HEADERS][RANGE] = "bytes=10-20"
+        sample_text = "My SSN is 123-45-6789 and my name is John"
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.return_value = sample_text, {CONTENT_RANGE: "bytes 0-40/41"}, \
+                                                                         S3_STATUS_CODES.PARTIAL_CONTENT_206
+        mocked_redact.return_value = Document(sample_text, pii_classification={'SSN': 0.9}, redacted_text="not used",
+                                              pii_entities=[{'Score': 0.9, 'Type': 'SSN', 'BeginOffset': 10, 'EndOffset': 21}])
+
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        # the range is downloaded with some context on each side
+        mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(
+            sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL], dict(sample_event[USER_REQUEST][HEADERS], Range="bytes=0-1044"), ANY, ANY,
+            spill_threshold=0, trim_partial_characters=True)
+        assert mocked_redact.call_args[0][0] == sample_text
+        mocked_s3_client.respond_back_with_data.assert_called_once_with(b"***********",
+                                                                        {CONTENT_RANGE: "bytes 10-20/41", CONTENT_LENGTH: 11},
+                                                                        sample_event[GET_OBJECT_CONTEXT][REQUEST_ROUTE],
+                                                                        sample_event[GET_OBJECT_CONTEXT][REQUEST_TOKEN],
+                                                                        S3_STATUS_CODES.PARTIAL_CONTENT_206)
+
+    @patch('validators.IS_PARTIAL_OBJECT_SUPPORTED', True)
+    @patch('handler.IS_PARTIAL_OBJECT_SUPPORTED', True)
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('handler.redact')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_range_request_multibyte(self, s3_client, mocked_redact, cloudwatch):
+        sample_text = "Nämé José SSN 123-45-6789 end"
+        # the name takes 5 bytes, which the body of the response has to keep whatever it is redacted with
+        expected_bodies = {'MASK': "Nämé ***** SSN 123-", 'REPLACE_WITH_PII_ENTITY_TYPE': "Nämé [NAME SSN 123-"}
+        for mask_mode, expected_body in expected_bodies.items():
+            with self.subTest(mask_mode=mask_mode):
+                CLIENT_REGISTRY.clear()
+                RESULT_CACHE.clear()
+                with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+                    sample_event = json.load(file_pointer)
+                sample_event[USER_REQUEST][HEADERS][RANGE] = "bytes=0-20"
+                sample_event[S3OL_CONFIGURATION][PAYLOAD] = json.dumps({'mask_mode': mask_mode})
+                mocked_s3_client = MagicMock()
+                s3_client.return_value = mocked_s3_client
+                mocked_s3_client.download_file_from_presigned_url.return_value = sample_text, {CONTENT_RANGE: "bytes 0-31/32"}, \
+                    S3_STATUS_CODES.PARTIAL_CONTENT_206
+                mocked_redact.return_value = Document(sample_text, pii_classification={'NAME': 0.9},
+                                                      pii_entities=[{'Score': 0.9, 'Type': 'NAME', 'BeginOffset': 5, 'EndOffset': 9}])
+
+                redact_pii_documents_handler(sample_event, self.mocked_context)
+                body = expected_body.encode('utf-8')
+                assert len(body) == 21
+                mocked_s3_client.respond_back_with_data.assert_called_once_with(body, {CONTENT_RANGE: "bytes 0-20/32", CONTENT_LENGTH: 21},
+                                                                                ANY, ANY, S3_STATUS_CODES.PARTIAL_CONTENT_206)
+
+    @patch('clients.comprehend_client.boto3')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
+    @patch('handler.SEGMENT_SIZE_PLANNING', True)
+    def test_redaction_handler_tiny_object_with_segment_size_planning(self, s3_client, cloudwatch, mocked_boto3):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_boto3.client.return_value.contains_pii_entities.return_value = {'Labels': [], 'ResponseMetadata': {'RetryAttempts': 0}}
+        for text in ['hi', 'abc', 'é']:
+            with self.subTest(text=text):
+                mocked_s3_client.download_file_from_presigned_url.return_value = text, {}, S3_STATUS_CODES.OK_200
+
+                redact_pii_documents_handler(sample_event, self.mocked_context)
+                body = text.encode('utf-8')
+                mocked_s3_client.respond_back_with_data.assert_called_with(body, {CONTENT_LENGTH: len(body)}, ANY, ANY,
+                                                                           S3_STATUS_CODES.OK_200)
+
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('handler.redact')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_reuses_clients_across_invocations(self, s3_client, mocked_redact, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.return_value = "Some Random text", {}, S3_STATUS_CODES.OK_200
+        mocked_redact.return_value = Document("Some Random text", redacted_text="Some Random text")
+
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+
+        s3_client.assert_called_once()
+        cloudwatch.assert_called_once()
+        assert mocked_s3_client.begin_request.call_count == 2
+        assert mocked_s3_client.respond_back_with_data.call_count == 2
+
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('handler.redact')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_serves_unchanged_object_from_result_cache(self, s3_client, mocked_redact, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.side_effect = lambda *args, **kwargs: (
+            "Some Random text", {'ETag': '"etag1"'}, S3_STATUS_CODES.OK_200)
+        mocked_redact.return_value = Document("Some Random text", pii_classification={'SSN': 0.9}, redacted_text="**** Random text")
+
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        mocked_redact.assert_called_once()
+        assert mocked_s3_client.respond_back_with_data.call_count == 2
+        for call in mocked_s3_client.respond_back_with_data.call_args_list:
+            assert call[0][0] == "**** Random text".encode('utf-8')
+
+        mocked_s3_client.download_file_from_presigned_url.side_effect = lambda *args, **kwargs: (
+            "Some Random text", {'ETag': '"etag2"'}, S3_STATUS_CODES.OK_200)
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        assert mocked_redact.call_count == 2
+
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('handler.redact')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_result_cache_keyed_by_pre_screen_policy(self, s3_client, mocked_redact, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.side_effect = lambda *args, **kwargs: (
+            "Some Random text", {'ETag': '"etag1"'}, S3_STATUS_CODES.OK_200)
+        mocked_redact.return_value = Document("Some Random text", redacted_text="Some Random text")
+
+        with patch('handler.PII_PRE_SCREEN_POLICY', PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP):
+            redact_pii_documents_handler(sample_event, self.mocked_context)
+        # a result which may have skipped segments isn't served once they are sent to comprehend again
+        with patch('handler.PII_PRE_SCREEN_POLICY', PII_PRE_SCREEN_POLICY_VALID_VALUES.OFF):
+            redact_pii_documents_handler(sample_event, self.mocked_context)
+        assert mocked_redact.call_count == 2
+        with patch('handler.PII_PRE_SCREEN_POLICY', PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP):
+            redact_pii_documents_handler(sample_event, self.mocked_context)
+        assert mocked_redact.call_count == 2
+
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('handler.redact')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_result_cache_keyed_by_segment_size_planning(self, s3_client, mocked_redact, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.side_effect = lambda *args, **kwargs: (
+            "Some Random text", {'ETag': '"etag1"'}, S3_STATUS_CODES.OK_200)
+        mocked_redact.return_value = Document("Some Random text", redacted_text="Some Random text")
+
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        # planned segments can be smaller than the largest ones, so they may not find the same pii
+        with patch('handler.SEGMENT_SIZE_PLANNING', True):
+            redact_pii_documents_handler(sample_event, self.mocked_context)
+            assert mocked_redact.call_count == 2
+            # served whatever the sizes planned this time, which follow the latencies observed
+            with patch('handler.plan_segment_sizes', side_effect=lambda *args, **kwargs: plan_segment_sizes(*args, **kwargs)._replace(
+                    classification_size=1000, detection_size=500)):
+                redact_pii_documents_handler(sample_event, self.mocked_context)
+            assert mocked_redact.call_count == 2
+
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('handler.redact')
+    @patch('clients.client_registry.S3Client')
+    def test_redaction_handler_without_etag_skips_result_cache(self, s3_client, mocked_redact, cloudwatch):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.side_effect = lambda *args, **kwargs: (
+            "Some Random text", {}, S3_STATUS_CODES.OK_200)
+        mocked_redact.return_value = Document("Some Random text", redacted_text="Some Random text")
+
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        redact_pii_documents_handler(sample_event, self.mocked_context)
+        assert mocked_redact.call_count == 2
+
+    @patch('handler.redact')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
     def test_redaction_handler_success_lambda_timedout(self, s3_client, cloudwatch, mocked_redact):
         with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
             sample_event = json.load(file_pointer)
@@ -178,7 +627,8 @@ class HandlersTest(TestCase):
         redact_pii_documents_handler(sample_event, self.mocked_context)
         mocked_redact.assert_called_once()
         mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
-                                                                                  sample_event[USER_REQUEST][HEADERS])
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=0, trim_partial_characters=False)
         mocked_s3_client.respond_back_with_error.assert_called_once_with(S3_STATUS_CODES.BAD_REQUEST_400,
                                                                          S3_ERROR_CODES.RequestTimeout,
                                                                          "Failed to complete document processing within time limit",
@@ -187,9 +637,9 @@ class HandlersTest(TestCase):
 
         mocked_cloudwatch.publish_metrics.assert_called_once()
 
-    @patch('handler.CloudWatchClient')
+    @patch('clients.client_registry.CloudWatchClient')
     @patch('handler.redact')
-    @patch('handler.S3Client')
+    @patch('clients.client_registry.S3Client')
     def test_redaction_handler_success_empty_payload(self, s3_client, mocked_redact, cloudwatch):
         with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
             sample_event = json.load(file_pointer)
@@ -212,16 +662,17 @@ class HandlersTest(TestCase):
         redact_pii_documents_handler(sample_event, self.mocked_context)
         mocked_redact.assert_called_once()
         mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
-                                                                                  sample_event[USER_REQUEST][HEADERS])
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=0, trim_partial_characters=False)
         mocked_s3_client.respond_back_with_data.assert_called_once_with(sample_redacted_text.encode('utf-8'),
                                                                         expected_response_http_headers,
                                                                         sample_event[GET_OBJECT_CONTEXT][REQUEST_ROUTE],
                                                                         sample_event[GET_OBJECT_CONTEXT][REQUEST_TOKEN],
                                                                         S3_STATUS_CODES.PARTIAL_CONTENT_206)
 
-    @patch('handler.CloudWatchClient')
+    @patch('clients.client_registry.CloudWatchClient')
     @patch('handler.redact')
-    @patch('handler.S3Client')
+    @patch('clients.client_registry.S3Client')
     @patch('handler.ExceptionHandler')
     def test_redaction_handler_failure(self, exception_handler, s3_client, mocked_redact, cloudwatch):
         with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
@@ -241,14 +692,15 @@ class HandlersTest(TestCase):
 
         redact_pii_documents_handler(sample_event, self.mocked_context)
         mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
-                                                                                  sample_event[USER_REQUEST][HEADERS])
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=0, trim_partial_characters=False)
         mocked_exception_handler.handle_exception.assert_called_once_with(exception,
                                                                           sample_event[GET_OBJECT_CONTEXT][REQUEST_ROUTE],
                                                                           sample_event[GET_OBJECT_CONTEXT][REQUEST_TOKEN])
 
     @patch('handler.classify')
-    @patch('handler.CloudWatchClient')
-    @patch('handler.S3Client')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
     def test_detection_handler_success_no_pii(self, s3_client, cloudwatch, mocked_classify):
         with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
             sample_event = json.load(file_pointer)
@@ -268,7 +720,8 @@ class HandlersTest(TestCase):
         pii_access_control_handler(sample_event, self.mocked_context)
         mocked_classify.assert_called_once()
         mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
-                                                                                  sample_event[USER_REQUEST][HEADERS])
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=0, trim_partial_characters=False)
         mocked_s3_client.respond_back_with_data.assert_called_once_with(sample_text.encode('utf-8'), expected_response_http_headers,
                                                                         sample_event[GET_OBJECT_CONTEXT][REQUEST_ROUTE],
                                                                         sample_event[GET_OBJECT_CONTEXT][REQUEST_TOKEN],
@@ -276,9 +729,74 @@ class HandlersTest(TestCase):
 
         mocked_cloudwatch.put_document_processed_metric.assert_called_once()
 
+    @patch('validators.IS_PARTIAL_OBJECT_SUPPORTED', True)
+    @patch('handler.IS_PARTIAL_OBJECT_SUPPORTED', True)
+    @patch('handler.classify')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
+    def test_detection_handler_range_request(self, s3_client, cloudwatch, mocked_classify):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        sample_event[USER_REQUEST][HEADERS][RANGE] = "bytes=-4"
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.return_value = "name is John", {CONTENT_RANGE: "bytes 29-40/41"}, \
+                                                                         S3_STATUS_CODES.PARTIAL_CONTENT_206
+        mocked_classify.return_value = []
+
+        pii_access_control_handler(sample_event, self.mocked_context)
+        mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(
+            sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL], dict(sample_event[USER_REQUEST][HEADERS], Range="bytes=-1028"), ANY, ANY,
+            spill_threshold=0, trim_partial_characters=True)
+        mocked_s3_client.respond_back_with_data.assert_called_once_with(b"John", {CONTENT_RANGE: "bytes 37-40/41", CONTENT_LENGTH: 4},
+                                                                        sample_event[GET_OBJECT_CONTEXT][REQUEST_ROUTE],
+                                                                        sample_event[GET_OBJECT_CONTEXT][REQUEST_TOKEN],
+                                                                        S3_STATUS_CODES.PARTIAL_CONTENT_206)
+
+    @patch('handler.classify')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
+    def test_detection_handler_serves_unchanged_object_from_result_cache(self, s3_client, cloudwatch, mocked_classify):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_exception_handler = MagicMock()
+        mocked_s3_client.download_file_from_presigned_url.side_effect = lambda *args, **kwargs: (
+            "Some Random text", {'ETag': '"etag1"'}, S3_STATUS_CODES.OK_200)
+        mocked_classify.return_value = ['SSN']
+
+        with patch('handler.ExceptionHandler', return_value=mocked_exception_handler):
+            pii_access_control_handler(sample_event, self.mocked_context)
+            pii_access_control_handler(sample_event, self.mocked_context)
+        mocked_classify.assert_called_once()
+        assert mocked_exception_handler.handle_exception.call_count == 2
+        for call in mocked_exception_handler.handle_exception.call_args_list:
+            assert isinstance(call[0][0], RestrictedDocumentException)
+        mocked_s3_client.respond_back_with_data.assert_not_called()
+
+    @patch('handler.classify')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
+    def test_detection_handler_result_cache_keyed_by_pre_screen_policy(self, s3_client, cloudwatch, mocked_classify):
+        with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
+            sample_event = json.load(file_pointer)
+        mocked_s3_client = MagicMock()
+        s3_client.return_value = mocked_s3_client
+        mocked_s3_client.download_file_from_presigned_url.side_effect = lambda *args, **kwargs: (
+            "Some Random text", {'ETag': '"etag1"'}, S3_STATUS_CODES.OK_200)
+        mocked_classify.return_value = []
+
+        with patch('handler.PII_PRE_SCREEN_POLICY', PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP):
+            pii_access_control_handler(sample_event, self.mocked_context)
+        with patch('handler.PII_PRE_SCREEN_POLICY', PII_PRE_SCREEN_POLICY_VALID_VALUES.OFF):
+            pii_access_control_handler(sample_event, self.mocked_context)
+        assert mocked_classify.call_count == 2
+        assert mocked_s3_client.respond_back_with_data.call_count == 2
+
     @patch('handler.classify')
-    @patch('handler.CloudWatchClient')
-    @patch('handler.S3Client')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
     def test_detection_handler_success_lambda_timedout(self, s3_client, cloudwatch, mocked_classify):
         with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
             sample_event = json.load(file_pointer)
@@ -303,7 +821,8 @@ class HandlersTest(TestCase):
         pii_access_control_handler(sample_event, self.mocked_context)
         mocked_classify.assert_called_once()
         mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
-                                                                                  sample_event[USER_REQUEST][HEADERS])
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=0, trim_partial_characters=False)
         mocked_s3_client.respond_back_with_error.assert_called_once_with(S3_STATUS_CODES.BAD_REQUEST_400,
                                                                          S3_ERROR_CODES.RequestTimeout,
                                                                          "Failed to complete document processing within time limit",
@@ -313,8 +832,8 @@ class HandlersTest(TestCase):
         mocked_cloudwatch.publish_metrics.assert_called_once()
 
     @patch('handler.classify')
-    @patch('handler.CloudWatchClient')
-    @patch('handler.S3Client')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
     def test_detection_handler_success_with_pii(self, s3_client, cloudwatch, mocked_classify):
         with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
             sample_event = json.load(file_pointer)
@@ -331,7 +850,8 @@ class HandlersTest(TestCase):
         pii_access_control_handler(sample_event, self.mocked_context)
         mocked_classify.assert_called_once()
         mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
-                                                                                  sample_event[USER_REQUEST][HEADERS])
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=0, trim_partial_characters=False)
         mocked_s3_client.respond_back_with_error.assert_called_once_with(S3_STATUS_CODES.FORBIDDEN_403,
                                                                          S3_ERROR_CODES.AccessDenied,
                                                                          "Document Contains PII",
@@ -344,8 +864,8 @@ class HandlersTest(TestCase):
         mocked_cloudwatch.put_pii_document_types_metric.assert_called_once()
 
     @patch('handler.classify')
-    @patch('handler.CloudWatchClient')
-    @patch('handler.S3Client')
+    @patch('clients.client_registry.CloudWatchClient')
+    @patch('clients.client_registry.S3Client')
     @patch('handler.ExceptionHandler')
     def test_detection_handler_failure(self, exception_handler, s3_client, cloudwatch, mocked_classify):
         with open(os.path.join(this_module_path, "..", 'data', 'sample_event.json'), 'r') as file_pointer:
@@ -364,7 +884,8 @@ class HandlersTest(TestCase):
 
         pii_access_control_handler(sample_event, self.mocked_context)
         mocked_s3_client.download_file_from_presigned_url.assert_called_once_with(sample_event[GET_OBJECT_CONTEXT][INPUT_S3_URL],
-                                                                                  sample_event[USER_REQUEST][HEADERS])
+                                                                                  sample_event[USER_REQUEST][HEADERS], ANY, ANY,
+                                                                                  spill_threshold=0, trim_partial_characters=False)
         mocked_exception_handler.handle_exception.assert_called_once_with(exception,
                                                                           sample_event[GET_OBJECT_CONTEXT][REQUEST_ROUTE],
                                                                           sample_event[GET_OBJECT_CONTEXT][REQUEST_TOKEN])
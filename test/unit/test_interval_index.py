@@ -0,0 +1,42 @@
+from random import Random
+from unittest import TestCase
+
+from interval_index import IntervalIndex
+
+
+def _index(spans):
+    return IntervalIndex([span[0] for span in spans], [span[1] for span in spans])
+
+
+class IntervalIndexTest(TestCase):
+    def test_overlapping(self):
+        index = _index([(54, 65), (58, 65), (10, 20), (65, 70), (0, 100)])
+        assert len(index) == 5
+        assert index.overlapping(58, 65) == [4, 0, 1]
+        assert index.overlapping(20, 54) == [4]
+        assert index.overlapping(64, 66) == [4, 0, 1, 3]
+        assert _index([]).overlapping(0, 10) == []
+
+    def test_overlapping_matches_brute_force(self):
+        rand = Random(7)
+        spans = [(begin, begin + rand.randint(1, 30)) for begin in (rand.randint(0, 1000) for _ in range(500))]
+        index = _index(spans)
+        for _ in range(200):
+            begin = rand.randint(0, 1000)
+            end = begin + rand.randint(1, 50)
+            assert sorted(index.overlapping(begin, end)) == [i for i, span in enumerate(spans) if span[0] < end and span[1] > begin]
+
+    def test_clusters(self):
+        index = _index([(30, 35), (0, 10), (5, 12), (12, 20), (11, 13)])
+        assert list(index.clusters()) == [[1, 2, 4, 3], [0]]
+
+    def test_resolve_by_score(self):
+        index = _index([(0, 10), (5, 12), (11, 20), (30, 35)])
+        assert index.resolve_by_score([0.5, 0.9, 0.6, 0.1]) == [1, 3]
+        # ties go to the span which begins first
+        assert index.resolve_by_score([0.5, 0.5, 0.5, 0.5]) == [0, 2, 3]
+
+    def test_resolve_by_score_with_groups(self):
+        index = _index([(0, 10), (5, 12), (8, 15), (30, 35)])
+        assert index.resolve_by_score([0.5, 0.9, 0.6, 0.1], groups=[0, 0, 1, 1]) == [0, 1, 3]
+        assert index.resolve_by_score([0.5, 0.4, 0.6, 0.1], groups=[0, 0, 1, 1]) == [2, 3]
@@ -0,0 +1,100 @@
+from unittest import TestCase
+
+from constants import RANGE
+from data_object import EntityStore, RedactionConfig
+from exceptions import InvalidRangeException, InvalidRequestException
+from partial_object import ByteRange, PartialObject, RangeRequest, content_range, parse_content_range
+from processors import Redactor
+
+
+class PartialObjectTest(TestCase):
+    def test_range_request_from_headers(self):
+        assert RangeRequest.from_headers({RANGE: "bytes=10-20"}) == RangeRequest(10, 20, None)
+        assert RangeRequest.from_headers({RANGE: "bytes=10-"}) == RangeRequest(10, None, None)
+        assert RangeRequest.from_headers({RANGE: "bytes=-20"}) == RangeRequest(None, None, 20)
+        assert RangeRequest.from_headers({}) is None
+        # malformed ranges are ignored
+        assert RangeRequest.from_headers({RANGE: "0-100"}) is None
+        assert RangeRequest.from_headers({RANGE: "bytes=20-10"}) is None
+        with self.assertRaises(InvalidRequestException):
+            RangeRequest.from_headers({RANGE: "bytes=0-10,20-30"})
+
+    def test_range_request_widened(self):
+        assert RangeRequest(1000, 2000, None).widened(100) == "bytes=900-2100"
+        assert RangeRequest(50, 2000, None).widened(100) == "bytes=0-2100"
+        assert RangeRequest(1000, None, None).widened(100) == "bytes=900-"
+        assert RangeRequest(None, None, 500).widened(100) == "bytes=-600"
+        # widened by at least a character on each side
+        assert RangeRequest(1000, 2000, None).widened(0) == "bytes=997-2003"
+
+    def test_range_request_resolve(self):
+        assert RangeRequest(10, 20, None).resolve(100) == ByteRange(10, 20)
+        assert RangeRequest(10, 200, None).resolve(100) == ByteRange(10, 99)
+        assert RangeRequest(10, None, None).resolve(100) == ByteRange(10, 99)
+        assert RangeRequest(None, None, 30).resolve(100) == ByteRange(70, 99)
+        assert RangeRequest(None, None, 300).resolve(100) == ByteRange(0, 99)
+        assert len(ByteRange(10, 20)) == 11
+        with self.assertRaises(InvalidRangeException):
+            RangeRequest(100, 200, None).resolve(100)
+        with self.assertRaises(InvalidRangeException):
+            RangeRequest(None, None, 0).resolve(100)
+
+    def test_content_range(self):
+        assert parse_content_range("bytes 10-20/100") == (ByteRange(10, 20), 100)
+        assert parse_content_range("bytes 10-20/*") == (ByteRange(10, 20), None)
+        assert content_range(ByteRange(10, 20), 100) == "bytes 10-20/100"
+        with self.assertRaises(ValueError):
+            parse_content_range("bytes */100")
+
+    def test_partial_object_ascii(self):
+        text = "My SSN is 123-45-6789 and my name is John"
+        # window of bytes 100 to 140 of the object, bytes 110 to 120 requested
+        partial_object = PartialObject(text, {'Content-Range': "bytes 100-140/1000"}, RangeRequest(110, 120, None))
+        assert partial_object.requested == ByteRange(110, 120)
+        assert partial_object.characters == ByteRange(110, 120)
+        assert partial_object.requested_bytes() == b"123-45-6789"
+        entities = EntityStore.from_entities([{'Type': 'SSN', 'Score': 0.9, 'BeginOffset': 10, 'EndOffset': 21}])
+        assert partial_object.redact(entities, Redactor(RedactionConfig())) == "***********"
+
+    def test_partial_object_entity_cut_by_range(self):
+        text = "My SSN is 123-45-6789 and my name is John"
+        partial_object = PartialObject(text, {}, RangeRequest(None, None, 27))
+        assert partial_object.requested == ByteRange(14, 40)
+        assert partial_object.object_size == len(text)
+        entities = EntityStore.from_entities([{'Type': 'SSN', 'Score': 0.9, 'BeginOffset': 10, 'EndOffset': 21}])
+        assert partial_object.redact(entities, Redactor(RedactionConfig())) == "******* and my name is John"
+        # padded to the bytes of the part of the entity in the range
+        assert partial_object.redact(entities, Redactor(RedactionConfig(mask_mode='REPLACE_WITH_PII_ENTITY_TYPE'))) == \
+            "[SSN]** and my name is John"
+
+    def test_partial_object_redaction_keeps_byte_length(self):
+        text = "Nämé José SSN 123-45-6789 end"
+        partial_object = PartialObject(text, {}, RangeRequest(0, 20, None))
+        entities = EntityStore.from_entities([{'Type': 'NAME', 'Score': 0.9, 'BeginOffset': 5, 'EndOffset': 9}])
+        for redaction_config, expected in [(RedactionConfig(), "Nämé ***** SSN 123-"),
+                                           (RedactionConfig(mask_mode='REPLACE_WITH_PII_ENTITY_TYPE'), "Nämé [NAME SSN 123-"),
+                                           (RedactionConfig(mask_character='█'), "Nämé █** SSN 123-")]:
+            redacted = partial_object.redact(entities, Redactor(redaction_config))
+            assert redacted == expected
+            assert len(redacted.encode('utf-8')) == len(partial_object.characters)
+
+    def test_partial_object_multibyte_characters(self):
+        text = "né à 文字 😀 end"
+        encoded = text.encode('utf-8')
+        size = len(encoded)
+        ranges = [RangeRequest(first, min(first + 4, size - 1), None) for first in range(0, size, 5)]
+        parts = [PartialObject(text, {}, range_request) for range_request in ranges]
+        # characters cut by a range are returned with the range they start in, so that consecutive ranges add up to the text
+        assert ''.join(text[part.begin:part.end] for part in parts) == text
+        for part, range_request in zip(parts, ranges):
+            assert part.characters.first >= range_request.first
+            assert encoded[part.characters.first:part.characters.last + 1].decode('utf-8') == text[part.begin:part.end]
+            assert part.requested_bytes() == encoded[range_request.first:range_request.last + 1]
+
+    def test_partial_object_range_without_characters(self):
+        text = "文字"
+        # the second byte of the first character starts no character
+        partial_object = PartialObject(text, {}, RangeRequest(1, 1, None))
+        assert partial_object.begin == partial_object.end
+        assert partial_object.characters == ByteRange(1, 1)
+        assert partial_object.redact(EntityStore(), Redactor(RedactionConfig())) == ''
@@ -3,10 +3,11 @@ import timeit
 from random import shuffle
 from unittest import TestCase
 
-from constants import REPLACE_WITH_PII_ENTITY_TYPE
+from constants import REPLACE_WITH_PII_ENTITY_TYPE, PII_PRE_SCREEN_POLICY_VALID_VALUES
 from data_object import Document, RedactionConfig
-from exceptions import InvalidConfigurationException
-from processors import Redactor, Segmenter
+from exceptions import DeadlineExceededException, InvalidConfigurationException
+from processors import IncrementalRedactor, PiiPreScreen, Redactor, Segmenter, Utf8ByteIndex, luhn_checksum_valid
+from util import Deadline
 
 this_module_path = os.path.dirname(__file__)
 
@@ -37,6 +38,12 @@ class ProcessorsTest(TestCase):
         assert segments[0].text == original_text
         assert segmentor.de_segment(segments).text == original_text
 
+    def test_segmenter_single_char_text(self):
+        segmentor = Segmenter(5000, overlap_tokens=3)
+        segments = segmentor.segment("é")
+        assert [segment.text for segment in segments] == ["é"]
+        assert segmentor.de_segment(segments).text == "é"
+
     def test_segmenter_max_chars_limit(self):
         segmentor = Segmenter(50, overlap_tokens=3, max_overlapping_chars=20)
         original_text = "BarackHusseinObamaIIisanAmerican politicianandattorneywhoservedasthe " \
@@ -53,6 +60,14 @@ class ProcessorsTest(TestCase):
         shuffle(segments)
         assert segmentor.de_segment(segments).text == original_text
 
+    def test_segmenter_checks_deadline(self):
+        text = "Some Random text " * 10
+        assert len(Segmenter(50, overlap_tokens=3, deadline=Deadline(60000)).segment(text)) > 1
+        assert len(Segmenter(5000, deadline=Deadline(0)).segment(text)) == 1
+        with self.assertRaises(DeadlineExceededException) as e:
+            Segmenter(50, overlap_tokens=3, deadline=Deadline(0)).segment(text)
+        assert e.exception.operation == "segmentation"
+
     def test_segmenter_unicode_chars(self):
         segmentor = Segmenter(100, overlap_tokens=3)
         original_text = "ʕ•́ᴥ•̀ʔっ♡ Emoticons 😜 ʕ•́ᴥ•̀ʔっ♡ Emoticons 😜 ᗷᙓ ò¥¥¥¥¥¥¥ᗢᖇᓮᘐᓰﬡᗩᒪ ℬ℮ ¢◎øł Bᴇ ʏᴏᴜʀsᴇʟғ विकिपीडिया सभी विषयों पर प्रामाणिक और उपयोग, " \
@@ -102,11 +117,40 @@ class ProcessorsTest(TestCase):
         assert expected_merged_document.pii_classification == actual_merged_doc.pii_classification
         assert expected_merged_document.pii_entities == actual_merged_doc.pii_entities
 
+    def test_desegment_resolves_conflicts_with_first_entity(self):
+        segments = [Document(text="Call 555-0100 now", char_offset=0,
+                             pii_entities=[{'Score': 0.4, 'Type': 'PHONE', 'BeginOffset': 5, 'EndOffset': 13}]),
+                    Document(text="555-0100 now please", char_offset=5,
+                             pii_entities=[{'Score': 0.9, 'Type': 'PHONE', 'BeginOffset': 0, 'EndOffset': 8}])]
+        merged_doc = Segmenter(5000).de_segment(segments)
+        assert merged_doc.text == "Call 555-0100 now please"
+        assert merged_doc.pii_entities == [{'Score': 0.9, 'Type': 'PHONE', 'BeginOffset': 5, 'EndOffset': 13}]
+        # the entities of the segments are left untouched
+        assert segments[1].pii_entities == [{'Score': 0.9, 'Type': 'PHONE', 'BeginOffset': 0, 'EndOffset': 8}]
 
-    def test_is_overlapping_annotations(self):
-        segmentor = Segmenter(5000)
-        assert segmentor._is_overlapping_annotations({'Score': 0.634, 'Type': 'ADDRESS', 'BeginOffset': 54, 'EndOffset': 65},
-                                                     {'Score': 0.234, 'Type': 'ADDRESS', 'BeginOffset': 58, 'EndOffset': 65}) == 0
+    def test_desegment_large_dense_document(self):
+        text = "SSN 123-45-6789 and phone 555-0100. " * 30000
+        segmenter = Segmenter(5000, overlap_tokens=20)
+        segments = segmenter.segment(text)
+        for segment in segments:
+            segment.pii_entities = [{'Score': 0.9, 'Type': 'SSN', 'BeginOffset': i + 4, 'EndOffset': i + 15}
+                                    for i in range(len(segment.text)) if segment.text.startswith('SSN ', i)]
+        shuffle(segments)
+        start_time = timeit.default_timer()
+        merged_doc = segmenter.de_segment(segments)
+        elapsed_time = timeit.default_timer() - start_time
+        assert elapsed_time < 2
+        assert merged_doc.text == text
+        assert [entity['BeginOffset'] for entity in merged_doc.pii_entities] == [i * 36 + 4 for i in range(30000)]
+
+    def test_desegment_many_colliding_entities(self):
+        # every segment reports the same entities, with the highest scores reported by the last segment
+        segments = [Document(text="x" * 10000, char_offset=i,
+                             pii_entities=[{'Score': i / 10, 'Type': 'NAME', 'BeginOffset': 10 * k - i, 'EndOffset': 10 * k - i + 5}
+                                           for k in range(1, 1000)]) for i in range(5)]
+        merged_doc = Segmenter(5000).de_segment(segments)
+        assert merged_doc.pii_entities == [{'Score': 0.4, 'Type': 'NAME', 'BeginOffset': 10 * k, 'EndOffset': 10 * k + 5}
+                                           for k in range(1, 1000)]
 
     def test_segmenter_scalablity_test(self):
         # 1MB of text should be segmented with around 30 ms latency
@@ -123,6 +167,33 @@ segmenter = Segmenter(overlap_tokens=20, max_doc_size=5000)
         segmentation_time = timeit.timeit("segmenter.segment(one_mb_text)", setup=setup, number=100)
         assert segmentation_time < 15
 
+    def test_segmenter_multi_mb_unicode_text_scalability(self):
+        # segmentation is linear in the size of the text, even when it has multi byte characters
+        text = "ʕ•́ᴥ•̀ʔっ♡ Hello Zhang Wei. 汉堡包 Your AnyCompany credit card account 1111-0000-1111-0000 😜 " * 40000
+        start_time = timeit.default_timer()
+        segments = Segmenter(50000).segment(text)
+        elapsed_time = timeit.default_timer() - start_time
+        assert elapsed_time < 2
+        for segment in segments:
+            assert len(segment.text.encode('utf-8')) <= 50000
+            assert text[segment.char_offset:segment.char_offset + len(segment.text)] == segment.text
+        assert Segmenter(50000).de_segment(segments).text == text
+
+    def test_utf8_byte_index(self):
+        text = "ʕ•́ᴥ•̀ʔっ♡ Emoticons 😜 hànbǎobāo, hànbǎo 汉堡包/漢堡包 " * 5
+        byte_index = Utf8ByteIndex(text)
+        for char_offset in range(len(text) + 1):
+            assert byte_index.byte_offset(char_offset) == len(text[:char_offset].encode('utf-8'))
+        for byte_offset in range(len(text.encode('utf-8')) + 1):
+            expected = max(i for i in range(len(text) + 1) if len(text[:i].encode('utf-8')) <= byte_offset)
+            assert byte_index.char_offset_at_most(byte_offset) == expected
+
+    def test_utf8_byte_index_ascii(self):
+        byte_index = Utf8ByteIndex("Some Random text")
+        assert byte_index.byte_offset(5) == 5
+        assert byte_index.char_offset_at_most(5) == 5
+        assert byte_index.char_offset_at_most(500) == 16
+
     def test_redaction_with_no_entities(self):
         text = "Hello Zhang Wei. Your AnyCompany Financial Services, LLC credit card account 1111-0000-1111-0000 has a minimum payment of $24.53"
         redactor = Redactor(RedactionConfig())
@@ -145,6 +216,97 @@ segmenter = Segmenter(overlap_tokens=20, max_doc_size=5000)
         expected_redaction = "Hello [NAME]. Your AnyCompany Financial Services, LLC credit card account 1111-0000-1111-0000 has a minimum payment of $24.53"
         assert expected_redaction == redacted_text
 
+    def test_redaction_with_overlapping_entities(self):
+        text = "Hello Zhang Wei. Your AnyCompany Financial Services, LLC credit card account 1111-0000-1111-0000 has a minimum payment of $24.53"
+        entities = [{'Score': 0.9, 'Type': 'CREDIT_DEBIT_NUMBER', 'BeginOffset': 77, 'EndOffset': 96},
+                    {'Score': 0.7, 'Type': 'BANK_ACCOUNT_NUMBER', 'BeginOffset': 69, 'EndOffset': 86},
+                    {'Score': 0.8, 'Type': 'NAME', 'BeginOffset': 6, 'EndOffset': 15}]
+        redacted_text = Redactor(RedactionConfig()).redact(text, entities)
+        assert redacted_text == "Hello *********. Your AnyCompany Financial Services, LLC credit card *************************** has a minimum payment " \
+                                "of $24.53"
+        redacted_text = Redactor(RedactionConfig(mask_mode=REPLACE_WITH_PII_ENTITY_TYPE)).redact(text, entities)
+        assert redacted_text == "Hello [NAME]. Your AnyCompany Financial Services, LLC credit card [CREDIT_DEBIT_NUMBER] has a minimum payment of $24.53"
+
+    def test_incremental_redactor_matches_whole_redaction(self):
+        text = "Call 555-0100 or 555-0199, SSN 123-45-6789, card 1111-0000-1111-0000. " * 200
+        segmenter = Segmenter(500, overlap_tokens=5)
+        segments = segmenter.segment(text)
+        for i, segment in enumerate(segments):
+            # overlapping segments report the same entities with different scores and spans
+            segment.pii_entities = [{'Score': 0.5 + (i % 5) / 10, 'Type': entity_type, 'BeginOffset': k + begin,
+                                     'EndOffset': k + begin + length + (i % 2)}
+                                    for k in range(len(segment.text)) if segment.text.startswith('Call', k)
+                                    for entity_type, begin, length in [('PHONE', 5, 8), ('PHONE', 17, 8), ('SSN', 31, 11)]
+                                    if k + begin + length + 1 <= len(segment.text)]
+            segment.pii_classification = {'PHONE': i / len(segments)}
+        for mask_mode in ['MASK', REPLACE_WITH_PII_ENTITY_TYPE]:
+            redactor = Redactor(RedactionConfig(mask_mode=mask_mode))
+            expected_redaction = redactor.redact(text, segmenter.de_segment(segments).pii_entities)
+            for _ in range(5):
+                incremental_redactor = IncrementalRedactor(text, redactor)
+                for segment in segments:
+                    incremental_redactor.expect(segment)
+                shuffle(segments)
+                pieces = [incremental_redactor.add(segment) for segment in segments] + [incremental_redactor.finish()]
+                assert ''.join(pieces) == expected_redaction
+                assert incremental_redactor.pii_classification == {'PHONE': (len(segments) - 1) / len(segments)}
+
+    def test_incremental_redactor_waits_for_first_expected_segment(self):
+        text = "My SSN is 123-45-6789 and my phone is 555-0100"
+        segments = [Document(text=text[:26], char_offset=0,
+                             pii_entities=[{'Score': 0.5, 'Type': 'SSN', 'BeginOffset': 10, 'EndOffset': 21}]),
+                    Document(text=text[17:], char_offset=17,
+                             pii_entities=[{'Score': 0.9, 'Type': 'SSN', 'BeginOffset': 0, 'EndOffset': 4},
+                                           {'Score': 0.9, 'Type': 'PHONE', 'BeginOffset': 21, 'EndOffset': 29}])]
+        incremental_redactor = IncrementalRedactor(text, Redactor(RedactionConfig(mask_mode=REPLACE_WITH_PII_ENTITY_TYPE)))
+        for segment in segments:
+            incremental_redactor.expect(segment)
+        # nothing before the first segment is complete until it comes in
+        assert incremental_redactor.add(segments[1]) == ''
+        # the conflicting entities are resolved by score
+        assert incremental_redactor.add(segments[0]) == "My SSN is 123-45-[SSN] and my phone is [PHONE]"
+        assert incremental_redactor.finish() == ''
+
+    def test_incremental_redactor_holds_back_entities_crossing_into_expected_segment(self):
+        text = "My SSN is 123-45-6789 and my phone is 555-0100"
+        segments = [Document(text=text[:26], char_offset=0,
+                             pii_entities=[{'Score': 0.5, 'Type': 'SSN', 'BeginOffset': 10, 'EndOffset': 21}]),
+                    Document(text=text[17:], char_offset=17,
+                             pii_entities=[{'Score': 0.9, 'Type': 'PHONE', 'BeginOffset': 0, 'EndOffset': 4}])]
+        incremental_redactor = IncrementalRedactor(text, Redactor(RedactionConfig(mask_mode=REPLACE_WITH_PII_ENTITY_TYPE)))
+        for segment in segments:
+            incremental_redactor.expect(segment)
+        # the ssn might conflict with the entities of the second segment
+        assert incremental_redactor.add(segments[0]) == "My SSN is "
+        assert incremental_redactor.add(segments[1]) == "123-45-[PHONE] and my phone is 555-0100"
+        assert incremental_redactor.finish() == ''
+
+    def test_luhn_checksum_valid(self):
+        assert luhn_checksum_valid("4111 1111 1111 1111")
+        assert luhn_checksum_valid("3782-822463-10005")
+        assert not luhn_checksum_valid("4111 1111 1111 1112")
+
+    def test_pii_pre_screen(self):
+        pre_screen = PiiPreScreen(['SSN', 'EMAIL', 'CREDIT_DEBIT_NUMBER', 'PASSWORD'], PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP)
+        assert pre_screen.skips_clean_segments
+        assert pre_screen.has_candidates("My SSN is 123-45-6789")
+        assert pre_screen.has_candidates("Reach me at jane.doe@example.com")
+        assert pre_screen.has_candidates("Paid with 4111 1111 1111 1111")
+        assert pre_screen.has_candidates("The Password is hunter2")
+        # card numbers failing the luhn check and numeric values aren't candidates
+        assert not pre_screen.has_candidates("Paid with 4111 1111 1111 1112")
+        assert not pre_screen.has_candidates("ts=1700000000 cpu=0.75 mem=1024 latency=12.5 99 1000 2021 42")
+        segments = [Document("cpu=0.75"), Document("SSN: 123 45 6789"), Document("mem=1024")]
+        assert pre_screen.partition(segments) == ([segments[1]], [segments[0], segments[2]])
+
+    def test_pii_pre_screen_with_unscreened_entity_types(self):
+        # names can't be screened for locally, so clean segments may still hold pii of interest
+        assert not PiiPreScreen(['SSN', 'NAME'], PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP).skips_clean_segments
+        pre_screen = PiiPreScreen(['ALL'], PII_PRE_SCREEN_POLICY_VALID_VALUES.SKIP)
+        assert not pre_screen.skips_clean_segments
+        assert pre_screen.has_candidates("Call me at (206) 555-0100")
+        assert not pre_screen.has_candidates("Barack Obama was born in Hawaii")
+
     def test_segmenter_constructor_invalid_args(self):
         try:
             Segmenter(3)
@@ -1,18 +1,35 @@
 from unittest import TestCase
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
 
-from clients.s3_client import S3Client
-from constants import BEGIN_OFFSET, END_OFFSET, ENTITY_TYPE, SCORE, S3_STATUS_CODES, S3_ERROR_CODES, RANGE
-from exceptions import S3DownloadException, FileSizeLimitExceededException, UnsupportedFileException
+from clients.s3_client import S3Client, TextStream
+from constants import BEGIN_OFFSET, END_OFFSET, ENTITY_TYPE, SCORE, S3_STATUS_CODES, S3_ERROR_CODES, RANGE, \
+    UNSUPPORTED_FILE_HANDLING_VALID_VALUES, MIN_TIME_FOR_API_CALL
+from exceptions import S3DownloadException, FileSizeLimitExceededException, UnsupportedFileException, TaskCancelledException, \
+    DeadlineExceededException
+from scheduler import CancellationToken
+from spill import MappedText
+from util import Deadline
 
 PRESIGNED_URL_TEST = "https://s3ol-classifier.s3.amazonaws.com/test.txt"
 
 
 class MockResponse:
-    def __init__(self, content, status_code, headers):
+    def __init__(self, content, status_code, headers, chunk_size=None):
         self.status_code = status_code
         self.content = content
         self.headers = headers
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        chunk_size = self.chunk_size or chunk_size
+        for i in range(0, len(self.content), chunk_size):
+            self.bytes_read = min(i + chunk_size, len(self.content))
+            yield bytes(self.content[i:i + chunk_size])
+
+    def close(self):
+        self.closed = True
 
 
 def get_s3_xml_response(code: str, message: str = '') -> str:
@@ -59,6 +76,58 @@ class S3ClientTest(TestCase):
                                                                         RequestRoute='Route', RequestToken="q2334",
                                                                         StatusCode=206)
 
+    @patch('clients.s3_client.boto3')
+    def test_s3_client_respond_back_with_streamed_data(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+        sent_bodies = []
+        mocked_client.write_get_object_response.side_effect = lambda Body, **kwargs: sent_bodies.append(b''.join(Body))
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        s3_client.respond_back_with_data(data=iter(["Some ", "Dätä"]), headers={"SomeRandomHeader": '0123'},
+                                         request_route="Route", request_token="q2334")
+
+        assert sent_bodies == ["Some Dätä".encode('utf-8')]
+        mocked_client.write_get_object_response.assert_called_once_with(Body=ANY, RequestRoute='Route', RequestToken="q2334",
+                                                                        StatusCode=200)
+        # a streamed body can't be sent again, so the request isn't retried
+        assert mocked_boto3.client.call_args[1]['config'].retries == {'total_max_attempts': 1, 'mode': 'standard'}
+
+    @patch('clients.s3_client.boto3')
+    def test_s3_client_respond_back_with_streamed_data_failure(self, mocked_boto3):
+        mocked_client = MagicMock()
+        mocked_boto3.client.return_value = mocked_client
+
+        def chunks():
+            yield "Some "
+            raise DeadlineExceededException("redaction", 100)
+
+        def send(Body, **kwargs):
+            try:
+                b''.join(Body)
+            except Exception as error:
+                raise RuntimeError("Exception received when sending urllib3 HTTP request") from error
+
+        mocked_client.write_get_object_response.side_effect = send
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        # the error raised while producing the data is raised, and isn't counted as a failure of s3
+        with self.assertRaises(DeadlineExceededException):
+            s3_client.respond_back_with_data(data=chunks(), headers={}, request_route="Route", request_token="q2334")
+        assert 'ErrorCount' not in [metric['MetricName'] for metric in s3_client.write_get_object_metrics.metrics]
+
+    def test_text_stream(self):
+        text = "ʕ•́ᴥ•̀ʔっ♡ Emoticons 😜 hànbǎobāo " * 10
+        encoded = text.encode('utf-8')
+        with patch.object(TextStream, 'ENCODING_SIZE', 7):
+            assert b''.join(TextStream([text[:100], '', text[100:]])) == encoded
+            stream = TextStream([text[:100], '', text[100:]])
+            assert stream.read(0) == b''
+            blocks = [stream.read(10)]
+            # iterating over a partially read stream goes on from where reading stopped
+            assert b''.join(blocks + list(stream)) == encoded
+            stream = TextStream([text])
+            assert stream.read(25) + stream.read() == encoded
+            assert stream.read(10) == b''
+
     @patch('clients.s3_client.requests.Session.get',
            side_effect=lambda *args, **kwargs: MockResponse(b'Test', 200, {'Content-Length': '4'}))
     def test_s3_client_download_file_from_presigned_url_200_ok(self, mocked_get):
@@ -68,7 +137,7 @@ class S3ClientTest(TestCase):
         assert text == 'Test'
         assert response_http_headers == {'Content-Length': '4'}
         assert status_code == S3_STATUS_CODES.OK_200
-        mocked_get.assert_called_with(PRESIGNED_URL_TEST, timeout=10, headers=http_header)
+        mocked_get.assert_called_with(PRESIGNED_URL_TEST, timeout=10, headers=http_header, stream=True)
 
     @patch('clients.s3_client.requests.Session.get',
            side_effect=lambda *args, **kwargs: MockResponse(b'Test', 206, {'Content-Length': '100'}))
@@ -79,7 +148,7 @@ class S3ClientTest(TestCase):
         assert text == 'Test'
         assert response_http_headers == {'Content-Length': '100'}
         assert status_code == S3_STATUS_CODES.PARTIAL_CONTENT_206
-        mocked_get.assert_called_with(PRESIGNED_URL_TEST, timeout=10, headers=http_header)
+        mocked_get.assert_called_with(PRESIGNED_URL_TEST, timeout=10, headers=http_header, stream=True)
 
     @patch('clients.s3_client.requests.Session.get',
            side_effect=lambda *args, **kwargs: MockResponse(b'Test', 400, {'Content-Length': '4'}))
@@ -139,3 +208,180 @@ class S3ClientTest(TestCase):
         self.assertRaises(S3DownloadException, s3_client.download_file_from_presigned_url, PRESIGNED_URL_TEST, {})
 
         assert mocked_get.call_count == 5
+
+    def test_s3_client_download_rejects_large_file_before_reading_body(self):
+        response = MockResponse(b'A' * 1024, 200, {'Content-Length': '1024'})
+        s3_client = S3Client(s3ol_access_point="Random_access_point", max_file_supported=100)
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            self.assertRaises(FileSizeLimitExceededException, s3_client.download_file_from_presigned_url, PRESIGNED_URL_TEST, {})
+        assert response.bytes_read == 0
+        assert response.closed
+
+    def test_s3_client_download_aborts_mid_stream_when_file_size_limit_exceeded(self):
+        response = MockResponse(b'A' * 1024, 200, {}, chunk_size=10)
+        s3_client = S3Client(s3ol_access_point="Random_access_point", max_file_supported=100)
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            self.assertRaises(FileSizeLimitExceededException, s3_client.download_file_from_presigned_url, PRESIGNED_URL_TEST, {})
+        assert response.bytes_read == 110
+        assert response.closed
+
+    def test_s3_client_download_aborted_when_cancelled(self):
+        cancellation_token = CancellationToken()
+        response = MockResponse(b'A' * 1024, 200, {'Content-Length': '1024'}, chunk_size=10)
+        iter_content = response.iter_content
+
+        def cancelled_after_three_chunks(chunk_size=1):
+            for i, chunk in enumerate(iter_content(chunk_size)):
+                if i == 3:
+                    cancellation_token.cancel()
+                yield chunk
+
+        response.iter_content = cancelled_after_three_chunks
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            self.assertRaises(TaskCancelledException, s3_client.download_file_from_presigned_url, PRESIGNED_URL_TEST, {},
+                              cancellation_token)
+        assert response.bytes_read == 40
+        assert response.closed
+        assert s3_client.download_metrics.metrics == []
+
+    def test_s3_client_download_outliving_its_request(self):
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        first_request_metrics = s3_client.download_metrics
+
+        def next_request_begins(*args, **kwargs):
+            s3_client.begin_request()
+            return MockResponse(b'Test', 200, {'Content-Length': '4'})
+
+        with patch('clients.s3_client.requests.Session.get', side_effect=next_request_begins):
+            s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {})
+        # the download is recorded for the request it was made for
+        assert [metric['MetricName'] for metric in first_request_metrics.metrics] == ['Latency']
+        assert s3_client.download_metrics.metrics == []
+
+    def test_s3_client_download_forgets_cancellation_callback(self):
+        cancellation_token = CancellationToken()
+        response = MockResponse(b'Test', 200, {'Content-Length': '4'})
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            downloaded_text, _, _ = s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {}, cancellation_token)
+        assert downloaded_text == 'Test'
+        assert cancellation_token._callbacks == []
+
+    def test_s3_client_download_within_deadline(self):
+        response = MockResponse(b'Test', 200, {'Content-Length': '4'})
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response) as mocked_get:
+            downloaded_text, _, _ = s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {}, deadline=Deadline(60000))
+            assert mocked_get.call_args[1]['timeout'] == S3Client.MAX_GET_TIMEOUT
+            s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {}, deadline=Deadline(5000))
+            assert 4.5 < mocked_get.call_args[1]['timeout'] <= 5
+            with self.assertRaises(DeadlineExceededException):
+                s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {}, deadline=Deadline(MIN_TIME_FOR_API_CALL))
+            assert mocked_get.call_count == 2
+        assert downloaded_text == 'Test'
+
+    @patch('clients.s3_client.requests.Session.get',
+           side_effect=lambda *args, **kwargs: MockResponse(get_s3_xml_response('InternalError').encode('utf-8'), 200,
+                                                            {'Content-Length': '4'}))
+    def test_s3_client_download_does_not_retry_past_deadline(self, mocked_get):
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with self.assertRaises(DeadlineExceededException):
+            s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {}, deadline=Deadline(1100))
+        assert mocked_get.call_count == 1
+
+    def test_s3_client_download_decodes_characters_split_across_chunks(self):
+        text = "Some ünicode 文字 text 😀" * 10
+        response = MockResponse(text.encode('utf-8'), 200, {'Content-Length': str(len(text.encode('utf-8')))}, chunk_size=3)
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            downloaded_text, _, _ = s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {})
+        assert downloaded_text == text
+
+    def test_s3_client_download_body_longer_than_content_length(self):
+        response = MockResponse(b'Test text', 200, {'Content-Length': '4'}, chunk_size=2)
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            downloaded_text, _, _ = s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {})
+        assert downloaded_text == 'Test text'
+
+    @patch('clients.s3_client.UNSUPPORTED_FILE_HANDLING', UNSUPPORTED_FILE_HANDLING_VALID_VALUES.FAIL)
+    def test_s3_client_download_stops_reading_invalid_utf8_file(self):
+        response = MockResponse(b'Test' + bytearray.fromhex('ff') + b'A' * 100, 200, {'Content-Length': '105'}, chunk_size=10)
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            self.assertRaises(UnsupportedFileException, s3_client.download_file_from_presigned_url, PRESIGNED_URL_TEST, {})
+        assert response.bytes_read == 10
+
+    @patch('clients.s3_client.UNSUPPORTED_FILE_HANDLING', UNSUPPORTED_FILE_HANDLING_VALID_VALUES.PASS)
+    def test_s3_client_download_reads_whole_invalid_utf8_file_to_pass_it_back(self):
+        content = b'Test' + bytearray.fromhex('ff') + b'A' * 100
+        response = MockResponse(content, 200, {'Content-Length': '105'}, chunk_size=10)
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            with self.assertRaises(UnsupportedFileException) as context:
+                s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {})
+        assert context.exception.file_content == content
+
+    @patch('clients.s3_client.UNSUPPORTED_FILE_HANDLING', UNSUPPORTED_FILE_HANDLING_VALID_VALUES.PASS)
+    def test_s3_client_download_truncated_utf8_file(self):
+        content = "Test 😀".encode('utf-8')[:-1]
+        response = MockResponse(content, 200, {'Content-Length': str(len(content))})
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            with self.assertRaises(UnsupportedFileException) as context:
+                s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {})
+        assert context.exception.file_content == content
+
+    def test_s3_client_download_spills_large_file(self):
+        content = "Some ünicode 文字 text 😀 ".encode('utf-8') * 10
+        response = MockResponse(content, 200, {'Content-Length': str(len(content))}, chunk_size=7)
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            small_text, _, _ = s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {}, spill_threshold=len(content))
+            response.closed = False
+            spilled_text, _, _ = s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {}, spill_threshold=100)
+        assert small_text == content.decode('utf-8')
+        assert isinstance(spilled_text, MappedText)
+        with spilled_text:
+            assert spilled_text[:] == small_text
+            spilled_text.file.seek(0)
+            assert spilled_text.file.read() == content
+
+    @patch('clients.s3_client.UNSUPPORTED_FILE_HANDLING', UNSUPPORTED_FILE_HANDLING_VALID_VALUES.PASS)
+    def test_s3_client_download_passes_back_invalid_utf8_spilled_file(self):
+        content = b'Test' + bytearray.fromhex('ff') + b'A' * 100
+        response = MockResponse(content, 200, {'Content-Length': '105'}, chunk_size=10)
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            with self.assertRaises(UnsupportedFileException) as context:
+                s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {}, spill_threshold=10)
+        # the file is passed back without being read in memory
+        with context.exception.file_content as file:
+            assert file.read() == content
+
+    def test_s3_client_download_range_cutting_multibyte_characters(self):
+        content = "Some ünicode 文字 text 😀".encode('utf-8')
+        # bytes 15 to 27 start with the last two bytes of 文 and end with the first two bytes of 😀
+        body = content[15:28]
+        response = MockResponse(body, 206, {'Content-Length': str(len(body)), 'Content-Range': f"bytes 15-27/{len(content)}"},
+                                chunk_size=1)
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            text, http_headers, status_code = s3_client.download_file_from_presigned_url(PRESIGNED_URL_TEST, {},
+                                                                                         trim_partial_characters=True)
+        assert text == "字 text "
+        assert http_headers['Content-Range'] == f"bytes 17-25/{len(content)}"
+        assert http_headers['Content-Length'] == '9'
+        assert status_code == S3_STATUS_CODES.PARTIAL_CONTENT_206
+
+    def test_s3_client_download_part_cutting_multibyte_character(self):
+        content = "é abc".encode('utf-8')
+        # a part which starts in the middle of a character is rejected rather than returned without it, even when it could be spilled
+        body = content[1:]
+        response = MockResponse(body, 206, {'Content-Length': str(len(body)), 'Content-Range': f"bytes 1-5/{len(content)}"})
+        s3_client = S3Client(s3ol_access_point="Random_access_point")
+        with patch('clients.s3_client.requests.Session.get', return_value=response):
+            self.assertRaises(UnsupportedFileException, s3_client.download_file_from_presigned_url, PRESIGNED_URL_TEST, {},
+                              spill_threshold=1)
+        assert response.headers['Content-Range'] == f"bytes 1-5/{len(content)}"
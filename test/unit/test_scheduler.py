@@ -0,0 +1,95 @@
+from threading import Event
+from unittest import TestCase
+
+from exceptions import TaskCancelledException
+from scheduler import CancellationToken, Scheduler
+
+
+class SchedulerTest(TestCase):
+
+    def setUp(self) -> None:
+        self.scheduler = Scheduler()
+
+    def tearDown(self) -> None:
+        self.scheduler.shutdown()
+
+    def test_pools_are_reused(self):
+        pool = self.scheduler.pool('Some pool', 2)
+        assert self.scheduler.pool('Some pool', 2) is pool
+        assert pool._max_workers == 2
+        assert self.scheduler.pool('Some pool', 3) is not pool
+        assert self.scheduler.pool('Other pool', 2) is not pool
+
+    def test_task_group(self):
+        tasks = self.scheduler.task_group('Some pool', 2)
+        futures = [tasks.submit(pow, 2, i) for i in range(5)]
+        assert tasks.wait(timeout=1)
+        assert [future.result() for future in futures] == [1, 2, 4, 8, 16]
+        assert tasks.futures == futures
+        assert not tasks.cancelled
+
+    def test_task_group_cancel(self):
+        started, release = Event(), Event()
+
+        def blocking_task():
+            started.set()
+            release.wait()
+            return 'done'
+
+        tasks = self.scheduler.task_group('Some pool', 1)
+        running = tasks.submit(blocking_task)
+        started.wait()
+        pending = tasks.submit(pow, 2, 3)
+        assert tasks.cancel() == 1
+        assert tasks.cancelled
+        assert pending.cancelled()
+        with self.assertRaises(TaskCancelledException):
+            tasks.submit(pow, 2, 3)
+        release.set()
+        assert running.result(timeout=1) == 'done'
+
+        # the pool outlives the cancelled group and serves the next ones
+        assert self.scheduler.task_group('Some pool', 1).submit(pow, 2, 3).result(timeout=1) == 8
+
+    def test_task_group_cancelled_when_block_raises(self):
+        release = Event()
+        with self.assertRaises(ValueError):
+            with self.scheduler.task_group('Some pool', 1) as tasks:
+                running = tasks.submit(release.wait)
+                pending = tasks.submit(pow, 2, 3)
+                release.set()
+                raise ValueError()
+        assert tasks.cancelled
+        assert running.done()
+        assert pending.done()
+
+    def test_task_group_cancelled_with_token(self):
+        started, release = Event(), Event()
+        token = CancellationToken()
+        tasks = self.scheduler.task_group('Some pool', 1, token)
+        tasks.submit(lambda: started.set() or release.wait())
+        started.wait()
+        pending = tasks.submit(pow, 2, 3)
+        token.cancel()
+        release.set()
+        assert tasks.cancelled
+        assert pending.cancelled()
+
+    def test_cancellation_token(self):
+        token = CancellationToken()
+        calls = []
+        token.add_callback(lambda: calls.append('first'))
+        token.add_callback(lambda: calls.append('removed'))
+        token.remove_callback(token._callbacks[-1])
+        token.raise_if_cancelled()
+        assert not token.wait(0.01)
+
+        token.cancel()
+        token.cancel()
+        assert token.cancelled
+        assert token.wait(10)
+        assert calls == ['first']
+        with self.assertRaises(TaskCancelledException):
+            token.raise_if_cancelled()
+        token.add_callback(lambda: calls.append('late'))
+        assert calls == ['first', 'late']
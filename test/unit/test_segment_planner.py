@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+from segment_planner import LatencyModel, billed_units, plan_segment_sizes
+
+
+class SegmentPlannerTest(TestCase):
+    def test_billed_units(self):
+        assert billed_units(1) == 3
+        assert billed_units(300) == 3
+        assert billed_units(301) == 4
+        assert billed_units(5000) == 50
+
+    def test_latency_model_fitted_to_calls(self):
+        latency = LatencyModel(base_latency=100, latency_per_char=0.01)
+        assert latency.estimate(1000) == 110
+        for size in [1000, 5000, 2000, 10000, 3000] * 10:
+            latency.observe(size, 50 + 0.02 * size)
+        assert abs(latency.estimate(20000) - 450) < 1
+
+    def test_latency_model_with_calls_of_one_size(self):
+        latency = LatencyModel(base_latency=100, latency_per_char=0.01)
+        for _ in range(20):
+            latency.observe(5000, 300)
+        # the cost per character stays the prior one, the fixed cost is fitted
+        assert abs(latency.estimate(5000) - 300) < 1
+        assert abs(latency.estimate(10000) - 350) < 1
+
+    def test_plan_small_text(self):
+        plan = plan_segment_sizes(2000, 1.0, LatencyModel(), LatencyModel(), 20, 8)
+        assert plan.classification.segment_count == 1
+        assert plan.billed_units == plan.min_billed_units == 40
+
+    def test_plan_tiny_text(self):
+        # a single segment keeps the maximum size, a segment of the text length would be too small to segment
+        plan = plan_segment_sizes(2, 2.0, LatencyModel(), LatencyModel(), 20, 8, max_classification_size=50 * 1000,
+                                  max_detection_size=5 * 1000)
+        assert (plan.classification_size, plan.detection_size) == (50 * 1000, 5 * 1000)
+
+    def test_plan_spreads_segments_over_threads(self):
+        plan = plan_segment_sizes(100 * 1000, 1.0, LatencyModel(), LatencyModel(), 20, 8, max_classification_size=50 * 1000,
+                                  max_detection_size=5 * 1000, overlap_size=200)
+        # one round of calls over every thread instead of two large segments, for a few more units
+        assert plan.classification.segment_count == 20
+        assert plan.classification_size % 100 == 0
+        assert plan.classification.billed_units <= 1.1 * 1002
+        assert plan.detection_size <= 5 * 1000
+        assert plan.estimated_time < plan_segment_sizes(100 * 1000, 1.0, LatencyModel(), LatencyModel(), 1, 1).estimated_time
+
+    def test_plan_sizes_in_bytes(self):
+        plan = plan_segment_sizes(100 * 1000, 2.0, LatencyModel(), LatencyModel(), 1, 1, max_classification_size=50 * 1000,
+                                  max_detection_size=5 * 1000, detect_entities=False)
+        # segments of at most 25000 characters of 2 bytes
+        assert plan.classification.segment_size <= 25 * 1000
+        assert plan.classification_size == 2 * plan.classification.segment_size
+        assert plan.detection is None
+
+    def test_plan_relaxes_cost_bound_to_meet_deadline(self):
+        def plan(remaining_time):
+            return plan_segment_sizes(50 * 1000, 1.0, LatencyModel(), LatencyModel(), 20, 8, remaining_time=remaining_time,
+                                      detect_entities=False, max_classification_size=50 * 1000, max_extra_units=0)
+        # without any extra unit allowed, the text is classified as a whole
+        assert plan(None).classification.segment_count == 1
+        assert plan(10000).classification.segment_count == 1
+        assert plan(300).classification.segment_count == 20
@@ -0,0 +1,39 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from spill import MappedText, spill_file
+
+
+def mapped_text(text: str) -> MappedText:
+    file = spill_file()
+    file.write(text.encode('utf-8'))
+    return MappedText(file)
+
+
+class SpillTest(TestCase):
+    def test_mapped_text(self):
+        text = "ʕ•́ᴥ•̀ʔっ♡ Emoticons 😜 hànbǎobāo, hànbǎo 汉堡包/漢堡包 " * 20
+        # blocks and reads much smaller than the text, cutting multibyte characters
+        with patch.object(MappedText, 'BLOCK_SIZE', 16), patch.object(MappedText, 'READ_SIZE', 101):
+            with mapped_text(text) as mapped:
+                assert len(mapped) == len(text)
+                assert mapped.byte_size == len(text.encode('utf-8'))
+                for begin in range(0, len(text), 7):
+                    for end in range(begin, len(text) + 20, 53):
+                        assert mapped[begin:end] == text[begin:end]
+                assert mapped[-10:] == text[-10:]
+                assert mapped[:] == text
+
+    def test_mapped_text_block_multiple(self):
+        with patch.object(MappedText, 'BLOCK_SIZE', 4):
+            with mapped_text("汉堡包/漢堡包!") as mapped:
+                assert len(mapped) == 8
+                assert mapped[4:8] == "漢堡包!"
+                assert mapped.byte_offset(8) == mapped.byte_size
+
+    def test_mapped_text_empty(self):
+        mapped = mapped_text('')
+        assert len(mapped) == 0
+        assert mapped[0:10] == ''
+        mapped.close()
+        assert mapped.file.closed
@@ -1,9 +1,12 @@
 import time
+from threading import Event, current_thread
 from time import sleep
 from unittest import TestCase
 
-from exceptions import TimeoutException, FileSizeLimitExceededException
-from util import execute_task_with_timeout
+from constants import REQUEST_POOL, REQUEST_POOL_THREAD_COUNT
+from exceptions import DeadlineExceededException, TimeoutException, FileSizeLimitExceededException
+from scheduler import CancellationToken
+from util import Deadline, execute_task_with_timeout
 
 
 class UtilTest(TestCase):
@@ -35,3 +38,46 @@ class UtilTest(TestCase):
 
         with self.assertRaises(FileSizeLimitExceededException) as e:
             execute_task_with_timeout(2000, task)
+
+    def test_execute_task_with_timeout_reuses_threads(self):
+        thread_names = set()
+
+        def task():
+            thread_names.add(current_thread().name)
+
+        for _ in range(10):
+            execute_task_with_timeout(2000, task)
+        assert len(thread_names) <= REQUEST_POOL_THREAD_COUNT
+        assert all(thread_name.startswith(REQUEST_POOL) for thread_name in thread_names)
+
+    def test_execute_task_with_timeout_cancels_token(self):
+        cancellation_token = CancellationToken()
+        stopped = Event()
+
+        def task():
+            while not cancellation_token.wait(0.01):
+                pass
+            stopped.set()
+
+        with self.assertRaises(TimeoutException):
+            execute_task_with_timeout(1000, task, cancellation_token)
+        assert cancellation_token.cancelled
+        assert stopped.wait(1)
+
+    def test_deadline(self):
+        deadline = Deadline(5000)
+        assert 4900 <= deadline.remaining_time_in_millis() <= 5000
+        assert deadline.timeout(1) == 1
+        assert 4.9 <= deadline.timeout(10) <= 5
+        deadline.check("some operation", 1000)
+        with self.assertRaises(DeadlineExceededException) as e:
+            deadline.check("some operation", 5000)
+        assert isinstance(e.exception, TimeoutException)
+        assert e.exception.operation == "some operation"
+        assert 'some operation' in str(e.exception)
+
+        expired_deadline = Deadline(-1000)
+        assert expired_deadline.remaining_time_in_millis() == 0
+        assert expired_deadline.timeout(10) == 0
+        with self.assertRaises(DeadlineExceededException):
+            expired_deadline.check("some operation")